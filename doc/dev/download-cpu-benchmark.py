@@ -0,0 +1,92 @@
+#!/usr/bin/python
+# Compare the CPU time used per gigabyte downloaded with the fixed
+# 8 KiB reads (and a progress report per block) that gPodder used
+# before and with the adaptive block size and time-based reports
+#
+# Usage: python doc/dev/download-cpu-benchmark.py [MEGABYTES]
+#
+# The file is served from localhost by a separate process, so only
+# the CPU time of the downloading process (user + system) is counted.
+
+import sys
+import os
+import time
+import socket
+import tempfile
+import resource
+import subprocess
+import BaseHTTPServer
+
+sys.path.insert(0, 'src')
+
+from gpodder import download
+
+CHUNK = 'x'*(1024*1024)
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        size = int(self.path.strip('/'))*len(CHUNK)
+        self.send_response(200)
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        for i in range(size/len(CHUNK)):
+            self.wfile.write(CHUNK)
+
+    def log_message(self, *args):
+        pass
+
+def serve(port):
+    BaseHTTPServer.HTTPServer(('127.0.0.1', port), Handler).serve_forever()
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+class Channel(object):
+    username = None
+    password = None
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def measure(url, megabytes, mode):
+    opener = download.DownloadURLOpener(Channel())
+    if mode == 'before':
+        opener.MIN_BLOCK_SIZE = opener.MAX_BLOCK_SIZE = 8*1024
+        opener.REPORT_INTERVAL = 0
+
+    reports = []
+    def reporthook(count, block_size, total):
+        reports.append(count*block_size)
+
+    filename = tempfile.mktemp()
+    start, cpu = time.time(), cpu_time()
+    opener.retrieve_resume(url, filename, reporthook)
+    duration, cpu = time.time()-start, cpu_time()-cpu
+    os.remove(filename)
+
+    print '%-7s %6.2f CPU s/GiB  %7.1f MiB/s  %7d reports' % (mode, \
+            cpu*1024./megabytes, megabytes/duration, len(reports))
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == '--serve':
+        serve(int(sys.argv[2]))
+        sys.exit(0)
+
+    megabytes = int((sys.argv[1:] or [1024])[0])
+    port = free_port()
+    server = subprocess.Popen([sys.executable, sys.argv[0], '--serve', str(port)])
+    time.sleep(1)
+
+    try:
+        url = 'http://127.0.0.1:%d/%d' % (port, megabytes)
+        for mode in ('before', 'after'):
+            measure(url, megabytes, mode)
+    finally:
+        server.terminate()
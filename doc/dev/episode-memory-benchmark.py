@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# Compare the memory used by PodcastEpisode objects and EpisodeRecord
+# objects when loading all episodes of a big (synthetic) library
+#
+# Usage: python doc/dev/episode-memory-benchmark.py [EPISODES]
+#
+# Each loading mode is measured in its own process (on Linux, using
+# the resident set size from /proc/self/status).
+
+import sys
+import os
+import time
+import tempfile
+import subprocess
+
+sys.path.insert(0, 'src')
+
+from gpodder import dbsqlite
+from gpodder import model
+
+CHANNELS = 50
+DESCRIPTION = 'Lorem ipsum dolor sit amet, consectetur adipisicing elit. '*20
+
+def rss_kb():
+    for line in open('/proc/self/status'):
+        if line.startswith('VmRSS:'):
+            return int(line.split()[1])
+    return 0
+
+def create_database(filename, count):
+    db = dbsqlite.Database(filename)
+    for channel_id in range(1, CHANNELS+1):
+        db.db.execute('INSERT INTO channels (id, url, title, channel_is_locked) VALUES (?, ?, ?, 0)', \
+                (channel_id, 'http://example.com/%d.xml' % channel_id, 'Podcast %d' % channel_id))
+
+    channels = model.PodcastChannel.load_from_db(db, tempfile.gettempdir())
+    episodes = []
+    for i in range(count):
+        episode = model.PodcastEpisode(channels[i % CHANNELS])
+        episode.guid = 'episode-%d' % i
+        episode.url = 'http://example.com/episodes/%d.mp3' % i
+        episode.title = 'Episode number %d' % i
+        episode.description = DESCRIPTION
+        episode.pubDate = 1262300400 + i*3600
+        episode.length = 12345678
+        episodes.append(episode)
+    db.save_episodes(episodes)
+    db.close()
+
+def measure(filename, mode):
+    db = dbsqlite.Database(filename)
+    channels = model.PodcastChannel.load_from_db(db, tempfile.gettempdir())
+
+    before = rss_kb()
+    start = time.time()
+    episodes = []
+    for channel in channels:
+        if mode == 'full':
+            episodes.extend(channel.get_all_episodes())
+        elif mode == 'lazy':
+            episodes.extend(channel.get_all_episodes(lazy=True))
+        else:
+            episodes.extend(channel.get_episode_records())
+    duration = time.time() - start
+
+    print '%-8s %7d episodes  %8.1f MiB  %6.2f s' % (mode, len(episodes), \
+            (rss_kb()-before)/1024., duration)
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '--measure':
+        measure(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+
+    count = int((sys.argv[1:] or [50000])[0])
+    filename = tempfile.mktemp(suffix='.sqlite')
+    print 'Creating database with %d episodes...' % count
+    create_database(filename, count)
+
+    for mode in ('full', 'lazy', 'record'):
+        subprocess.call([sys.executable, sys.argv[0], '--measure', filename, mode])
+
+    os.remove(filename)
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# Compare the time needed to remove old and unreachable episodes after
+# a feed update with one DELETE per vanished GUID plus the NOT IN/LIMIT
+# purge that gPodder used before and with Database.prune_episodes
+#
+# Usage: python doc/dev/prune-benchmark.py [EPISODES] [VANISHED] [ROUNDS]
+#
+# Each round simulates an update of a podcast with EPISODES episodes
+# whose feed does not list VANISHED of them anymore; max_episodes
+# keeps all but the 50 oldest episodes.
+
+import sys
+import os
+import time
+import tempfile
+
+sys.path.insert(0, 'src')
+
+import gpodder
+from gpodder import dbsqlite
+from gpodder import model
+
+def create_database(filename, count):
+    db = dbsqlite.Database(filename)
+    db.db.execute('INSERT INTO channels (id, url, title, channel_is_locked) VALUES (1, ?, ?, 0)', \
+            ('http://example.com/feed.xml', 'Podcast'))
+
+    channel = model.PodcastChannel.load_from_db(db, tempfile.gettempdir())[0]
+    episodes = []
+    for i in range(count):
+        episode = model.PodcastEpisode(channel)
+        episode.guid = 'episode-%d' % i
+        episode.url = 'http://example.com/episodes/%d.mp3' % i
+        episode.title = 'Episode number %d' % i
+        episode.pubDate = 1262300400 + i*3600
+        episodes.append(episode)
+    db.save_episodes(episodes)
+    db.commit()
+    return db
+
+def prune_before(db, max_episodes, seen_guids):
+    cur = db.db.cursor()
+    cur.execute('SELECT guid FROM episodes WHERE channel_id = 1 AND state <> ?', \
+            (gpodder.STATE_DOWNLOADED,))
+    for (guid,) in cur.fetchall():
+        if guid not in seen_guids:
+            db.db.execute('DELETE FROM episodes WHERE channel_id = 1 AND guid = ?', (guid,))
+    db.db.execute("""
+        DELETE FROM episodes
+        WHERE channel_id = ?
+        AND state <> ?
+        AND id NOT IN
+        (SELECT id FROM episodes WHERE channel_id = ?
+        ORDER BY pubDate DESC LIMIT ?)""", \
+                (1, gpodder.STATE_DOWNLOADED, 1, max_episodes))
+    db.commit()
+
+def prune_after(db, max_episodes, seen_guids):
+    db.prune_episodes(1, max_episodes, seen_guids)
+    db.commit()
+
+def measure(filename, count, vanished, rounds, mode):
+    duration = 0.
+    for i in range(rounds):
+        db = create_database(filename, count)
+        seen_guids = set('episode-%d' % i for i in range(count) \
+                if i < count/2 or i >= count/2+vanished)
+        start = time.time()
+        if mode == 'before':
+            prune_before(db, count-50, seen_guids)
+        else:
+            prune_after(db, count-50, seen_guids)
+        duration += time.time() - start
+        remaining = db.db.execute('SELECT COUNT(*) FROM episodes').fetchone()[0]
+        db.close()
+        os.remove(filename)
+
+    print '%-8s %7d episodes  %5d vanished  %7d left  %8.1f ms' % (mode, \
+            count, vanished, remaining, duration*1000./rounds)
+
+if __name__ == '__main__':
+    count = int((sys.argv[1:] or [10000])[0])
+    vanished = int((sys.argv[2:] or [100])[0])
+    rounds = int((sys.argv[3:] or [5])[0])
+    filename = tempfile.mktemp(suffix='.sqlite')
+
+    for mode in ('before', 'after'):
+        measure(filename, count, vanished, rounds, mode)
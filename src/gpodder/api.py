@@ -29,6 +29,8 @@ from gpodder import opml
 from gpodder.model import PodcastChannel
 from gpodder import download
 from gpodder import console
+from gpodder import feedupdate
+from gpodder import tagger
 
 from gpodder import dbsqlite
 from gpodder import config
@@ -54,7 +56,7 @@ class Podcast(object):
         """Get all episodes that belong to this podcast
 
         Returns a list of Episode objects that belong to this podcast."""
-        return [Episode(e, self._manager) for e in self._podcast.get_all_episodes()]
+        return [Episode(e, self._manager) for e in self._podcast.get_episode_records()]
 
     def rename(self, title):
         """Set a new title for this podcast
@@ -114,9 +116,10 @@ class Episode(object):
         This will run the download in the same thread, so be sure
         to call this method from a worker thread in case you have
         a GUI running as a frontend."""
-        task = download.DownloadTask(self._episode, self._manager._config)
+        task = download.DownloadTask(self._episode.get_episode(), self._manager._config)
         task.status = download.DownloadTask.QUEUED
-        task.run()
+        if task.run():
+            task.wait()
 
 
 class PodcastClient(object):
@@ -171,6 +174,102 @@ class PodcastClient(object):
 
         return None
 
+    def update_podcasts(self, podcasts=None, progress_callback=None, \
+            error_callback=None):
+        """Update multiple podcasts in parallel
+
+        Downloads the feeds of all podcasts in "podcasts" (or of all
+        subscribed podcasts if it is None) in parallel and adds the
+        new episodes to the database. The optional callbacks are
+        called as progress_callback(podcast, position, total) after
+        each podcast and error_callback(podcast, exception) for each
+        podcast that cannot be updated.
+        """
+        if podcasts is None:
+            podcasts = self.get_podcasts()
+
+        lookup = dict((p._podcast, p) for p in podcasts)
+
+        def on_progress(channel, position, total):
+            if progress_callback is not None:
+                progress_callback(lookup[channel], position, total)
+
+        def on_error(channel, error):
+            if error_callback is not None:
+                error_callback(lookup[channel], error)
+
+        updater = feedupdate.FeedUpdater(self._config.feed_update_workers, \
+                self._config.feed_update_connections_per_host)
+        updater.update([p._podcast for p in podcasts], \
+                self._config.max_episodes_per_feed, \
+                progress_callback=on_progress, error_callback=on_error)
+
+    def create_refresh_scheduler(self, update_callback=None, \
+            error_callback=None):
+        """Create a scheduler that updates podcasts when they are due
+
+        Call start() on the returned object to update every subscribed
+        podcast in the background when a new episode is expected (see
+        feedupdate.RefreshScheduler), and stop() to end the updates.
+        The optional callbacks are called as update_callback(podcast,
+        episodes) with the list of new episodes after each update and
+        error_callback(podcast, exception) for failed updates.
+        """
+        podcasts = self.get_podcasts()
+        lookup = dict((p._podcast, p) for p in podcasts)
+
+        def on_updated(channel, episodes, removed_ids):
+            if update_callback is not None:
+                ids = set(e.id for e in episodes)
+                update_callback(lookup[channel], [Episode(e, self) for e in \
+                        channel.get_episode_records() if e.id in ids])
+
+        def on_failed(channel, error):
+            if error_callback is not None:
+                error_callback(lookup[channel], error)
+
+        scheduler = feedupdate.RefreshScheduler( \
+                self._config.max_episodes_per_feed, \
+                min_interval=60*self._config.auto_update_frequency)
+        scheduler.register('podcast-updated', on_updated)
+        scheduler.register('podcast-failed', on_failed)
+        scheduler.set_podcasts([p._podcast for p in podcasts])
+        return scheduler
+
+    def check_statistics(self):
+        """Check and repair the episode statistics
+
+        Recalculates the per-podcast episode counts from scratch
+        and returns the list of podcasts whose counts were wrong.
+        """
+        ids = set(self._db.rebuild_channel_counts())
+        return [p for p in self.get_podcasts() if p._podcast.id in ids]
+
+    def retag_episodes(self, force=False, progress_callback=None):
+        """Update the tags of all downloaded episodes
+
+        Use this after changing the tag_* settings. Files whose tags
+        already match the settings are not written. If "force" is
+        True, all files are checked (not only those for which the
+        settings have changed since they were tagged).
+
+        If given, progress_callback(position, total) is called for
+        every file that is checked. Returns a tuple (changed, failed)
+        with the number of files that have been changed or could not
+        be tagged.
+        """
+        batch = tagger.BatchTagger(self._config)
+        if progress_callback is not None:
+            batch.register('progress', progress_callback)
+
+        episodes = []
+        for podcast in PodcastChannel.load_from_db(self._db, \
+                self._config.download_dir):
+            episodes.extend(podcast.get_episode_records())
+
+        results = batch.retag(episodes, force)
+        return (results[batch.CHANGED], results[batch.FAILED])
+
     def synchronize_device(self):
         """Synchronize episodes to a device
 
@@ -65,11 +65,36 @@ gPodderSettings = {
         "time. Requires 'max_downloads_enabled'.")),
     'max_downloads_enabled': ( bool, True,
       ("The 'max_downloads' setting will only work if this is set to 'True'.")), 
+    'max_downloads_per_host': ( int, 0,
+      ("The maximum number of simultaneous downloads from the same server "
+        "(0 means no limit).")),
+    'download_queue_policy': ( str, 'fifo',
+      ("The order in which queued downloads are started: 'fifo' (in the "
+        "order they were added), 'smallest' (smallest files first), "
+        "'newest' (newest episodes first) or 'roundrobin' (one episode "
+        "of each podcast in turn).")),
     'limit_rate': ( bool, False,
       ("The 'limit_rate_value' setting will only work if this is set to 'True'.")),
     'limit_rate_value': ( float, 500.0,
       ("Set a global speed limit (in KB/s) when downloading files. "
         "Requires 'limit_rate'.")),
+    'limit_rate_hosts': ( str, '',
+      ("Speed limits (in KB/s) for downloads from specific servers, "
+        "separated by spaces, e.g. 'example.com=100 example.org=50'. "
+        "These also apply to subdomains of the given hosts.")),
+    'limit_rate_schedule': ( str, '',
+      ("Times of the day with a different global speed limit (in KB/s), "
+        "separated by spaces, e.g. '08:00-18:00=100 23:00-06:00=0'. "
+        "A limit of 0 means no limit. Requires 'limit_rate'.")),
+    'download_segments': ( int, 1,
+      ("The number of connections used to download a single episode. If "
+        "this is larger than 1, big files are split into parts that are "
+        "downloaded in parallel (if the server supports it).")),
+    'dedup_downloads': ( bool, False,
+      ("Compute a checksum of downloaded files and store files that have "
+        "already been downloaded for another episode (with the same URL "
+        "or content) only once, using hard links. Has no effect if "
+        "update_tags is enabled, as the tags differ between episodes.")),
     'episode_old_age': ( int, 7,
       ("The number of days before an episode is considered old.")),
 
@@ -93,8 +118,9 @@ gPodderSettings = {
       ("Automatically update feeds when gPodder is minimized. "
         "See 'auto_update_frequency' and 'auto_download'.")),
     'auto_update_frequency': (int, 20,
-      ("The frequency (in minutes) at which gPodder will update all feeds "
-        "if 'auto_update_feeds' is enabled.")),
+      ("The minimum time (in minutes) between two automatic updates of "
+        "a feed if 'auto_update_feeds' is enabled. Each feed is updated "
+        "when a new episode is expected.")),
     'auto_cleanup_downloads': (bool, True,
       ('Automatically removed cancelled and finished downloads from the list')),
     'episode_list_descriptions': (bool, True,
@@ -203,6 +229,10 @@ gPodderSettings = {
 
     'feed_update_skipping': (bool, False,
       ('Skip podcasts that are unlikely to have new episodes when updating feeds.')),
+    'feed_update_workers': (int, 4,
+      ('The number of feeds that are downloaded in parallel when updating feeds.')),
+    'feed_update_connections_per_host': (int, 2,
+      ('The maximum number of feeds downloaded from the same server at once.')),
     'allow_empty_feeds': (bool, True,
       ('Allow subscribing to feeds without episodes')),
 
@@ -226,7 +256,6 @@ gPodderSettings = {
     'youtube_preferred_fmt_id': (int, 18,
       ('The preferred video format that should be downloaded from YouTube.')),
 
-<<<<<<< HEAD
 	# File tag updating settings
 	'update_tags': (bool, False,
 	  ("Should file tags be updated after download?")),
@@ -24,6 +24,8 @@
 # 2010-04-24 Thomas Perl <thp@gpodder.org>
 #
 
+from __future__ import with_statement
+
 import gpodder
 _ = gpodder.gettext
 
@@ -47,9 +49,12 @@ if not have_sqlite:
     sys.exit(1)
 
 from gpodder.liblogger import log
+from gpodder import util
 
 import string
 import threading
+import contextlib
+import time
 import re
 
 class Database(object):
@@ -72,12 +77,18 @@ class Database(object):
             ('password', 'TEXT'), # Password for HTTP authentication (feed update + downloads)
             ('last_modified', 'TEXT'), # Last-modified HTTP header from last update
             ('etag', 'TEXT'), # ETag HTTP header from last update
+            ('feed_digest', 'TEXT'), # Digest of the feed content from last update
             ('channel_is_locked', 'INTEGER'), # 1 if deletion is prevented, 0 otherwise
             ('foldername', 'TEXT'), # Folder name (basename) to put downloaded episodes
             ('auto_foldername', 'INTEGER'), # 1 if the foldername was auto-generated, 0 otherwise
             ('release_expected', 'INTEGER'), # Statistic value for when a new release is expected
             ('release_deviation', 'INTEGER'), # Deviation of the release cycle differences
             ('updated_timestamp', 'INTEGER'), # Timestamp of the last feed update
+            ('release_count', 'INTEGER'), # Number of release intervals in the statistics
+            ('release_mean', 'REAL'), # Mean length of the release intervals
+            ('release_m2', 'REAL'), # Sum of squared differences from the mean interval
+            ('release_min', 'INTEGER'), # Shortest release interval
+            ('release_latest', 'INTEGER'), # Date of the latest release in the statistics
     )
     INDEX_CHANNELS = (
             ('foldername', 'UNIQUE INDEX'),
@@ -107,6 +118,9 @@ class Database(object):
             ('total_time', 'INTEGER'), # Length in seconds
             ('current_position', 'INTEGER'), # Current playback position
             ('current_position_updated', 'INTEGER'), # Set to NOW when updating current_position
+            ('tag_fingerprint', 'TEXT'), # Fingerprint of the tags written to the file (or NULL)
+            ('digest', 'TEXT'), # SHA-1 of the downloaded file (or NULL)
+            ('duplicate_id', 'TEXT'), # Hash of title and pubDate (see util.duplicate_id)
     )
     INDEX_EPISODES = (
             ('guid', 'UNIQUE INDEX'),
@@ -116,13 +130,59 @@ class Database(object):
             ('state', 'INDEX'),
             ('played', 'INDEX'),
             ('locked', 'INDEX'),
+            ('digest', 'INDEX'),
+            (('channel_id', 'guid'), 'INDEX'),
+            (('channel_id', 'duplicate_id'), 'INDEX'),
+            (('channel_id', 'pubDate'), 'INDEX'),
+    )
+
+    # Per-channel episode statistics, maintained by triggers on "episodes"
+    TABLE_COUNTS = 'channel_counts'
+    SCHEMA_COUNTS = (
+            ('channel_id', 'INTEGER PRIMARY KEY'), # ID of the podcast
+            ('total', 'INTEGER'), # Number of episodes
+            ('deleted', 'INTEGER'), # Number of deleted episodes
+            ('new', 'INTEGER'), # Number of new (not downloaded, not played) episodes
+            ('downloaded', 'INTEGER'), # Number of downloaded episodes
+            ('unplayed', 'INTEGER'), # Number of downloaded, unplayed episodes
+    )
+    INDEX_COUNTS = ()
+
+    # Journal of unfinished downloads, used to resume them on startup
+    TABLE_DOWNLOADS = 'downloads'
+    SCHEMA_DOWNLOADS = (
+            ('episode_id', 'INTEGER PRIMARY KEY'), # ID of the episode
+            ('status', 'INTEGER'), # Status of the DownloadTask
+            ('offset', 'INTEGER'), # Number of bytes already downloaded
+            ('total_size', 'INTEGER'), # Expected size of the file
+            ('updated', 'INTEGER'), # Timestamp of the last change
+    )
+    INDEX_DOWNLOADS = (
+            ('status', 'INDEX'),
     )
 
+    # Maximum number of "?" placeholders used in a single query
+    MAX_SQL_VARIABLES = 500
+
     def __init__(self, filename):
         self.database_file = filename
         self._db = None
+        self._wal = False
+        self._readers = threading.local()
+        self._all_readers = []
+        self._readers_lock = threading.Lock()
         self.lock = threading.RLock()
 
+        # Cached episode statistics (see get_all_channel_counts)
+        self._counts_lock = threading.Lock()
+        self._channel_counts = None
+        self._stale_channels = set()
+        self._counts_generation = 0
+
+        # True if the download journal did not exist before (see
+        # load_download_journal)
+        self.download_journal_created = False
+
     def close(self):
         self.commit()
 
@@ -132,6 +192,14 @@ class Database(object):
         cur.close()
         self.lock.release()
 
+        # Close the read connections of all threads
+        self._readers_lock.acquire()
+        readers, self._all_readers = self._all_readers, []
+        self._readers = threading.local()
+        self._readers_lock.release()
+        for reader in readers:
+            reader.close()
+
         self._db.close()
         self._db = None
 
@@ -142,25 +210,79 @@ class Database(object):
         except TypeError, e:
             log('Exception in log(): %s: %s', e, message, sender=self)
 
-    def purge(self, max_episodes, channel_id):
+    def prune_episodes(self, channel_id, max_episodes, seen_guids=None):
+        """Delete old and unreachable episodes of a podcast
+
+        Episodes that have not been downloaded are deleted if they
+        are not among the "max_episodes" most recent episodes or, if
+        "seen_guids" is given, if their GUID is not in "seen_guids"
+        (i.e. the feed does not list them anymore). Both are deleted
+        in a single transaction; unreachable episodes are deleted first,
+        so that they do not count towards "max_episodes".
+
+        Returns the list of IDs of the deleted episodes.
+
+        >>> import tempfile, shutil, os.path
+        >>> tempdir = tempfile.mkdtemp()
+        >>> db = Database(os.path.join(tempdir, 'database.sqlite'))
+        >>> for i in range(1, 7):
+        ...     db.db.execute('INSERT INTO episodes (id, channel_id, guid, ' \\
+        ...             'pubDate, state) VALUES (?, 1, ?, ?, ?)', (i, 'e%d' % i, \\
+        ...             i, (i == 2) and gpodder.STATE_DOWNLOADED or 0)) and None
+        >>> db.journal_download(1, 1, 0, 100)
+        >>> db.prune_episodes(1, 3, ['e1', 'e3', 'e4', 'e6'])
+        [5, 1]
+        >>> db.db.execute('SELECT id FROM episodes ORDER BY id').fetchall()
+        [(2,), (3,), (4,), (6,)]
+        >>> db.db.execute('SELECT COUNT(*) FROM downloads').fetchall()
+        [(0,)]
+        >>> db.prune_episodes(1, 1)
+        [4, 3]
+        >>> db.close()
+        >>> shutil.rmtree(tempdir)
         """
-        Deletes old episodes.  Should be called
-        before adding new episodes to a channel.
-        """
-        cur = self.cursor(lock=True)
+        ids = []
+
+        def delete(cur, new_ids):
+            for offset in range(0, len(new_ids), self.MAX_SQL_VARIABLES):
+                chunk = new_ids[offset:offset+self.MAX_SQL_VARIABLES]
+                qmarks = ', '.join('?'*len(chunk))
+                cur.execute('DELETE FROM %s WHERE id IN (%s)' % \
+                        (self.TABLE_EPISODES, qmarks), chunk)
+                cur.execute('DELETE FROM %s WHERE episode_id IN (%s)' % \
+                        (self.TABLE_DOWNLOADS, qmarks), chunk)
+            ids.extend(new_ids)
 
-        self.log("purge(%s)", channel_id)
-        sql = """
-            DELETE FROM episodes
-            WHERE channel_id = ?
-            AND state <> ?
-            AND id NOT IN
-            (SELECT id FROM episodes WHERE channel_id = ?
-            ORDER BY pubDate DESC LIMIT ?)"""
-        cur.execute(sql, (channel_id, gpodder.STATE_DOWNLOADED, channel_id, max_episodes))
+        try:
+            with self.transaction() as cur:
+                # Episodes that have disappeared from the feed
+                if seen_guids is not None:
+                    cur.execute('CREATE TEMP TABLE IF NOT EXISTS seen_guids (guid TEXT PRIMARY KEY)')
+                    cur.execute('DELETE FROM temp.seen_guids')
+                    cur.executemany('INSERT OR IGNORE INTO temp.seen_guids (guid) VALUES (?)', \
+                            ((guid,) for guid in seen_guids))
+                    cur.execute('SELECT id FROM %s WHERE channel_id = ? AND state <> ? ' \
+                            'AND guid IS NOT NULL AND guid NOT IN ' \
+                            '(SELECT guid FROM temp.seen_guids)' % self.TABLE_EPISODES, \
+                            (channel_id, gpodder.STATE_DOWNLOADED))
+                    delete(cur, [id for (id,) in cur.fetchall()])
+                    cur.execute('DELETE FROM temp.seen_guids')
+
+                # Episodes that are not in the "keep-set" of the most recent ones
+                # (the index over channel_id and pubDate is used for sorting)
+                cur.execute('SELECT id FROM (SELECT id, state FROM %s ' \
+                        'WHERE channel_id = ? ORDER BY pubDate DESC LIMIT -1 OFFSET ?) ' \
+                        'WHERE state <> ?' % self.TABLE_EPISODES, \
+                        (channel_id, max_episodes, gpodder.STATE_DOWNLOADED))
+                delete(cur, [id for (id,) in cur.fetchall()])
+        except Exception, e:
+            log('Cannot prune episodes: %s', e, sender=self, traceback=True)
+            ids = []
 
-        cur.close()
-        self.lock.release()
+        if ids:
+            self.log('Pruned %d episodes of channel %d', len(ids), channel_id)
+            self._invalidate_counts(channel_id)
+        return ids
 
     def db_sort_cmp(self, a, b):
         """
@@ -183,13 +305,35 @@ class Database(object):
             b = re.sub('^the ', '', b.lower())
             return cmp(a, b)
 
+    def _connect(self):
+        # Autocommit mode: statements that have to be written atomically
+        # are executed in a transaction (see transaction())
+        db = sqlite.connect(self.database_file, check_same_thread=False, \
+                isolation_level=None)
+        db.text_factory = str
+        db.create_collation("UNICODE", self.db_sort_cmp)
+        db.create_function('duplicate_id', 2, util.duplicate_id)
+        return db
+
     @property
     def db(self):
+        """The connection used for writing (protected by self.lock)"""
         if self._db is None:
-            self._db = sqlite.connect(self.database_file, check_same_thread=False)
-            self._db.text_factory = str
-            self._db.create_collation("UNICODE", self.db_sort_cmp)
+            self._db = self._connect()
             self.log('Connected')
+
+            # With a write-ahead log, readers do not block the writer
+            # and vice versa, so we can use one connection per thread
+            # for reading (this does not work for in-memory databases)
+            cur = self._db.cursor()
+            cur.execute('PRAGMA journal_mode = WAL')
+            self._wal = (cur.fetchone()[0].lower() == 'wal')
+            if self._wal:
+                cur.execute('PRAGMA synchronous = NORMAL')
+            else:
+                self.log('WAL not available, reading with a shared connection')
+            cur.close()
+
             self.__check_schema()
         return self._db
 
@@ -198,7 +342,64 @@ class Database(object):
             self.lock.acquire()
         return self.db.cursor()
 
+    @contextlib.contextmanager
+    def read_cursor(self):
+        """Get a cursor for read-only queries
+
+        Use it in a with statement. In WAL mode, every thread has its
+        own connection for reading, so no locking is required and the
+        queries do not have to wait for long-running writes. Otherwise,
+        the cursor is taken from the write connection (with locking).
+        """
+        db = self.db
+        if self._wal:
+            reader = getattr(self._readers, 'db', None)
+            if reader is None:
+                reader = self._connect()
+                self._readers.db = reader
+                self._readers_lock.acquire()
+                self._all_readers.append(reader)
+                self._readers_lock.release()
+            cur = reader.cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
+        else:
+            self.lock.acquire()
+            cur = db.cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
+                self.lock.release()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Get a cursor for writing several statements atomically
+
+        The connections are in autocommit mode, so every statement is
+        committed on its own. Statements that are executed with this
+        cursor (in a with statement) are committed at the end of the
+        block, or rolled back if the block raises an exception.
+        """
+        self.lock.acquire()
+        cur = self.db.cursor()
+        try:
+            cur.execute('BEGIN')
+            try:
+                yield cur
+            except:
+                cur.execute('ROLLBACK')
+                raise
+            cur.execute('COMMIT')
+        finally:
+            cur.close()
+            self.lock.release()
+
     def commit(self):
+        # Writes are committed right away or at the end of transaction(),
+        # so this only finishes a transaction that has been left open
         self.lock.acquire()
         try:
             self.log("COMMIT")
@@ -230,10 +431,11 @@ class Database(object):
                 channel_ids = [id for (id,) in cur]
 
                 # Remove all deleted channels from the database
-                for id in channel_ids:
-                    self.log('Removing deleted channel with ID %d', id)
-                    cur.execute('DELETE FROM %s WHERE id = ?' % self.TABLE_CHANNELS, (id,))
-                    cur.execute('DELETE FROM %s WHERE channel_id = ?' % self.TABLE_EPISODES, (id,))
+                with self.transaction() as cur:
+                    for id in channel_ids:
+                        self.log('Removing deleted channel with ID %d', id)
+                        cur.execute('DELETE FROM %s WHERE id = ?' % self.TABLE_CHANNELS, (id,))
+                        cur.execute('DELETE FROM %s WHERE channel_id = ?' % self.TABLE_EPISODES, (id,))
         self.lock.release()
 
     def __check_schema(self):
@@ -248,70 +450,227 @@ class Database(object):
         # corresponding channels and their episodes and remove it
         self._remove_deleted_channels()
 
+        # Duplicate IDs have to be calculated for episodes of older versions
+        cur.execute('PRAGMA table_info(%s)' % self.TABLE_EPISODES)
+        duplicate_ids_missing = 'duplicate_id' not in [row[1] for row in cur]
+
         # Create tables and possibly add newly-added columns
         self.upgrade_table(self.TABLE_CHANNELS, self.SCHEMA_CHANNELS, self.INDEX_CHANNELS)
         self.upgrade_table(self.TABLE_EPISODES, self.SCHEMA_EPISODES, self.INDEX_EPISODES)
+        counts_created = self.upgrade_table(self.TABLE_COUNTS, self.SCHEMA_COUNTS, self.INDEX_COUNTS)
+        self.download_journal_created = self.upgrade_table(self.TABLE_DOWNLOADS, \
+                self.SCHEMA_DOWNLOADS, self.INDEX_DOWNLOADS)
+
+        self._create_count_triggers(cur)
+        if counts_created:
+            self.rebuild_channel_counts()
 
         # Make sure deleted episodes are played, to simplify querying statistics.
         try:
-            cur.execute("UPDATE episodes SET played = 1 WHERE state = ?", (gpodder.STATE_DELETED,))
+            cur.execute("UPDATE episodes SET played = 1 WHERE state = ? AND IFNULL(played, 0) = 0", (gpodder.STATE_DELETED,))
         except OperationalError:
             pass
 
+        if duplicate_ids_missing:
+            cur.execute("UPDATE episodes SET duplicate_id = duplicate_id(title, pubDate)")
+
         cur.close()
         self.lock.release()
 
+    # Expressions that evaluate to 1 if an episode row counts towards
+    # a statistic (in the order of the columns of TABLE_COUNTS)
+    COUNT_EXPRESSIONS = (
+            '1',
+            '(%(row)sstate = %(deleted)d)',
+            '(%(row)sstate = %(normal)d AND IFNULL(%(row)splayed, 0) = 0)',
+            '(%(row)sstate = %(downloaded)d)',
+            '(%(row)sstate = %(downloaded)d AND IFNULL(%(row)splayed, 0) = 0)',
+    )
+
+    def _count_expressions(self, row=''):
+        d = {'row': row,
+             'normal': gpodder.STATE_NORMAL,
+             'downloaded': gpodder.STATE_DOWNLOADED,
+             'deleted': gpodder.STATE_DELETED}
+        return [expression % d for expression in self.COUNT_EXPRESSIONS]
+
+    def _create_count_triggers(self, cur):
+        """Create triggers that keep TABLE_COUNTS up to date"""
+        columns = [name for name, typ in self.SCHEMA_COUNTS if name != 'channel_id']
+
+        def change(row, operator):
+            return ', '.join('%s = %s %s %s' % (column, column, operator, expression) \
+                    for column, expression in zip(columns, self._count_expressions(row)))
+
+        def ensure_row(row):
+            return 'INSERT OR IGNORE INTO %s (channel_id, %s) VALUES (%s.channel_id, %s);' % \
+                    (self.TABLE_COUNTS, ', '.join(columns), row, ', '.join('0'*len(columns)))
+
+        def update(row, operator):
+            return 'UPDATE %s SET %s WHERE channel_id = %s.channel_id;' % \
+                    (self.TABLE_COUNTS, change(row+'.', operator), row)
+
+        triggers = (
+            ('insert', 'AFTER INSERT', ensure_row('NEW') + update('NEW', '+')),
+            ('delete', 'AFTER DELETE', update('OLD', '-')),
+            ('update', 'AFTER UPDATE OF channel_id, state, played', \
+                    update('OLD', '-') + ensure_row('NEW') + update('NEW', '+')),
+        )
+
+        for name, event, body in triggers:
+            cur.execute('CREATE TRIGGER IF NOT EXISTS %s_%s %s ON %s BEGIN %s END' % \
+                    (self.TABLE_COUNTS, name, event, self.TABLE_EPISODES, body))
+
+    def rebuild_channel_counts(self):
+        """Recalculate the per-channel statistics from scratch
+
+        The statistics are normally kept up to date by triggers;
+        this can be used to check and repair them. Returns a list
+        of channel IDs for which the statistics were wrong.
+
+        >>> import tempfile, shutil, os.path
+        >>> tempdir = tempfile.mkdtemp()
+        >>> db = Database(os.path.join(tempdir, 'database.sqlite'))
+        >>> def execute(sql, *args):
+        ...     db.db.execute(sql % db.TABLE_EPISODES, args)
+        >>> for id, channel_id, state, played in ((1, 1, 0, 0), (2, 1, 1, 0), \\
+        ...         (3, 1, 2, 1), (4, 2, 0, 1)):
+        ...     execute('INSERT INTO %s (id, channel_id, state, played) ' \\
+        ...             'VALUES (?, ?, ?, ?)', id, channel_id, state, played)
+        >>> db.get_all_channel_counts() == {1: (3, 1, 1, 1, 1), 2: (1, 0, 0, 0, 0)}
+        True
+
+        The triggers update the statistics for each change:
+
+        >>> execute('UPDATE %s SET played = 1 WHERE id = 2')
+        >>> execute('UPDATE %s SET channel_id = 2 WHERE id = 1')
+        >>> execute('DELETE FROM %s WHERE id = 3')
+        >>> db.rebuild_channel_counts()
+        []
+        >>> db.get_all_channel_counts() == {1: (1, 0, 0, 1, 0), 2: (2, 0, 1, 0, 0)}
+        True
+        >>> db.db.execute('UPDATE %s SET total = 5' % db.TABLE_COUNTS) and None
+        >>> sorted(db.rebuild_channel_counts())
+        [1, 2]
+        >>> db.get_channel_count(2)
+        (2, 0, 1, 0, 0)
+        >>> db.close()
+        >>> shutil.rmtree(tempdir)
+        """
+        columns = [name for name, typ in self.SCHEMA_COUNTS]
+
+        with self.transaction() as cur:
+            cur.execute('SELECT * FROM %s' % self.TABLE_COUNTS)
+            old = dict((row[0], row[1:]) for row in cur if any(row[1:]))
+
+            cur.execute('DELETE FROM %s' % self.TABLE_COUNTS)
+            sums = ', '.join('SUM(%s)' % e for e in self._count_expressions())
+            cur.execute('INSERT INTO %s (%s) SELECT channel_id, %s FROM %s GROUP BY channel_id' % \
+                    (self.TABLE_COUNTS, ', '.join(columns), sums, self.TABLE_EPISODES))
+
+            cur.execute('SELECT * FROM %s' % self.TABLE_COUNTS)
+            new = dict((row[0], row[1:]) for row in cur)
+
+        self._invalidate_counts()
+
+        wrong = [id for id in set(old) | set(new) if old.get(id) != new.get(id)]
+        if wrong:
+            self.log('Rebuilt statistics for %d channel(s)', len(wrong))
+        return wrong
+
+    def _invalidate_counts(self, channel_id=None):
+        """Mark cached statistics of a channel (or all channels) as stale"""
+        with self._counts_lock:
+            self._counts_generation += 1
+            if channel_id is None:
+                self._channel_counts = None
+                self._stale_channels.clear()
+            elif self._channel_counts is not None:
+                self._stale_channels.add(channel_id)
+
+    def get_all_channel_counts(self):
+        """Get the statistics for all channels in one query
+
+        Returns a dictionary mapping channel IDs to tuples of
+        (total, deleted, new, downloaded, unplayed). Channels
+        without episodes are not contained in the dictionary.
+
+        The values are read from TABLE_COUNTS, which is kept up to
+        date by triggers (see rebuild_channel_counts).
+
+        The result is cached; after the first call, only the
+        channels that have been changed in the meantime are
+        queried from the database again.
+        """
+        with self._counts_lock:
+            generation = self._counts_generation
+            if self._channel_counts is None:
+                stale = None
+            elif self._stale_channels:
+                stale = list(self._stale_channels)
+            else:
+                return dict(self._channel_counts)
+
+        with self.read_cursor() as cur:
+            if stale is None:
+                cur.execute('SELECT * FROM %s WHERE total > 0' % self.TABLE_COUNTS)
+                rows = cur.fetchall()
+            else:
+                rows = []
+                for offset in range(0, len(stale), self.MAX_SQL_VARIABLES):
+                    chunk = stale[offset:offset+self.MAX_SQL_VARIABLES]
+                    cur.execute('SELECT * FROM %s WHERE total > 0 AND channel_id IN (%s)' % \
+                            (self.TABLE_COUNTS, ', '.join('?'*len(chunk))), chunk)
+                    rows.extend(cur.fetchall())
+
+        counts = dict((row[0], tuple(row[1:])) for row in rows)
+
+        with self._counts_lock:
+            if stale is None:
+                result = counts
+            else:
+                result = dict(self._channel_counts or {})
+                for id in stale:
+                    result.pop(id, None)
+                result.update(counts)
+
+            # Only cache the result if nothing changed while querying
+            if generation == self._counts_generation:
+                self._channel_counts = result
+                self._stale_channels.clear()
+
+            return dict(result)
+
     def get_channel_count(self, id):
         """Given a channel ID, returns the statistics for it
 
         Returns a tuple (total, deleted, new, downloaded, unplayed)
         """
-        total, deleted, new, downloaded, unplayed = 0, 0, 0, 0, 0
+        with self._counts_lock:
+            generation = self._counts_generation
+            if self._channel_counts is not None and id not in self._stale_channels:
+                return self._channel_counts.get(id, (0, 0, 0, 0, 0))
 
-        cur = self.cursor(lock=True)
-        cur.execute('SELECT COUNT(*), state, played FROM episodes WHERE channel_id = ? GROUP BY state, played', (id,))
-        for count, state, played in cur:
-            total += count
-            if state == gpodder.STATE_DELETED:
-                deleted += count
-            elif state == gpodder.STATE_NORMAL and not played:
-                new += count
-            elif state == gpodder.STATE_DOWNLOADED and not played:
-                downloaded += count
-                unplayed += count
-            elif state == gpodder.STATE_DOWNLOADED:
-                downloaded += count
+        with self.read_cursor() as cur:
+            cur.execute('SELECT total, deleted, new, downloaded, unplayed FROM %s WHERE channel_id = ?' % self.TABLE_COUNTS, (id,))
+            result = tuple(cur.fetchone() or (0, 0, 0, 0, 0))
 
-        cur.close()
-        self.lock.release()
+        with self._counts_lock:
+            if generation == self._counts_generation and \
+                    self._channel_counts is not None:
+                self._channel_counts[id] = result
+                self._stale_channels.discard(id)
 
-        return (total, deleted, new, downloaded, unplayed)
+        return result
 
     def get_total_count(self):
         """Get statistics for episodes in all channels
 
         Returns a tuple (total, deleted, new, downloaded, unplayed)
         """
-        total, deleted, new, downloaded, unplayed = 0, 0, 0, 0, 0
-
-        cur = self.cursor(lock=True)
-        cur.execute('SELECT COUNT(*), state, played FROM episodes GROUP BY state, played')
-        for count, state, played in cur:
-            total += count
-            if state == gpodder.STATE_DELETED:
-                deleted += count
-            elif state == gpodder.STATE_NORMAL and not played:
-                new += count
-            elif state == gpodder.STATE_DOWNLOADED and not played:
-                downloaded += count
-                unplayed += count
-            elif state == gpodder.STATE_DOWNLOADED:
-                downloaded += count
-
-        cur.close()
-        self.lock.release()
-
-        return (total, deleted, new, downloaded, unplayed)
+        with self.read_cursor() as cur:
+            cur.execute('SELECT SUM(total), SUM(deleted), SUM(new), SUM(downloaded), SUM(unplayed) FROM %s' % self.TABLE_COUNTS)
+            return tuple(value or 0 for value in cur.fetchone())
 
     def load_channels(self, factory=None, url=None):
         """
@@ -322,12 +681,13 @@ class Database(object):
 
         self.log("load_channels()")
 
-        cur = self.cursor(lock=True)
-        cur.execute('SELECT * FROM %s ORDER BY title COLLATE UNICODE' % self.TABLE_CHANNELS)
+        with self.read_cursor() as cur:
+            cur.execute('SELECT * FROM %s ORDER BY title COLLATE UNICODE' % self.TABLE_CHANNELS)
+            keys = list(desc[0] for desc in cur.description)
+            rows = cur.fetchall()
 
         result = []
-        keys = list(desc[0] for desc in cur.description)
-        for row in cur:
+        for row in rows:
             channel = dict(zip(keys, row))
 
             if url is None or url == channel['url']:
@@ -336,9 +696,6 @@ class Database(object):
                 else:
                     result.append(factory(channel, self))
 
-        cur.close()
-        self.lock.release()
-
         return result
 
     def save_channel(self, c):
@@ -347,50 +704,167 @@ class Database(object):
     def delete_channel(self, channel):
         assert channel.id is not None
 
-        cur = self.cursor(lock=True)
         self.log("delete_channel(%d), %s", channel.id, channel.url)
 
-        cur.execute("DELETE FROM channels WHERE id = ?", (channel.id, ))
-        cur.execute("DELETE FROM episodes WHERE channel_id = ?", (channel.id, ))
+        with self.transaction() as cur:
+            cur.execute("DELETE FROM channels WHERE id = ?", (channel.id, ))
+            cur.execute("DELETE FROM episodes WHERE channel_id = ?", (channel.id, ))
+            cur.execute("DELETE FROM channel_counts WHERE channel_id = ?", (channel.id, ))
+            cur.execute("DELETE FROM downloads WHERE episode_id NOT IN (SELECT id FROM episodes)")
 
-        cur.close()
-        # Commit changes
-        self.db.commit()
-        self.lock.release()
+        self._invalidate_counts(channel.id)
 
-    def load_all_episodes(self, channel_mapping, limit=10000):
-        self.log('Loading all episodes from the database')
-        sql = 'SELECT * FROM %s ORDER BY pubDate DESC LIMIT ?' % (self.TABLE_EPISODES,)
-        args = (limit,)
-        cur = self.cursor(lock=True)
-        cur.execute(sql, args)
-        keys = [desc[0] for desc in cur.description]
-        id_index = keys.index('channel_id')
-        result = map(lambda row: channel_mapping[row[id_index]].episode_factory(dict(zip(keys, row))), cur)
-        cur.close()
-        self.lock.release()
+    def episode_columns(self, exclude=()):
+        """Get the names of the episode columns, except for "exclude"
+
+        Can be used to build the "columns" argument for
+        load_episodes() and load_all_episodes().
+        """
+        return [name for name, typ in self.SCHEMA_EPISODES if name not in exclude]
+
+    def _episode_projection(self, columns):
+        if columns is None:
+            return '*'
+
+        # The ID and the podcast are always needed to create objects
+        names = ['id', 'channel_id']
+        names.extend(c for c in columns if c not in names)
+        known = set(self.episode_columns())
+        for name in names:
+            assert name in known, 'Unknown episode column: %s' % name
+        return ', '.join(names)
+
+    def load_all_episodes(self, channel_mapping, limit=None, columns=None):
+        """Load the newest episodes of all podcasts
+
+        Returns a list of at most "limit" episodes (all episodes if
+        "limit" is None). If "columns" is given, only these columns will
+        be loaded from the database, and the dictionaries passed to the
+        episode factory only contain these (and "id" and "channel_id").
+        Use iter_all_episodes() to avoid loading everything at once.
+        """
+        result = []
+        for page in self.iter_all_episodes(channel_mapping, columns=columns):
+            result.extend(page)
+            if limit is not None and len(result) >= limit:
+                del result[limit:]
+                break
         return result
 
-    def load_episodes(self, channel, factory=lambda x: x, limit=1000, state=None):
+    def iter_all_episodes(self, channel_mapping, page_size=500, columns=None):
+        """Yield the episodes of all podcasts in pages, newest first
+
+        Each page is a list of at most "page_size" episodes. The pages
+        are queried one by one (continuing after the last episode of
+        the previous page), so no cursor is kept open between pages and
+        there is no limit on the total number of episodes. Episodes of
+        podcasts that are not in "channel_mapping" are skipped.
+
+        >>> import tempfile, shutil, os.path
+        >>> tempdir = tempfile.mkdtemp()
+        >>> db = Database(os.path.join(tempdir, 'database.sqlite'))
+        >>> for id, channel_id, pubDate in ((1, 1, 10), (2, 1, 20), (3, 1, 20), \\
+        ...         (4, 1, None), (5, 1, None), (6, 1, 30), (7, 2, 25)):
+        ...     db.db.execute('INSERT INTO episodes (id, channel_id, pubDate) ' \\
+        ...             'VALUES (?, ?, ?)', (id, channel_id, pubDate)) and None
+        >>> class Channel(object):
+        ...     def episode_factory(self, d):
+        ...         return d['id']
+        >>> list(db.iter_all_episodes({1: Channel()}, 2, ['title']))
+        [[6], [3, 2], [1, 5], [4]]
+        >>> db.load_all_episodes({1: Channel(), 2: Channel()}, 3)
+        [6, 7, 3]
+        >>> db.close()
+        >>> shutil.rmtree(tempdir)
+        """
+        self.log('Loading all episodes from the database (paged)')
+        if columns is not None and 'pubDate' not in columns:
+            columns = list(columns) + ['pubDate']
+        sql = 'SELECT %s FROM %s %%s ORDER BY pubDate DESC, id DESC LIMIT ?' % \
+                (self._episode_projection(columns), self.TABLE_EPISODES)
+        where, args = '', ()
+
+        while True:
+            with self.read_cursor() as cur:
+                cur.execute(sql % where, args + (page_size,))
+                keys = [desc[0] for desc in cur.description]
+                rows = cur.fetchall()
+
+            if not rows:
+                break
+
+            id_index = keys.index('id')
+            channel_id_index = keys.index('channel_id')
+            pubdate_index = keys.index('pubDate')
+
+            page = []
+            for row in rows:
+                channel = channel_mapping.get(row[channel_id_index])
+                if channel is not None:
+                    page.append(channel.episode_factory(dict(zip(keys, row))))
+            if page:
+                yield page
+
+            if len(rows) < page_size:
+                break
+
+            last_id, last_pubdate = rows[-1][id_index], rows[-1][pubdate_index]
+
+            # Episodes without pubDate sort last (NULL is the smallest value)
+            if last_pubdate is None:
+                where = 'WHERE pubDate IS NULL AND id < ?'
+                args = (last_id,)
+            else:
+                where = 'WHERE pubDate < ? OR pubDate IS NULL OR (pubDate = ? AND id < ?)'
+                args = (last_pubdate, last_pubdate, last_id)
+
+    def load_episodes(self, channel, factory=lambda x: x, limit=1000, state=None, columns=None):
         assert channel.id is not None
 
         self.log('Loading episodes for channel %d', channel.id)
+        projection = self._episode_projection(columns)
 
         if state is None:
-            sql = 'SELECT * FROM %s WHERE channel_id = ? ORDER BY pubDate DESC LIMIT ?' % (self.TABLE_EPISODES,)
+            sql = 'SELECT %s FROM %s WHERE channel_id = ? ORDER BY pubDate DESC LIMIT ?' % (projection, self.TABLE_EPISODES)
             args = (channel.id, limit)
         else:
-            sql = 'SELECT * FROM %s WHERE channel_id = ? AND state = ? ORDER BY pubDate DESC LIMIT ?' % (self.TABLE_EPISODES,)
+            sql = 'SELECT %s FROM %s WHERE channel_id = ? AND state = ? ORDER BY pubDate DESC LIMIT ?' % (projection, self.TABLE_EPISODES)
             args = (channel.id, state, limit)
 
-        cur = self.cursor(lock=True)
-        cur.execute(sql, args)
-        keys = [desc[0] for desc in cur.description]
-        result = map(lambda row: factory(dict(zip(keys, row)), self), cur)
-        cur.close()
-        self.lock.release()
+        with self.read_cursor() as cur:
+            cur.execute(sql, args)
+            keys = [desc[0] for desc in cur.description]
+            result = map(lambda row: factory(dict(zip(keys, row)), self), cur)
         return result
 
+    def load_matching_episodes(self, channel, guids, duplicate_ids, \
+            factory=lambda x: x):
+        """Load the episodes of a podcast with one of the given GUIDs
+        or duplicate IDs (see util.duplicate_id)
+
+        The episodes are looked up using the indexes over (channel_id,
+        guid) and (channel_id, duplicate_id), so this only depends on
+        the number of GUIDs and IDs, not on the number of episodes.
+        """
+        assert channel.id is not None
+
+        result = {}
+        with self.read_cursor() as cur:
+            for column, values in (('guid', guids), ('duplicate_id', duplicate_ids)):
+                values = list(set(v for v in values if v is not None))
+                for offset in range(0, len(values), self.MAX_SQL_VARIABLES):
+                    chunk = values[offset:offset+self.MAX_SQL_VARIABLES]
+                    cur.execute('SELECT * FROM %s WHERE channel_id = ? AND %s IN (%s)' % \
+                            (self.TABLE_EPISODES, column, ', '.join('?'*len(chunk))), \
+                            [channel.id] + chunk)
+                    keys = [desc[0] for desc in cur.description]
+                    for row in cur.fetchall():
+                        d = dict(zip(keys, row))
+                        if d['id'] not in result:
+                            result[d['id']] = factory(d, self)
+
+        return result.values()
+
     def load_episode(self, id):
         """Load episode as dictionary by its id
 
@@ -399,18 +873,32 @@ class Database(object):
         """
         assert id is not None
 
-        cur = self.cursor(lock=True)
-        cur.execute('SELECT * from %s WHERE id = ? LIMIT 1' % (self.TABLE_EPISODES,), (id,))
-        try:
-            d = dict(zip((desc[0] for desc in cur.description), cur.fetchone()))
-            cur.close()
-            self.log('Loaded episode %d from DB', id)
-            self.lock.release()
-            return d
-        except:
-            cur.close()
-            self.lock.release()
+        with self.read_cursor() as cur:
+            cur.execute('SELECT * from %s WHERE id = ? LIMIT 1' % (self.TABLE_EPISODES,), (id,))
+            row = cur.fetchone()
+            if row is None:
+                return None
+            d = dict(zip((desc[0] for desc in cur.description), row))
+
+        self.log('Loaded episode %d from DB', id)
+        return d
+
+    def load_episode_value(self, id, column):
+        """Load a single column of an episode by its id
+
+        Used to load columns that have been left out when
+        loading the episode with a list of columns.
+        """
+        assert id is not None
+        assert column in self.episode_columns()
+
+        with self.read_cursor() as cur:
+            cur.execute('SELECT %s FROM %s WHERE id = ?' % (column, self.TABLE_EPISODES), (id,))
+            row = cur.fetchone()
+
+        if row is None:
             return None
+        return row[0]
 
     def save_episode(self, e):
         assert e.channel_id
@@ -420,6 +908,138 @@ class Database(object):
             return
 
         self._save_object(e, self.TABLE_EPISODES, self.SCHEMA_EPISODES)
+        self._invalidate_counts(e.channel_id)
+
+    def save_episodes(self, episodes):
+        """Save a list of episodes in a single transaction
+
+        New episodes (without id) are inserted and get their id
+        set, existing episodes are only written to the database
+        if at least one column has changed. Episodes without guid
+        are not saved (see save_episode). A new episode whose guid
+        is already in the database for its podcast gets the id of
+        that row and is saved like an existing one.
+
+        Returns a tuple (inserted, updated, unchanged).
+
+        >>> import tempfile, shutil, os.path
+        >>> tempdir = tempfile.mkdtemp()
+        >>> db = Database(os.path.join(tempdir, 'database.sqlite'))
+        >>> db.db.execute('INSERT INTO channels (id, url, title) ' \\
+        ...         'VALUES (1, ?, ?)', ('http://example.com/', 'Podcast')) and None
+        >>> class Episode(object):
+        ...     def __init__(self, guid, title):
+        ...         for name, typ in Database.SCHEMA_EPISODES:
+        ...             setattr(self, name, None)
+        ...         self.channel_id, self.guid, self.title = 1, guid, title
+        ...         self.pubDate = 1262300400
+        >>> episodes = [Episode('a', u'\\xc4'), Episode('b', 'B'), Episode('b', 'C')]
+        >>> db.save_episodes(episodes)
+        (2, 0, 0)
+        >>> [e.id is not None for e in episodes]
+        [True, True, False]
+
+        Only changed episodes are written (values are compared like
+        SQLite stores them):
+
+        >>> episodes[0].pubDate = 1262300400.0
+        >>> episodes[1].title = 'Bee'
+        >>> db.save_episodes(episodes[:2])
+        (0, 1, 1)
+        >>> again = Episode('a', u'\\xc4')
+        >>> db.save_episodes([again]), again.id == episodes[0].id
+        ((0, 0, 1), True)
+        >>> db.close()
+        >>> shutil.rmtree(tempdir)
+        """
+        columns = [name for name, typ in self.SCHEMA_EPISODES if name != 'id']
+        inserts, updates = [], {}
+        channel_ids = set()
+
+        for e in episodes:
+            assert e.channel_id
+            channel_ids.add(e.channel_id)
+            if not e.guid:
+                self.log('Refusing to save an episode without guid: %s', e)
+            elif e.id is None:
+                inserts.append(e)
+            else:
+                updates[e.id] = e
+
+        new_ids, inserted, changed = [], 0, 0
+
+        try:
+            with self.transaction() as cur:
+                # Episodes that are already in the database (e.g. from a
+                # concurrent update) are updated instead of inserted
+                known = self._find_guids(cur, inserts)
+                new_episodes = []
+                for e in inserts:
+                    id = known.get((e.channel_id, e.guid))
+                    if id is None:
+                        new_episodes.append(e)
+                    elif id not in updates:
+                        updates[id] = e
+                        new_ids.append((e, id))
+                inserts = new_episodes
+
+                if inserts:
+                    qmarks = ', '.join('?'*len(columns))
+                    sql = 'INSERT OR IGNORE INTO %s (%s) VALUES (%s)' % \
+                            (self.TABLE_EPISODES, ', '.join(columns), qmarks)
+                    cur.executemany(sql, ([getattr(e, name) for name in columns] \
+                            for e in inserts))
+                    inserted = cur.rowcount
+
+                    # Look up the ids of the inserted rows via their GUIDs
+                    # (rows that could not be inserted will keep id = None)
+                    ids = self._find_guids(cur, inserts)
+                    for e in inserts:
+                        id = ids.pop((e.channel_id, e.guid), None)
+                        if id is not None:
+                            new_ids.append((e, id))
+
+                # Only update rows where at least one column differs; SQLite
+                # compares the values after applying the column affinity
+                if updates:
+                    sql = 'UPDATE OR IGNORE %s SET %s WHERE id = ? AND (%s)' % \
+                            (self.TABLE_EPISODES, \
+                            ', '.join('%s = ?' % name for name in columns), \
+                            ' OR '.join('%s IS NOT ?' % name for name in columns))
+                    cur.executemany(sql, ([getattr(e, name) for name in columns] + \
+                            [id] + [getattr(e, name) for name in columns] \
+                            for id, e in updates.iteritems()))
+                    changed = cur.rowcount
+        except Exception, e:
+            log('Cannot save episodes: %s', e, sender=self, traceback=True)
+            new_ids, inserted, changed = [], 0, 0
+
+        # Only assign ids to new episodes if the transaction succeeded
+        for e, id in new_ids:
+            e.id = id
+
+        for channel_id in channel_ids:
+            self._invalidate_counts(channel_id)
+
+        unchanged = len(updates) - changed
+        self.log('save_episodes(): %d inserted, %d updated, %d unchanged', \
+                inserted, changed, unchanged)
+        return (inserted, changed, unchanged)
+
+    def _find_guids(self, cur, episodes):
+        """Get the ids of the rows with the GUIDs of the given episodes
+
+        Returns a dict that maps (channel_id, guid) to the episode id.
+        """
+        result = {}
+        guids = list(set(e.guid for e in episodes))
+        for offset in range(0, len(guids), self.MAX_SQL_VARIABLES):
+            chunk = guids[offset:offset+self.MAX_SQL_VARIABLES]
+            cur.execute('SELECT id, channel_id, guid FROM %s WHERE guid IN (%s)' % \
+                    (self.TABLE_EPISODES, ', '.join('?'*len(chunk))), chunk)
+            for id, channel_id, guid in cur.fetchall():
+                result[(channel_id, guid)] = id
+        return result
 
     def _save_object(self, o, table, schema):
         self.lock.acquire()
@@ -448,10 +1068,75 @@ class Database(object):
         assert episode.id is not None
 
         cur = self.cursor(lock=True)
-        cur.execute('UPDATE episodes SET state = ?, played = ?, length = ? WHERE id = ?', \
-                (episode.state, episode.is_played, episode.length, episode.id))
+        cur.execute('UPDATE episodes SET state = ?, played = ?, length = ?, tag_fingerprint = ?, digest = ? WHERE id = ?', \
+                (episode.state, episode.is_played, episode.length, episode.tag_fingerprint, episode.digest, episode.id))
         cur.close()
         self.lock.release()
+        self._invalidate_counts(episode.channel_id)
+
+    def get_downloaded_duplicates(self, episode_id, url, digest=None):
+        """Find other downloaded episodes with the same URL or digest
+
+        Returns a list of (foldername, filename, digest) tuples.
+        """
+        with self.read_cursor() as cur:
+            cur.execute('SELECT channels.foldername, episodes.filename, episodes.digest ' \
+                    'FROM episodes JOIN channels ON channels.id = episodes.channel_id ' \
+                    'WHERE episodes.state = ? AND episodes.id != ? AND ' \
+                    '(episodes.url = ? OR episodes.digest = ?)', \
+                    (gpodder.STATE_DOWNLOADED, episode_id, url, digest))
+            return [row for row in cur if row[0] and row[1]]
+
+    def save_tag_fingerprints(self, fingerprints):
+        """Store tag fingerprints given as (episode id, fingerprint) pairs"""
+        with self.transaction() as cur:
+            cur.executemany('UPDATE episodes SET tag_fingerprint = ? ' \
+                    'WHERE id = ?', [(fingerprint, id) \
+                    for id, fingerprint in fingerprints])
+
+    def journal_download(self, episode_id, status, offset, total_size):
+        """Record the state of an unfinished download in the journal"""
+        cur = self.cursor(lock=True)
+        cur.execute('INSERT OR REPLACE INTO downloads (episode_id, status, ' \
+                'offset, total_size, updated) VALUES (?, ?, ?, ?, ?)', \
+                (episode_id, status, offset, total_size, int(time.time())))
+        cur.close()
+        self.lock.release()
+
+    def remove_from_download_journal(self, episode_id):
+        cur = self.cursor(lock=True)
+        cur.execute('DELETE FROM downloads WHERE episode_id = ?', (episode_id,))
+        cur.close()
+        self.lock.release()
+
+    def load_download_journal(self, channel_mapping, statuses):
+        """Load the episodes of unfinished downloads from the journal
+
+        Returns a list of (episode, status, offset) tuples for all
+        journaled downloads with one of the given statuses, oldest
+        first. Episodes of podcasts that are not in "channel_mapping"
+        (and entries without episode) are skipped.
+        """
+        self.log('Loading the download journal')
+        sql = 'SELECT downloads.status AS journal_status, ' \
+                'downloads.offset AS journal_offset, episodes.* ' \
+                'FROM downloads JOIN episodes ON episodes.id = downloads.episode_id ' \
+                'WHERE downloads.status IN (%s) ORDER BY downloads.updated, ' \
+                'downloads.episode_id' % ', '.join('?'*len(statuses))
+
+        with self.read_cursor() as cur:
+            cur.execute(sql, tuple(statuses))
+            keys = [desc[0] for desc in cur.description]
+            rows = cur.fetchall()
+
+        result = []
+        for row in rows:
+            d = dict(zip(keys, row))
+            status, offset = d.pop('journal_status'), d.pop('journal_offset')
+            channel = channel_mapping.get(d['channel_id'])
+            if channel is not None:
+                result.append((channel.episode_factory(d), status, offset))
+        return result
 
     def update_episode_state(self, episode):
         assert episode.id is not None
@@ -460,6 +1145,7 @@ class Database(object):
         cur.execute('UPDATE episodes SET state = ?, played = ?, locked = ? WHERE id = ?', (episode.state, episode.is_played, episode.is_locked, episode.id))
         cur.close()
         self.lock.release()
+        self._invalidate_counts(episode.channel_id)
 
     def update_channel_lock(self, channel):
         assert channel.id is not None
@@ -475,18 +1161,15 @@ class Database(object):
         """
         Returns the first cell of a query result, useful for COUNT()s.
         """
-        cur = self.cursor(lock=True)
-
         self.log("__get__(): %s", sql)
 
-        if params is None:
-            cur.execute(sql)
-        else:
-            cur.execute(sql, params)
+        with self.read_cursor() as cur:
+            if params is None:
+                cur.execute(sql)
+            else:
+                cur.execute(sql, params)
 
-        row = cur.fetchone()
-        cur.close()
-        self.lock.release()
+            row = cur.fetchone()
 
         if row is None:
             return None
@@ -532,10 +1215,13 @@ class Database(object):
 
         cur.close()
         self.lock.release()
+        self._invalidate_counts(channel.id)
 
     def upgrade_table(self, table_name, fields, index_list):
         """
         Creates a table or adds fields to it.
+
+        Returns True if the table has been newly created.
         """
         cur = self.cursor(lock=True)
 
@@ -547,7 +1233,9 @@ class Database(object):
             columns = ', '.join(' '.join(f) for f in fields)
             sql = "CREATE TABLE %s (%s)" % (table_name, columns)
             cur.execute(sql)
+            created = True
         else:
+            created = False
             # Table info columns, as returned by SQLite
             ID, NAME, TYPE, NULL, DEFAULT = range(5)
             existing = set(column[NAME] for column in available)
@@ -558,18 +1246,13 @@ class Database(object):
                     cur.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table_name, field_name, field_type))
 
         for column, typ in index_list:
-            cur.execute('CREATE %s IF NOT EXISTS idx_%s ON %s (%s)' % (typ, column, table_name, column))
-
-        self.lock.release()
+            # Indexes over multiple columns are given as tuples
+            if isinstance(column, tuple):
+                name, column = '_'.join(column), ', '.join(column)
+            else:
+                name = column
+            cur.execute('CREATE %s IF NOT EXISTS idx_%s ON %s (%s)' % (typ, name, table_name, column))
 
-    def delete_episode_by_guid(self, guid, channel_id):
-        """
-        Deletes episodes that have a specific GUID for
-        a given channel. Used after feed updates for
-        episodes that have disappeared from the feed.
-        """
-        cur = self.cursor(lock=True)
-        cur.execute('DELETE FROM episodes WHERE channel_id = ? AND guid = ?', \
-                (channel_id, guid))
         self.lock.release()
+        return created
 
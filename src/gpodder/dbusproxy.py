@@ -28,6 +28,7 @@ import os
 
 from gpodder import model
 from gpodder import util
+from gpodder import download
 
 try:
     import dbus
@@ -66,9 +67,34 @@ class DBusPodcastsProxy(dbus.service.Object):
         self._on_check_for_updates = check_for_updates
         self._playback_episodes = playback_episodes
         self._download_episodes = download_episodes
+        self._download_progress = None
         dbus.service.Object.__init__(self, \
                 object_path=gpodder.dbus_podcasts_object_path, \
                 bus_name=bus_name)
+        download.progress_service.register('progress-changed', \
+                self._on_download_progress_changed)
+
+    def _summarize_download_progress(self, snapshot):
+        """Convert a DownloadProgressSnapshot into a D-Bus tuple"""
+        if snapshot.total_size > 0:
+            progress = snapshot.done_size/snapshot.total_size
+        else:
+            progress = 0.
+        if snapshot.eta is not None:
+            eta = snapshot.eta
+        else:
+            eta = -1.
+
+        return (snapshot.count(download.DownloadTask.DOWNLOADING), \
+                snapshot.count(download.DownloadTask.QUEUED), \
+                snapshot.count(download.DownloadTask.FAILED), \
+                float(snapshot.total_speed), float(progress), float(eta))
+
+    def _on_download_progress_changed(self, snapshot):
+        summary = self._summarize_download_progress(snapshot)
+        if summary != self._download_progress:
+            self._download_progress = summary
+            self.download_progress_changed(*summary)
 
     def _get_episode_refs(self, urls):
         """Get Episode instances associated with URLs"""
@@ -116,7 +142,7 @@ class DBusPodcastsProxy(dbus.service.Object):
 
             return (title, url, description, filename, file_type, is_new, is_downloaded, is_deleted)
 
-        return [episode_to_tuple(e) for e in podcast.get_all_episodes()]
+        return [episode_to_tuple(e) for e in podcast.get_episode_records(lazy=False)]
 
     @dbus.service.method(dbus_interface=gpodder.dbus_podcasts, in_signature='as', out_signature='(bs)')
     def play_or_download_episode(self, urls):
@@ -136,6 +162,22 @@ class DBusPodcastsProxy(dbus.service.Object):
 
         return (1, 'Success')
 
+    @dbus.service.method(dbus_interface=gpodder.dbus_podcasts, in_signature='', out_signature='(iiiddd)')
+    def get_download_progress(self):
+        """Get (downloading, queued, failed, speed, progress, eta)
+
+        The speed is in bytes per second, the progress between 0 and 1
+        and the estimated time left in seconds (-1 if it is unknown).
+        """
+        snapshot = download.progress_service.get_snapshot()
+        return self._summarize_download_progress(snapshot)
+
+    @dbus.service.signal(dbus_interface=gpodder.dbus_podcasts, signature='iiiddd')
+    def download_progress_changed(self, downloading, queued, failed, \
+            speed, progress, eta):
+        """Emitted when the download progress changes (see above)"""
+        pass
+
     @dbus.service.method(dbus_interface=gpodder.dbus_podcasts, in_signature='', out_signature='')
     def check_for_updates(self):
         """Check for new episodes or offer subscriptions"""
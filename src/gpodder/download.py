@@ -30,16 +30,23 @@ from __future__ import with_statement
 from gpodder.liblogger import log
 from gpodder import util
 from gpodder import youtube
+from gpodder import httppool
+from gpodder import services
+from gpodder import tagger
+from gpodder import playlist
 import gpodder
 
 import threading
+import Queue
 import urllib
 import urlparse
 import shutil
 import os.path
 import os
 import time
-import collections
+import heapq
+import hashlib
+import itertools
 
 import mimetypes
 import email
@@ -49,6 +56,40 @@ from xml.sax import saxutils
 
 _ = gpodder.gettext
 
+def update_digest(digest, filename, size=None):
+    """Feed the content of a file into a hashlib object
+
+    If "size" is given, only the first "size" bytes are used.
+    """
+    fp = open(filename, 'rb')
+    while size is None or size > 0:
+        block = fp.read(min(size or 1024*1024, 1024*1024))
+        if not block:
+            break
+        digest.update(block)
+        if size is not None:
+            size -= len(block)
+    fp.close()
+
+def replace_with_link(source, target):
+    """Replace the file "target" by a hard link to "source"
+
+    Returns False (leaving "target" untouched) if hard links
+    are not supported for these files.
+    """
+    if not hasattr(os, 'link'):
+        return False
+
+    try:
+        os.link(source, target+'.link')
+        os.rename(target+'.link', target)
+    except OSError, e:
+        log('Cannot link %s to %s: %s', target, source, e)
+        util.delete_file(target+'.link')
+        return False
+
+    return True
+
 def get_header_param(headers, param, header_name):
     """Extract a HTTP header parameter from a dict
 
@@ -108,7 +149,8 @@ class ContentRange(object):
     Represents the Content-Range header
 
     This header is ``start-stop/length``, where stop and length can be
-    ``*`` (represented as None in the attributes).
+    ``*`` (represented as None in the attributes). The "stop" attribute
+    is exclusive (like in slices), the value in the header is inclusive.
     """
 
     def __init__(self, start, stop, length):
@@ -128,7 +170,7 @@ class ContentRange(object):
         if self.stop is None:
             stop = '*'
         else:
-            stop = self.stop + 1
+            stop = self.stop - 1
         if self.length is None:
             length = '*'
         else:
@@ -179,7 +221,224 @@ class ContentRange(object):
         if end is None:
             return cls(start, None, length)
         else:
-            return cls(start, end-1, length)
+            return cls(start, end+1, length)
+
+
+class TokenBucket(object):
+    """Allow a data rate (bytes per second) with bursts of one second
+
+    >>> bucket = TokenBucket(100.)
+    >>> bucket.tokens, bucket.updated = -150., 0.
+    >>> bucket.wait_time()
+    1.5
+    >>> bucket.refill(1.)
+    >>> bucket.tokens, bucket.wait_time()
+    (-50.0, 0.5)
+    >>> bucket.refill(10.)
+    >>> bucket.tokens, bucket.wait_time()
+    (100.0, 0.0)
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.time()
+
+    def refill(self, now):
+        self.tokens = min(self.rate, self.tokens + (now-self.updated)*self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """Seconds until the bucket is no longer in debt"""
+        if self.tokens >= 0:
+            return 0.
+        return -self.tokens/self.rate
+
+
+class BandwidthLimiter(object):
+    """Speed limit shared by all downloads using the same Config
+
+    The global limit ("limit_rate" and "limit_rate_value", possibly
+    replaced by a "limit_rate_schedule" entry) and the per-host limits
+    ("limit_rate_hosts") are token buckets shared by all downloads.
+    Changes of these settings apply to running downloads, too.
+
+    Use BandwidthLimiter.for_config(config) to get the limiter.
+
+    >>> from minimock import mock, Mock, restore
+    >>> clock = [1000.]
+    >>> def sleep(seconds):
+    ...     print 'sleep %.2f' % seconds
+    ...     clock[0] += seconds
+    >>> localtime = [time.struct_time((2010, 1, 1, 1, 30, 0, 4, 1, 0))]
+    >>> mock('time.time', returns_func=lambda: clock[0], tracker=None)
+    >>> mock('time.sleep', returns_func=sleep, tracker=None)
+    >>> mock('time.localtime', returns_func=lambda: localtime[0], tracker=None)
+    >>> config = Mock('config', tracker=None)
+    >>> config.limit_rate, config.limit_rate_value = True, 100.
+    >>> config.limit_rate_hosts = 'example.com=50 invalid'
+    >>> config.limit_rate_schedule = '01:00-02:00=10 22:00-06:00=20'
+    >>> limiter = BandwidthLimiter(config)
+
+    The first matching entry of the schedule replaces the global limit:
+
+    >>> limiter.get_global_rate()
+    10240.0
+    >>> localtime[0] = time.struct_time((2010, 1, 1, 23, 0, 0, 4, 1, 0))
+    >>> limiter.get_global_rate()
+    20480.0
+    >>> localtime[0] = time.struct_time((2010, 1, 1, 12, 0, 0, 4, 1, 0))
+    >>> limiter.get_global_rate()
+    102400.0
+
+    Downloads wait while one of the buckets (global or per host,
+    including subdomains) is in debt:
+
+    >>> limiter.throttle('www.example.com', 102400)
+    >>> limiter.throttle('www.example.com', 1000)
+    sleep 0.50
+    sleep 0.50
+    >>> limiter.throttle('example.org', 1000)
+    >>> config.limit_rate_hosts = ''
+    >>> limiter.apply_settings()
+    >>> config.limit_rate = False
+    >>> limiter.throttle('www.example.com', 10**9)
+    >>> restore()
+    """
+    # Maximum time to sleep before re-checking the settings
+    MAX_SLEEP = .5
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def for_config(cls, config):
+        with cls._instances_lock:
+            if id(config) not in cls._instances:
+                cls._instances[id(config)] = cls(config)
+            return cls._instances[id(config)]
+
+    def __init__(self, config):
+        self._config = config
+        self._lock = threading.Lock()
+        self._global_bucket = None
+        self._host_buckets = {}
+        self._schedule = []
+
+        self.apply_settings()
+        self._config.add_observer(self._on_config_changed)
+
+    def _on_config_changed(self, name, old_value, new_value):
+        if name.startswith('limit_rate'):
+            self.apply_settings()
+
+    def _parse_rates(self, value):
+        """Parse 'key=rate key=rate' into a list of (key, bytes per second)"""
+        result = []
+        for item in value.split():
+            try:
+                key, rate = item.rsplit('=', 1)
+                result.append((key.lower(), float(rate)*1024))
+            except ValueError:
+                log('Invalid speed limit: %s', item, sender=self)
+        return result
+
+    def _parse_schedule(self, value):
+        schedule = []
+        for period, rate in self._parse_rates(value):
+            try:
+                start, end = [time.strptime(t, '%H:%M') for t in period.split('-')]
+                schedule.append(((start.tm_hour*60+start.tm_min), \
+                        (end.tm_hour*60+end.tm_min), rate))
+            except ValueError:
+                log('Invalid time range: %s', period, sender=self)
+        return schedule
+
+    def apply_settings(self):
+        with self._lock:
+            host_rates = dict(self._parse_rates(self._config.limit_rate_hosts))
+            for host in self._host_buckets.keys():
+                if host not in host_rates:
+                    del self._host_buckets[host]
+            for host, rate in host_rates.items():
+                if host in self._host_buckets:
+                    self._host_buckets[host].rate = rate
+                else:
+                    self._host_buckets[host] = TokenBucket(rate)
+
+            self._schedule = self._parse_schedule(self._config.limit_rate_schedule)
+
+    def get_global_rate(self):
+        """The current global limit in bytes per second (0 = none)"""
+        if not self._config.limit_rate:
+            return 0.
+
+        now = time.localtime()
+        minute = now.tm_hour*60 + now.tm_min
+        for start, end, rate in self._schedule:
+            if start <= minute < end or \
+                    (end < start and (minute >= start or minute < end)):
+                return rate
+
+        return self._config.limit_rate_value*1024
+
+    def _get_buckets(self, host):
+        rate = self.get_global_rate()
+        if rate > 0:
+            if self._global_bucket is None:
+                self._global_bucket = TokenBucket(rate)
+            self._global_bucket.rate = rate
+            buckets = [self._global_bucket]
+        else:
+            self._global_bucket = None
+            buckets = []
+
+        host = host.lower()
+        for pattern, bucket in self._host_buckets.iteritems():
+            if bucket.rate > 0 and \
+                    (host == pattern or host.endswith('.'+pattern)):
+                buckets.append(bucket)
+
+        return buckets
+
+    def throttle(self, host, amount):
+        """Account for "amount" bytes received from "host"
+
+        Blocks as long as the data rate is above one of the limits.
+        """
+        while True:
+            with self._lock:
+                buckets = self._get_buckets(host)
+                now = time.time()
+                for bucket in buckets:
+                    bucket.refill(now)
+                wait = max([bucket.wait_time() for bucket in buckets] + [0.])
+                if wait == 0:
+                    for bucket in buckets:
+                        bucket.tokens -= amount
+                    return
+
+            time.sleep(min(wait, self.MAX_SLEEP))
+
+
+class AdaptiveBlockSize(object):
+    """Size of reads that adapts to the download speed
+
+    The size is doubled while a read (including the time spent in the
+    speed limiter) takes less than half of "target_time", and halved
+    when it takes more than twice as long, so fast connections need
+    fewer (Python-level) iterations and slow ones still react quickly.
+    """
+    def __init__(self, minimum=8*1024, maximum=4*1024*1024, target_time=.1):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_time = target_time
+        self.size = minimum
+
+    def update(self, amount, duration):
+        if amount >= self.size and duration < self.target_time/2:
+            self.size = min(self.size*2, self.maximum)
+        elif duration > self.target_time*2:
+            self.size = max(self.size/2, self.minimum)
 
 
 class DownloadCancelledException(Exception): pass
@@ -199,11 +458,67 @@ class DownloadURLOpener(urllib.FancyURLopener):
     # FYI: The omission of "%" in the list is to avoid double escaping!
     ESCAPE_CHARS = dict((ord(c), u'%%%x'%ord(c)) for c in u' <>#"{}|\\^[]`')
 
-    def __init__( self, channel):
+    # Limits for the size of single reads (see AdaptiveBlockSize)
+    MIN_BLOCK_SIZE = 8*1024
+    MAX_BLOCK_SIZE = 4*1024*1024
+
+    # Minimum time (in seconds) between two calls of the report hook
+    REPORT_INTERVAL = .2
+
+    def __init__( self, channel, limiter=None):
         self.channel = channel
+        self.limiter = limiter
         self._auth_retry_counter = 0
         urllib.FancyURLopener.__init__(self, None)
 
+    def throttle(self, url, amount):
+        if self.limiter is not None:
+            self.limiter.throttle(urlparse.urlparse(url).hostname or '', amount)
+
+    def open_http(self, url, data=None):
+        return self._open_pooled('http', url, data)
+
+    def open_https(self, url, data=None):
+        return self._open_pooled('https', url, data)
+
+    def _open_pooled(self, scheme, url, data):
+        """Open a HTTP(S) URL using a connection from the pool
+
+        Requests through a proxy (where "url" is a tuple) and URLs
+        with username and password are handled by FancyURLopener.
+        """
+        fallback = getattr(urllib.FancyURLopener, 'open_'+scheme)
+        if not isinstance(url, str):
+            return fallback(self, url, data)
+
+        host, selector = urllib.splithost(url)
+        if not host:
+            raise IOError, ('http error', 'no host given')
+
+        user_passwd, host = urllib.splituser(host)
+        if user_passwd:
+            return fallback(self, url, data)
+
+        headers = dict(self.addheaders)
+        if data is None:
+            method = 'GET'
+        else:
+            method = 'POST'
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        response = httppool.connection_pool.request(scheme, \
+                urllib.unquote(host), method, selector, headers, data)
+
+        if 200 <= response.status < 300:
+            return urllib.addinfourl(response, response.msg, \
+                    scheme + ':' + url, response.status)
+        elif data is None:
+            return self.http_error(url, response, response.status, \
+                    response.reason, response.msg)
+        else:
+            return self.http_error(url, response, response.status, \
+                    response.reason, response.msg, data)
+
     def http_error_default(self, url, fp, errcode, errmsg, headers):
         """
         FancyURLopener by default does not raise an exception when
@@ -244,11 +559,22 @@ class DownloadURLOpener(urllib.FancyURLopener):
         # method, at the end after the line "if errcode == 200:"
         return urllib.addinfourl(fp, headers, 'http:' + url)
 
-    def retrieve_resume(self, url, filename, reporthook=None, data=None):
+    def fix_url(self, url):
+        # Fix a problem with bad URLs that are not encoded correctly (bug 549)
+        url = url.decode('ascii', 'ignore')
+        url = url.translate(self.ESCAPE_CHARS)
+        url = url.encode('ascii')
+
+        return urllib.unwrap(urllib.toBytes(url))
+
+    def retrieve_resume(self, url, filename, reporthook=None, data=None, \
+            digest=None):
         """Download files from an URL; return (headers, real_url)
 
         Resumes a download if the local filename exists and
-        the server supports download resuming.
+        the server supports download resuming. If "digest" is
+        given (a hashlib object), it is updated with the content
+        of the file while it is being downloaded.
         """
 
         current_size = 0
@@ -268,12 +594,7 @@ class DownloadURLOpener(urllib.FancyURLopener):
         if tfp is None:
             tfp = open(filename, 'wb')
 
-        # Fix a problem with bad URLs that are not encoded correctly (bug 549)
-        url = url.decode('ascii', 'ignore')
-        url = url.translate(self.ESCAPE_CHARS)
-        url = url.encode('ascii')
-
-        url = urllib.unwrap(urllib.toBytes(url))
+        url = self.fix_url(url)
         fp = self.open(url, data)
         headers = fp.info()
 
@@ -290,27 +611,41 @@ class DownloadURLOpener(urllib.FancyURLopener):
                 current_size = 0
                 log('Cannot resume. Missing or wrong Content-Range header (RFC2616)', sender=self)
 
+        if digest is not None and current_size > 0:
+            # Start with the data that has been downloaded before
+            update_digest(digest, filename, current_size)
+
         result = headers, fp.geturl()
-        bs = 1024*8
+        bs = AdaptiveBlockSize(self.MIN_BLOCK_SIZE, self.MAX_BLOCK_SIZE)
         size = -1
         read = current_size
-        blocknum = int(current_size/bs)
+        # The report hook gets the number of bytes as block count
         if reporthook:
             if "content-length" in headers:
                 size = int(headers["Content-Length"]) + current_size
-            reporthook(blocknum, bs, size)
+            reporthook(read, 1, size)
+        last_report = time.time()
         while read < size or size == -1:
+            started = time.time()
             if size == -1:
-                block = fp.read(bs)
+                block = fp.read(bs.size)
             else:
-                block = fp.read(min(size-read, bs))
+                block = fp.read(min(size-read, bs.size))
             if block == "":
                 break
             read += len(block)
             tfp.write(block)
-            blocknum += 1
-            if reporthook:
-                reporthook(blocknum, bs, size)
+            if digest is not None:
+                digest.update(block)
+            self.throttle(result[1], len(block))
+            now = time.time()
+            bs.update(len(block), now-started)
+            if reporthook and (now-last_report >= self.REPORT_INTERVAL \
+                    or read == size):
+                reporthook(read, 1, size)
+                last_report = now
+        if reporthook and read != size:
+            reporthook(read, 1, size)
         fp.close()
         tfp.close()
         del fp
@@ -325,6 +660,167 @@ class DownloadURLOpener(urllib.FancyURLopener):
 
 # end code based on urllib.py
 
+    # Files smaller than this are not split into segments
+    MIN_SEGMENT_SIZE = 1024*1024
+
+    # Suffix of the file that keeps track of downloaded segments
+    SEGMENTS_SUFFIX = '.segments'
+
+    def retrieve_segmented(self, url, filename, segments, reporthook=None):
+        """Download a file over multiple connections; return (headers, real_url)
+
+        The file is split into "segments" byte ranges which are fetched
+        in parallel into the (preallocated) file "filename". The progress
+        of each segment is stored in filename+SEGMENTS_SUFFIX, so that an
+        interrupted download can be resumed without losing completed parts.
+
+        Falls back to retrieve_resume() if the server does not support
+        byte ranges or the file is too small to be split.
+        """
+        state_filename = filename + self.SEGMENTS_SUFFIX
+        url = self.fix_url(url)
+
+        # Ask for the first byte to see if the server supports ranges
+        self.addheader('Range', 'bytes=0-0')
+        try:
+            fp = self.open(url)
+            headers, real_url = fp.info(), fp.geturl()
+            fp.close()
+            content_range = ContentRange.parse(headers.get('content-range', None))
+        except gPodderDownloadHTTPError, gdhe:
+            # "416 Requested Range Not Satisfiable" (e.g. empty files)
+            if gdhe.error_code != 416:
+                raise
+            content_range = None
+        self.addheaders = [h for h in self.addheaders if h[0] != 'Range']
+
+        if content_range is None or content_range.start != 0 or \
+                content_range.length is None or \
+                content_range.length < self.MIN_SEGMENT_SIZE*2:
+            log('Not using segmented download for %s', url, sender=self)
+            util.delete_file(state_filename)
+            return self.retrieve_resume(url, filename, reporthook)
+
+        size = content_range.length
+        ranges = self._load_segments(state_filename, size)
+        if ranges is None:
+            # Data from an earlier single-stream download can be kept
+            done = 0
+            if os.path.exists(filename) and not os.path.exists(state_filename):
+                done = min(os.path.getsize(filename), size)
+            segments = max(1, min(segments, (size-done)/self.MIN_SEGMENT_SIZE))
+            ranges = []
+            for index in range(segments):
+                start = done + (size-done)*index/segments
+                stop = done + (size-done)*(index+1)/segments
+                ranges.append([start, stop, start])
+
+        # Preallocate the file, keeping what has been downloaded already
+        if os.path.exists(filename):
+            tfp = open(filename, 'r+b')
+        else:
+            tfp = open(filename, 'wb')
+        tfp.truncate(size)
+        tfp.close()
+        self._save_segments(state_filename, size, ranges)
+
+        condition = threading.Condition()
+        errors = []
+        cancelled = []
+
+        def fetch_segment(segment):
+            start, stop, position = segment
+            if position >= stop:
+                return
+
+            try:
+                opener = DownloadURLOpener(self.channel, self.limiter)
+                opener.addheader('Range', 'bytes=%d-%d' % (position, stop-1))
+                fp = opener.open(real_url)
+                content_range = ContentRange.parse(fp.info().get('content-range', None))
+                if content_range is None or content_range.start != position:
+                    raise gPodderDownloadHTTPError(real_url, 206, \
+                            'Missing or wrong Content-Range header (RFC2616)')
+
+                tfp = open(filename, 'r+b')
+                tfp.seek(position)
+                bs = AdaptiveBlockSize(self.MIN_BLOCK_SIZE, self.MAX_BLOCK_SIZE)
+                while position < stop and not cancelled:
+                    started = time.time()
+                    block = fp.read(min(stop-position, bs.size))
+                    if block == '':
+                        break
+                    tfp.write(block)
+                    position += len(block)
+                    self.throttle(real_url, len(block))
+                    bs.update(len(block), time.time()-started)
+                    with condition:
+                        segment[2] = position
+                        condition.notify()
+                tfp.close()
+                fp.close()
+
+                if position < stop and not cancelled:
+                    raise urllib.ContentTooShortError('retrieval incomplete: ' \
+                            'got only %i out of %i bytes' % (position-start, \
+                            stop-start), (headers, real_url))
+            except Exception, e:
+                log('Error in segment %d-%d: %s', start, stop, e, sender=self)
+                with condition:
+                    errors.append(e)
+                    condition.notify()
+
+        threads = [threading.Thread(target=fetch_segment, args=(segment,)) \
+                for segment in ranges]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+
+        try:
+            while True:
+                with condition:
+                    condition.wait(self.REPORT_INTERVAL)
+                    read = ranges[0][0] + sum(position-start \
+                            for start, stop, position in ranges)
+                    finished = not [t for t in threads if t.isAlive()]
+                    if errors:
+                        raise errors[0]
+                self._save_segments(state_filename, size, ranges)
+                if reporthook:
+                    reporthook(read, 1, size)
+                if finished:
+                    break
+        finally:
+            cancelled.append(True)
+            for thread in threads:
+                thread.join()
+            self._save_segments(state_filename, size, ranges)
+
+        util.delete_file(state_filename)
+        return headers, real_url
+
+    def _load_segments(self, state_filename, size):
+        """Read the segment list; returns None if it cannot be used"""
+        if not os.path.exists(state_filename):
+            return None
+
+        try:
+            lines = open(state_filename).read().splitlines()
+            if int(lines[0]) != size:
+                log('File size has changed, restarting segments', sender=self)
+                return None
+            return [map(int, line.split()) for line in lines[1:]]
+        except Exception, e:
+            log('Cannot read segments from %s: %s', state_filename, e, sender=self)
+            return None
+
+    def _save_segments(self, state_filename, size, ranges):
+        lines = [str(size)] + ['%d %d %d' % tuple(r) for r in ranges]
+        fp = open(state_filename+'.tmp', 'w')
+        fp.write('\n'.join(lines)+'\n')
+        fp.close()
+        os.rename(state_filename+'.tmp', state_filename)
+
     def prompt_user_passwd( self, host, realm):
         # Keep track of authentication attempts, fail after the third one
         self._auth_retry_counter += 1
@@ -338,13 +834,225 @@ class DownloadURLOpener(urllib.FancyURLopener):
         return (None, None)
 
 
+class QueuePolicy(object):
+    """Order of the tasks in a DownloadQueue
+
+    Tasks with a smaller key (see get_key) are started first; tasks
+    with the same key are started in the order they were added. This
+    base class keeps that order (first in, first out).
+    """
+    def get_key(self, task):
+        return 0
+
+    def task_popped(self, task, key):
+        """Called when a task is taken from the queue"""
+        pass
+
+
+class SmallestFirstPolicy(QueuePolicy):
+    def get_key(self, task):
+        # Tasks with unknown size come last
+        return task.total_size or float('inf')
+
+
+class NewestFirstPolicy(QueuePolicy):
+    def get_key(self, task):
+        return -(task.episode.pubDate or 0)
+
+
+class RoundRobinPolicy(QueuePolicy):
+    """Take one task of each podcast in turn"""
+    def __init__(self):
+        self._next_round = {}
+        self._current_round = 0
+
+    def get_key(self, task):
+        podcast_url = task.podcast_url
+        key = max(self._next_round.get(podcast_url, 0), self._current_round)
+        self._next_round[podcast_url] = key + 1
+        return key
+
+    def task_popped(self, task, key):
+        self._current_round = key
+
+
+QUEUE_POLICIES = {
+    'fifo': QueuePolicy,
+    'smallest': SmallestFirstPolicy,
+    'newest': NewestFirstPolicy,
+    'roundrobin': RoundRobinPolicy,
+}
+
+
+class DownloadQueue(object):
+    """Priority queue of download tasks
+
+    The order is determined by the QueuePolicy. Tasks that are added
+    with force=True are started before all others. If max_per_host is
+    set, tasks are skipped while that many downloads from the same host
+    are running; call task_done(task) for each task returned by pop().
+
+    Adding, removing and re-prioritizing a task is O(log n).
+
+    >>> class Task(object):
+    ...     def __init__(self, name, podcast, size=0, pubDate=0):
+    ...         self.name, self.podcast_url = name, podcast
+    ...         self.url = 'http://%s.example.com/%s.mp3' % (podcast, name)
+    ...         self.total_size = size
+    ...         self.episode = Task
+    ...         self.episode.pubDate = pubDate
+    ...     def __repr__(self):
+    ...         return self.name
+    >>> def pop_all(queue):
+    ...     tasks = []
+    ...     while len(queue):
+    ...         tasks.append(queue.pop())
+    ...         queue.task_done(tasks[-1])
+    ...     return tasks
+    >>> a1, a2, a3 = Task('a1', 'a', 30), Task('a2', 'a', 10), Task('a3', 'a')
+    >>> b1, b2 = Task('b1', 'b', 20), Task('b2', 'b', 5)
+
+    >>> queue = DownloadQueue()
+    >>> for task in (a1, a2, a3, b1, b2):
+    ...     queue.push(task)
+    >>> queue.push(b1, force=True)
+    >>> queue.remove(a2)
+    >>> pop_all(queue)
+    [b1, a1, a3, b2]
+    >>> queue.pop()
+    Traceback (most recent call last):
+      ...
+    IndexError: No task that can be started
+
+    >>> queue = DownloadQueue(SmallestFirstPolicy())
+    >>> for task in (a1, a2, a3, b1, b2):
+    ...     queue.push(task)
+    >>> pop_all(queue)
+    [b2, a2, b1, a1, a3]
+    >>> queue = DownloadQueue(RoundRobinPolicy())
+    >>> for task in (a1, a2, a3, b1, b2):
+    ...     queue.push(task)
+    >>> pop_all(queue)
+    [a1, b1, a2, b2, a3]
+
+    With max_per_host, tasks of busy hosts are skipped:
+
+    >>> queue = DownloadQueue(max_per_host=1)
+    >>> for task in (a1, a2, b1, b2):
+    ...     queue.push(task)
+    >>> queue.pop(), queue.pop()
+    (a1, b1)
+    >>> queue.pop()
+    Traceback (most recent call last):
+      ...
+    IndexError: No task that can be started
+    >>> queue.task_done(b1)
+    >>> queue.pop()
+    b2
+    """
+    def __init__(self, policy=None, max_per_host=0):
+        self.policy = policy or QueuePolicy()
+        self.max_per_host = max_per_host
+
+        self._lock = threading.RLock()
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._active_hosts = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, task):
+        return task in self._entries
+
+    def _get_host(self, task):
+        return urlparse.urlparse(task.url).hostname
+
+    def push(self, task, force=False):
+        """Add a task, or move it to its new position if queued"""
+        with self._lock:
+            if task in self._entries:
+                self.remove(task)
+
+            # Forced tasks sort first; the counter keeps insertion order
+            entry = [not force, self.policy.get_key(task), \
+                    self._counter.next(), task]
+            self._entries[task] = entry
+            heapq.heappush(self._heap, entry)
+
+    reprioritize = push
+
+    def remove(self, task):
+        """Remove a task from the queue (ValueError if not queued)"""
+        with self._lock:
+            entry = self._entries.pop(task, None)
+            if entry is None:
+                raise ValueError('Task not in download queue')
+
+            # The entry is skipped when it comes up in pop()
+            entry[-1] = None
+
+    def pop(self):
+        """Take the next task (IndexError if there is none)"""
+        with self._lock:
+            skipped = []
+            try:
+                while self._heap:
+                    entry = heapq.heappop(self._heap)
+                    not_forced, key, count, task = entry
+                    if task is None:
+                        continue
+
+                    host = self._get_host(task)
+                    if not_forced and self.max_per_host > 0 and \
+                            self._active_hosts.get(host, 0) >= self.max_per_host:
+                        skipped.append(entry)
+                        continue
+
+                    del self._entries[task]
+                    self._active_hosts[host] = self._active_hosts.get(host, 0) + 1
+                    self.policy.task_popped(task, key)
+                    return task
+            finally:
+                for entry in skipped:
+                    heapq.heappush(self._heap, entry)
+
+            raise IndexError('No task that can be started')
+
+    def task_done(self, task):
+        """Mark a task returned by pop() as finished"""
+        with self._lock:
+            host = self._get_host(task)
+            self._active_hosts[host] -= 1
+            if not self._active_hosts[host]:
+                del self._active_hosts[host]
+
+    def set_policy(self, policy):
+        """Use a new policy and re-order all queued tasks"""
+        with self._lock:
+            self.policy = policy
+            entries = sorted(self._entries.values(), key=lambda e: e[2])
+            self._heap = []
+            for not_forced, key, count, task in entries:
+                entry = [not_forced, policy.get_key(task), count, task]
+                self._entries[task] = entry
+                self._heap.append(entry)
+            heapq.heapify(self._heap)
+
+
 class DownloadQueueWorker(threading.Thread):
-    def __init__(self, queue, exit_callback, continue_check_callback, minimum_tasks):
+    def __init__(self, queue, exit_callback, continue_check_callback, \
+            minimum_tasks, task_done_callback=None):
         threading.Thread.__init__(self)
         self.queue = queue
         self.exit_callback = exit_callback
         self.continue_check_callback = continue_check_callback
 
+        # Called after each task, because workers that found only tasks
+        # of busy hosts (see DownloadQueue) have quit in the meantime
+        self.task_done_callback = task_done_callback
+
         # The minimum amount of tasks that should be downloaded by this worker
         # before using the continue_check_callback to determine if it might
         # continue accepting tasks. This can be used to forcefully start a
@@ -364,25 +1072,59 @@ class DownloadQueueWorker(threading.Thread):
 
             try:
                 task = self.queue.pop()
-                log('%s is processing: %s', self.getName(), task, sender=self)
-                task.run()
             except IndexError, e:
                 log('No more tasks for %s to carry out.', self.getName(), sender=self)
                 break
+
+            log('%s is processing: %s', self.getName(), task, sender=self)
+            try:
+                task.run()
+            finally:
+                self.queue.task_done(task)
+                if self.task_done_callback is not None:
+                    self.task_done_callback()
         self.exit_callback(self)
 
 
 class DownloadQueueManager(object):
     def __init__(self, config):
         self._config = config
-        self.tasks = collections.deque()
+        self.tasks = DownloadQueue(self._get_policy(), \
+                self._config.max_downloads_per_host)
+        self._config.add_observer(self.__on_config_changed)
 
         self.worker_threads_access = threading.RLock()
         self.worker_threads = []
 
+        post_download_pipeline.add_idle_callback(self.__on_pipeline_idle)
+
+    def _get_policy(self):
+        name = self._config.download_queue_policy
+        if name not in QUEUE_POLICIES:
+            log('Unknown download queue policy: %s', name, sender=self)
+            name = 'fifo'
+        return QUEUE_POLICIES[name]()
+
+    def __on_config_changed(self, name, old_value, new_value):
+        if name == 'download_queue_policy':
+            self.tasks.set_policy(self._get_policy())
+        elif name == 'max_downloads_per_host':
+            self.tasks.max_per_host = new_value
+            self.spawn_threads()
+
     def __exit_callback(self, worker_thread):
         with self.worker_threads_access:
             self.worker_threads.remove(worker_thread)
+            session_finished = not self.worker_threads
+
+        if session_finished and post_download_pipeline.is_idle():
+            # All downloads are done - write the changed playlists at once
+            playlist.playlist_manager.flush()
+
+    def __on_pipeline_idle(self):
+        # The last downloads have been finished after the workers exited
+        if not self.are_queued_or_active_tasks():
+            playlist.playlist_manager.flush()
 
     def __continue_check_callback(self, worker_thread):
         with self.worker_threads_access:
@@ -418,7 +1160,8 @@ class DownloadQueueManager(object):
                     minimum_tasks = 0
 
                 worker = DownloadQueueWorker(self.tasks, self.__exit_callback, \
-                        self.__continue_check_callback, minimum_tasks)
+                        self.__continue_check_callback, minimum_tasks, \
+                        self.spawn_threads)
                 self.worker_threads.append(worker)
                 worker.start()
 
@@ -444,15 +1187,205 @@ class DownloadQueueManager(object):
             except ValueError, e:
                 pass
         task.status = DownloadTask.QUEUED
-        if force_start:
-            # Add the task to be taken on next pop
-            self.tasks.append(task)
-        else:
-            # Add the task to the end of the queue
-            self.tasks.appendleft(task)
+        # Forced tasks are taken on next pop, others as the policy decides
+        self.tasks.push(task, force_start)
         self.spawn_threads(force_start)
 
 
+class DownloadProgressSnapshot(object):
+    """The state of all download tasks at one point in time
+
+    "tasks" maps each task to a (status, progress, speed, total_size)
+    tuple. "changed" is the set of tasks that have been updated since
+    the previous snapshot, or None if all tasks should be considered
+    changed. "eta" is the estimated number of seconds until all queued
+    and active downloads have finished (None if unknown).
+    """
+    def __init__(self, tasks, changed=None):
+        self.tasks = tasks
+        self.changed = changed
+
+        self.total_speed = 0.
+        self.total_size = 0.
+        self.done_size = 0.
+        remaining = 0.
+        for status, progress, speed, size in tasks.itervalues():
+            self.total_size += size
+            self.done_size += size*progress
+            if status == DownloadTask.DOWNLOADING:
+                self.total_speed += speed
+            if status in (DownloadTask.DOWNLOADING, DownloadTask.QUEUED):
+                remaining += size*(1.-progress)
+
+        if self.total_speed > 0:
+            self.eta = remaining/self.total_speed
+        else:
+            self.eta = None
+
+    def count(self, status):
+        """Get the number of tasks with the given status"""
+        return len([t for t in self.tasks.itervalues() if t[0] == status])
+
+    def get_tasks(self, status):
+        """Get all tasks with the given status"""
+        return [task for task, t in self.tasks.iteritems() if t[0] == status]
+
+
+class DownloadProgressService(services.ObservableService):
+    """Coalesces progress updates of all download tasks
+
+    Tasks publish every change of their state here (from any thread).
+    Observers of the "progress-changed" signal receive a
+    DownloadProgressSnapshot at most "max_rate" times per second;
+    updates that arrive in between are merged into the next one.
+
+    The snapshots are sent from a single thread that is started with
+    the first update; call stop() to end it.
+    """
+    def __init__(self, max_rate=4):
+        services.ObservableService.__init__(self, ['progress-changed'])
+        self.interval = 1./max_rate
+        self._lock = threading.Condition()
+        self._tasks = {}
+        self._changed = set()
+        self._last_notify = 0
+        self._dirty = False
+        self._thread = None
+        self._stopped = False
+
+    def publish(self, task):
+        """Record the current state of a task"""
+        with self._lock:
+            self._tasks[task] = (task.status, task.progress, task.speed, \
+                    task.total_size)
+            self._changed.add(task)
+            self._schedule()
+
+    def remove(self, task):
+        """Forget about a task that is no longer shown"""
+        with self._lock:
+            if task in self._tasks:
+                del self._tasks[task]
+                self._changed.discard(task)
+                self._schedule()
+
+    def get_snapshot(self):
+        """Get a snapshot of all tasks (with all tasks marked changed)"""
+        with self._lock:
+            return DownloadProgressSnapshot(dict(self._tasks))
+
+    def stop(self):
+        """End the notification thread (pending updates are dropped)"""
+        with self._lock:
+            self._stopped = True
+            self._lock.notify()
+
+    def _schedule(self):
+        # Called with the lock held
+        if self._dirty or self._stopped:
+            return
+
+        self._dirty = True
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.setDaemon(True)
+            self._thread.start()
+        else:
+            self._lock.notify()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._dirty and not self._stopped:
+                    self._lock.wait()
+
+                # Merge the updates until the interval has passed
+                delay = self._last_notify + self.interval - time.time()
+                while delay > 0 and not self._stopped:
+                    self._lock.wait(delay)
+                    delay = self._last_notify + self.interval - time.time()
+
+                if self._stopped:
+                    return
+
+                self._dirty = False
+                self._last_notify = time.time()
+                snapshot = DownloadProgressSnapshot(dict(self._tasks), \
+                        self._changed)
+                self._changed = set()
+            self.notify('progress-changed', snapshot)
+
+
+# The progress service that all download tasks publish to
+progress_service = DownloadProgressService()
+
+
+class PostDownloadPipeline(object):
+    """Finishes downloaded tasks in a small pool of worker threads
+
+    As soon as the data of a task is on disk, the download worker
+    submits the task here and continues with the next download. Up to
+    "max_workers" threads then carry out DownloadTask.post_process().
+    The idle callbacks are called (from the pipeline thread) whenever
+    the last submitted task has been processed.
+    """
+    def __init__(self, max_workers=2):
+        self.max_workers = max_workers
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = 0
+        self._pending = 0
+        self._idle_callbacks = []
+
+    def add_idle_callback(self, callback):
+        self._idle_callbacks.append(callback)
+
+    def is_idle(self):
+        with self._lock:
+            return self._pending == 0
+
+    def submit(self, task):
+        with self._lock:
+            self._pending += 1
+        self._queue.put(task)
+        with self._lock:
+            if self._workers < self.max_workers:
+                self._workers += 1
+                worker = threading.Thread(target=self._worker)
+                worker.setDaemon(True)
+                worker.start()
+
+    def _worker(self):
+        while True:
+            task = self._queue.get()
+            try:
+                task.post_process()
+            except Exception, e:
+                log('Cannot post-process %s: %s', task, e, sender=self, \
+                        traceback=True)
+            self._queue.task_done()
+
+            with self._lock:
+                self._pending -= 1
+                idle = (self._pending == 0)
+
+            if idle:
+                for callback in self._idle_callbacks:
+                    try:
+                        callback()
+                    except Exception, e:
+                        log('Error in idle callback: %s', e, sender=self, \
+                                traceback=True)
+
+    def wait(self):
+        """Block until all submitted tasks have been processed"""
+        self._queue.join()
+
+
+# The pipeline that finishes all downloaded tasks
+post_download_pipeline = PostDownloadPipeline()
+
+
 class DownloadTask(object):
     """An object representing the download task of an episode
 
@@ -481,6 +1414,10 @@ class DownloadTask(object):
     of downloading data, this can take a while when the Internet is
     busy).
 
+    After the data has been downloaded, the task stays in the
+    POSTPROCESSING state until the post-download pipeline has moved
+    the file into place. It can still be paused or cancelled then.
+
     The "status_changed" attribute gets set to True everytime the
     "status" attribute changes its value. After you get the value of
     the "status_changed" attribute, it is always reset to False:
@@ -519,8 +1456,16 @@ class DownloadTask(object):
     """
     # Possible states this download task can be in
     STATUS_MESSAGE = (_('Added'), _('Queued'), _('Downloading'),
-            _('Finished'), _('Failed'), _('Cancelled'), _('Paused'))
-    (INIT, QUEUED, DOWNLOADING, DONE, FAILED, CANCELLED, PAUSED) = range(7)
+            _('Finished'), _('Failed'), _('Cancelled'), _('Paused'),
+            _('Finishing'))
+    (INIT, QUEUED, DOWNLOADING, DONE, FAILED, CANCELLED, PAUSED, \
+            POSTPROCESSING) = range(8)
+
+    # Unfinished downloads are kept in the download journal of the
+    # database, so they can be resumed after a restart; the number of
+    # downloaded bytes is journaled at most every JOURNAL_INTERVAL seconds
+    JOURNALED = (QUEUED, DOWNLOADING, FAILED, PAUSED, POSTPROCESSING)
+    JOURNAL_INTERVAL = 10.
 
     def __str__(self):
         return self.__episode.title
@@ -529,9 +1474,19 @@ class DownloadTask(object):
         return self.__status
 
     def __set_status(self, status):
-        if status != self.__status:
-            self.__status_changed = True
-            self.__status = status
+        with self.__status_lock:
+            if status in (DownloadTask.PAUSED, DownloadTask.CANCELLED) and \
+                    (self.__finishing or self.__status == DownloadTask.DONE):
+                # Too late - the file has been moved into place
+                log('Cannot pause/cancel finished download: %s', self, \
+                        sender=self)
+                return
+
+            if status != self.__status:
+                self.__status_changed = True
+                self.__status = status
+                progress_service.publish(self)
+                self._journal()
 
     status = property(fget=__get_status, fset=__set_status)
 
@@ -560,11 +1515,32 @@ class DownloadTask(object):
     episode = property(fget=__get_episode)
 
     def removed_from_list(self):
+        progress_service.remove(self)
         if self.status != self.DONE:
             util.delete_file(self.tempname)
+            util.delete_file(self.tempname+DownloadURLOpener.SEGMENTS_SUFFIX)
+            self._journal(remove=True)
+
+    def _journal(self, remove=False):
+        """Update the entry of this task in the download journal"""
+        self.__journal_time = time.time()
+        db = self.__episode.db
+        try:
+            if self.status in self.JOURNALED and not remove:
+                db.journal_download(self.__episode.id, self.status, \
+                        self.__offset, self.total_size)
+            elif self.status != self.INIT:
+                db.remove_from_download_journal(self.__episode.id)
+            db.commit()
+        except Exception, e:
+            log('Cannot update download journal: %s', e, sender=self, \
+                    traceback=True)
 
     def __init__(self, episode, config):
         self.__status = DownloadTask.INIT
+        self.__status_lock = threading.RLock()
+        # True while post_process() moves the file into place
+        self.__finishing = False
         self.__status_changed = True
         self.__episode = episode
         self._config = config
@@ -582,16 +1558,25 @@ class DownloadTask(object):
         self.progress = 0.0
         self.error_message = None
 
-        # Variables for speed limit and speed calculation
+        # SHA-1 of the downloaded file (if dedup_downloads is enabled)
+        self.digest = None
+
+        # Variables for speed calculation
         self.__start_time = 0
         self.__start_blocks = 0
-        self.__limit_rate_value = self._config.limit_rate_value
-        self.__limit_rate = self._config.limit_rate
+
+        # Set when the post-download pipeline has finished this task
+        self.__post_processed = threading.Event()
+
+        # Number of bytes downloaded so far (for the download journal)
+        self.__offset = 0
+        self.__journal_time = 0
 
         # If the tempname already exists, set progress accordingly
         if os.path.exists(self.tempname):
             try:
                 already_downloaded = os.path.getsize(self.tempname)
+                self.__offset = already_downloaded
                 if self.total_size > 0:
                     self.progress = max(0.0, min(1.0, float(already_downloaded)/self.total_size))
             except OSError, os_error:
@@ -601,6 +1586,8 @@ class DownloadTask(object):
             # files for resuming when the file is queued
             open(self.tempname, 'w').close()
 
+        progress_service.publish(self)
+
     def status_updated(self, count, blockSize, totalSize):
         # We see a different "total size" while downloading,
         # so correct the total size variable in the thread
@@ -611,6 +1598,11 @@ class DownloadTask(object):
             self.progress = max(0.0, min(1.0, float(count*blockSize)/self.total_size))
 
         self.calculate_speed(count, blockSize)
+        progress_service.publish(self)
+
+        self.__offset = count*blockSize
+        if time.time() - self.__journal_time > self.JOURNAL_INTERVAL:
+            self._journal()
 
         if self.status == DownloadTask.CANCELLED:
             raise DownloadCancelledException()
@@ -619,44 +1611,20 @@ class DownloadTask(object):
             raise DownloadCancelledException()
 
     def calculate_speed(self, count, blockSize):
-        if count % 5 == 0:
-            now = time.time()
-            if self.__start_time > 0:
-                # Has rate limiting been enabled or disabled?                
-                if self.__limit_rate != self._config.limit_rate: 
-                    # If it has been enabled then reset base time and block count                    
-                    if self._config.limit_rate:
-                        self.__start_time = now
-                        self.__start_blocks = count
-                    self.__limit_rate = self._config.limit_rate
-                    
-                # Has the rate been changed and are we currently limiting?            
-                if self.__limit_rate_value != self._config.limit_rate_value and self.__limit_rate: 
-                    self.__start_time = now
-                    self.__start_blocks = count
-                    self.__limit_rate_value = self._config.limit_rate_value
-
-                passed = now - self.__start_time
-                if passed > 0:
-                    speed = ((count-self.__start_blocks)*blockSize)/passed
-                else:
-                    speed = 0
+        # The report hook is called at most every REPORT_INTERVAL seconds
+        now = time.time()
+        if self.__start_time > 0:
+            passed = now - self.__start_time
+            if passed > 0:
+                speed = ((count-self.__start_blocks)*blockSize)/passed
             else:
-                self.__start_time = now
-                self.__start_blocks = count
-                passed = now - self.__start_time
-                speed = count*blockSize
-
-            self.speed = float(speed)
-
-            if self._config.limit_rate and speed > self._config.limit_rate_value:
-                # calculate the time that should have passed to reach
-                # the desired download rate and wait if necessary
-                should_have_passed = float((count-self.__start_blocks)*blockSize)/(self._config.limit_rate_value*1024.0)
-                if should_have_passed > passed:
-                    # sleep a maximum of 10 seconds to not cause time-outs
-                    delay = min(10.0, float(should_have_passed-passed))
-                    time.sleep(delay)
+                speed = 0
+        else:
+            self.__start_time = now
+            self.__start_blocks = count
+            speed = 0
+
+        self.speed = float(speed)
 
     def run(self):
         # Speed calculation (re-)starts here
@@ -666,8 +1634,10 @@ class DownloadTask(object):
         # If the download has already been cancelled, skip it
         if self.status == DownloadTask.CANCELLED:
             util.delete_file(self.tempname)
+            util.delete_file(self.tempname+DownloadURLOpener.SEGMENTS_SUFFIX)
             self.progress = 0.0
             self.speed = 0.0
+            progress_service.publish(self)
             return False
 
         # We only start this download if its status is "queued"
@@ -677,13 +1647,35 @@ class DownloadTask(object):
         # We are downloading this file right now
         self.status = DownloadTask.DOWNLOADING
 
+        if self._dedup_enabled() and self._link_same_url():
+            # The file has been downloaded for another episode before
+            self.progress = 1.0
+            self.status = DownloadTask.POSTPROCESSING
+            post_download_pipeline.submit(self)
+            return True
+
         try:
             # Resolve URL and start downloading the episode
             url = youtube.get_real_download_url(self.__episode.url, \
                     self._config.youtube_preferred_fmt_id)
-            downloader =  DownloadURLOpener(self.__episode.channel)
-            headers, real_url = downloader.retrieve_resume(url, \
-                    self.tempname, reporthook=self.status_updated)
+            # The speed limit is shared by all downloads (see BandwidthLimiter)
+            downloader =  DownloadURLOpener(self.__episode.channel, \
+                    BandwidthLimiter.for_config(self._config))
+            if self._config.download_segments > 1:
+                # The digest is calculated after the download (see _deduplicate)
+                headers, real_url = downloader.retrieve_segmented(url, \
+                        self.tempname, self._config.download_segments, \
+                        reporthook=self.status_updated)
+            else:
+                if self._dedup_enabled():
+                    digest = hashlib.sha1()
+                else:
+                    digest = None
+                headers, real_url = downloader.retrieve_resume(url, \
+                        self.tempname, reporthook=self.status_updated, \
+                        digest=digest)
+                if digest is not None:
+                    self.digest = digest.hexdigest()
 
             new_mimetype = headers.get('content-type', self.__episode.mimetype)
             old_mimetype = self.__episode.mimetype
@@ -717,26 +1709,11 @@ class DownloadTask(object):
                     log('Using content-disposition mimetype: %s',
                             new_mimetype, sender=self)
                     self.__episode.set_mimetype(new_mimetype, commit=True)
-
-            shutil.move(self.tempname, self.filename)
-
-            # Model- and database-related updates after a download has finished
-            self.__episode.on_downloaded(self.filename)
-
-            # If a user command has been defined, execute the command setting some environment variables
-            if len(self._config.cmd_download_complete) > 0:
-                os.environ["GPODDER_EPISODE_URL"]=self.__episode.url or ''
-                os.environ["GPODDER_EPISODE_TITLE"]=self.__episode.title or ''
-                os.environ["GPODDER_EPISODE_FILENAME"]=self.filename or ''
-                os.environ["GPODDER_EPISODE_PUBDATE"]=str(int(self.__episode.pubDate))
-                os.environ["GPODDER_EPISODE_LINK"]=self.__episode.link or ''
-                os.environ["GPODDER_EPISODE_DESC"]=self.__episode.description or ''
-                os.environ["GPODDER_CHANNEL_TITLE"]=self.__episode.channel.title or ''
-                util.run_external_command(self._config.cmd_download_complete)
         except DownloadCancelledException:
             log('Download has been cancelled/paused: %s', self, sender=self)
             if self.status == DownloadTask.CANCELLED:
                 util.delete_file(self.tempname)
+                util.delete_file(self.tempname+DownloadURLOpener.SEGMENTS_SUFFIX)
                 self.progress = 0.0
                 self.speed = 0.0
         except urllib.ContentTooShortError, ctse:
@@ -757,16 +1734,161 @@ class DownloadTask(object):
             self.error_message = _('Error: %s') % (e.message,)
 
         if self.status == DownloadTask.DOWNLOADING:
-            # Everything went well - we're done
-            self.status = DownloadTask.DONE
-            if self.total_size <= 0:
-                self.total_size = util.calculate_size(self.filename)
-                log('Total size updated to %d', self.total_size, sender=self)
+            # Everything went well - the post-download pipeline moves
+            # the file into place and sets the status to DONE
+            self.speed = 0.0
             self.progress = 1.0
+            self.status = DownloadTask.POSTPROCESSING
+            post_download_pipeline.submit(self)
             return True
         
         self.speed = 0.0
+        progress_service.publish(self)
 
         # We finished, but not successfully (at least not really)
         return False
 
+    def wait(self, timeout=None):
+        """Wait until the post-download pipeline has finished this task"""
+        self.__post_processed.wait(timeout)
+
+    def post_process(self):
+        """Carry out all stages after the data has been downloaded
+
+        The file is moved into place and the database is updated
+        before the task is marked as done. Tagging, updating the
+        playlist and running the user command come afterwards.
+
+        The task can be paused or cancelled while it is waiting in
+        the pipeline, but not anymore once the file is being moved.
+        """
+        try:
+            with self.__status_lock:
+                if self.status == DownloadTask.CANCELLED:
+                    util.delete_file(self.tempname)
+                    util.delete_file(self.tempname + \
+                            DownloadURLOpener.SEGMENTS_SUFFIX)
+                    self.progress = 0.0
+                    progress_service.publish(self)
+                    return
+                elif self.status != DownloadTask.POSTPROCESSING:
+                    # Paused - the complete file is kept for resuming
+                    return
+
+                self.__finishing = True
+
+            try:
+                self._move_file()
+                self._deduplicate()
+                self._update_database()
+            except IOError, ioe:
+                log('Error "%s" while moving "%s": %s', ioe.strerror, \
+                        self.__episode.title, ioe.filename, sender=self, \
+                        traceback=True)
+                self.status = DownloadTask.FAILED
+                d = {'error': ioe.strerror, 'filename': ioe.filename}
+                self.error_message = _('I/O Error: %(error)s: %(filename)s') % d
+                return
+            except Exception, e:
+                self.status = DownloadTask.FAILED
+                self.error_message = _('Error: %s') % (e.message,)
+                return
+            else:
+                self.status = DownloadTask.DONE
+            finally:
+                self.__finishing = False
+
+            for stage in (self._update_tag, self._update_playlist, \
+                    self._run_download_complete_command):
+                try:
+                    stage()
+                except Exception, e:
+                    log('Error in %s for "%s": %s', stage.__name__, \
+                            self.__episode.title, e, sender=self, \
+                            traceback=True)
+        finally:
+            self.__post_processed.set()
+
+    def _move_file(self):
+        shutil.move(self.tempname, self.filename)
+        if self.total_size <= 0:
+            self.total_size = util.calculate_size(self.filename)
+            log('Total size updated to %d', self.total_size, sender=self)
+
+    def _dedup_enabled(self):
+        # Tags are written into the file after the download, so a
+        # linked file would get the tags of both episodes (and the
+        # stored digest would not match the tagged content anymore)
+        return self._config.dedup_downloads and not self._config.update_tags
+
+    def _link_same_url(self):
+        """Hard-link the file of another episode with the same URL"""
+        for foldername, filename, digest in self._get_duplicates():
+            path = os.path.join(self.__episode.channel.download_dir, \
+                    foldername, filename)
+            if os.path.exists(path) and replace_with_link(path, self.tempname):
+                log('Linked %s to %s (same URL)', self.filename, path, \
+                        sender=self)
+                self.digest = digest
+                return True
+        return False
+
+    def _deduplicate(self):
+        """Hard-link the file of another episode with the same content"""
+        if not self._dedup_enabled():
+            return
+
+        if self.digest is None:
+            digest = hashlib.sha1()
+            update_digest(digest, self.filename)
+            self.digest = digest.hexdigest()
+
+        size = os.path.getsize(self.filename)
+        for foldername, filename, digest in self._get_duplicates():
+            path = os.path.join(self.__episode.channel.download_dir, \
+                    foldername, filename)
+            if digest != self.digest or not os.path.exists(path) or \
+                    os.path.samefile(path, self.filename) or \
+                    os.path.getsize(path) != size:
+                continue
+            if replace_with_link(path, self.filename):
+                log('Linked %s to %s (same content)', self.filename, path, \
+                        sender=self)
+                break
+
+    def _get_duplicates(self):
+        return self.__episode.db.get_downloaded_duplicates(self.__episode.id, \
+                self.__episode.url, self.digest)
+
+    def _update_database(self):
+        # Model- and database-related updates after a download has finished
+        self.__episode.on_downloaded(self.filename, self.digest)
+
+    def _update_tag(self):
+        if self._config.update_tags:
+            # The config cannot be passed to the Tagger's constructor
+            t = tagger.Tagger()
+            t.config = self._config
+            t.update_tag(self.__episode)
+
+    def _update_playlist(self):
+        playlist.playlist_manager.episode_downloaded(self.__episode)
+
+    def _run_download_complete_command(self):
+        # If a user command has been defined, execute the command setting
+        # some environment variables (for this command only)
+        if len(self._config.cmd_download_complete) > 0:
+            env = dict(os.environ)
+            for key, value in (
+                    ('GPODDER_EPISODE_URL', self.__episode.url),
+                    ('GPODDER_EPISODE_TITLE', self.__episode.title),
+                    ('GPODDER_EPISODE_FILENAME', self.filename),
+                    ('GPODDER_EPISODE_PUBDATE', str(int(self.__episode.pubDate))),
+                    ('GPODDER_EPISODE_LINK', self.__episode.link),
+                    ('GPODDER_EPISODE_DESC', self.__episode.description),
+                    ('GPODDER_CHANNEL_TITLE', self.__episode.channel.title)):
+                if isinstance(value, unicode):
+                    value = value.encode('utf-8')
+                env[key] = value or ''
+            util.run_external_command(self._config.cmd_download_complete, env)
+
@@ -27,6 +27,12 @@ import feedparser
 import urllib
 import urlparse
 import urllib2
+import hashlib
+import threading
+import StringIO
+import zlib
+
+from xml.parsers import expat
 
 def patch_feedparser():
     """Monkey-patch the Universal Feed Parser"""
@@ -100,6 +106,275 @@ class NotModified(ExceptionWithData): pass
 
 
 
+class UnchangedContent(Exception):
+    """The feed body is identical to the last one (see DigestHandler)"""
+    def __init__(self, url, headers):
+        Exception.__init__(self)
+        self.url = url
+        self.headers = headers
+
+
+class EnoughItems(Exception):
+    """Raised by the FeedTruncator parser to stop parsing"""
+
+
+class FeedTruncator(object):
+    """Cut off a feed document after its first "max_items" items
+
+    The document is fed chunk by chunk into an expat parser that counts
+    the RSS <item> and Atom <entry> elements. After the end tag of the
+    last wanted item, the rest of the document is thrown away and end
+    tags for all open elements are appended, so feedparser only has to
+    parse (and we only have to keep) the first items. Elements of the
+    feed that come after the items are lost in this case.
+
+    If the document cannot be read by expat (e.g. because of broken
+    XML or an unsupported encoding), it is kept as it is. Only one copy
+    of the document is kept; when it is truncated, only its last chunk
+    is cut off.
+
+    >>> doc = '<rss><channel><item>1</item><item>2</item><item>3</item></channel></rss>'
+    >>> t = FeedTruncator(2)
+    >>> t.feed(doc[:20])
+    >>> t.feed(doc[20:])
+    >>> t.truncated
+    True
+    >>> t.get_data()
+    ('<rss><channel><item>1</item><item>2</item></channel></rss>', None)
+    >>> t = FeedTruncator(1)
+    >>> for i in range(0, len(doc), 3):
+    ...     t.feed(doc[i:i+3])
+    >>> t.get_data()
+    ('<rss><channel><item>1</item></channel></rss>', None)
+
+    Documents with fewer items, broken documents and documents that are
+    parsed without a limit are not changed:
+
+    >>> t = FeedTruncator(5, 'identity')
+    >>> t.feed(doc)
+    >>> t.truncated, t.get_data() == (doc, 'identity')
+    (False, True)
+    >>> t = FeedTruncator(2)
+    >>> t.feed('<rss><item>1</rss><item>2</item><item>3</item>')
+    >>> t.truncated
+    False
+    >>> t = FeedTruncator(0)
+    >>> t.feed(doc)
+    >>> t.get_data() == (doc, '')
+    True
+
+    Compressed documents are decompressed for parsing and passed on
+    decompressed:
+
+    >>> import zlib
+    >>> t = FeedTruncator(1, 'deflate')
+    >>> t.feed(zlib.compress(doc))
+    >>> t.get_data()
+    ('<rss><channel><item>1</item></channel></rss>', None)
+    >>> t = FeedTruncator(5, 'deflate')
+    >>> t.feed(zlib.compress(doc))
+    >>> t.get_data() == (doc, None)
+    True
+    """
+    ITEM_ELEMENTS = ('item', 'entry')
+
+    def __init__(self, max_items, content_encoding=''):
+        self.max_items = max_items
+        self.content_encoding = content_encoding
+        self.items = 0
+        self.truncated = False
+
+        # The (decompressed) document and the length of the part of it
+        # that has been passed to the parser before the current chunk
+        self._chunks = []
+        self._offset = 0
+        self._open = []
+        self._open_items = 0
+        self._end = None
+
+        self._parser = None
+        self._decompressor = None
+        if max_items > 0:
+            self._parser = expat.ParserCreate()
+            # Do not fail on entities that would be defined in a DTD
+            self._parser.UseForeignDTD(True)
+            self._parser.StartElementHandler = self._start_element
+            self._parser.EndElementHandler = self._end_element
+
+            # Compressed documents are decompressed for parsing
+            if 'gzip' in content_encoding:
+                self._decompressor = zlib.decompressobj(16+zlib.MAX_WBITS)
+            elif 'deflate' in content_encoding:
+                self._decompressor = zlib.decompressobj()
+
+    def _is_item(self, name):
+        return name.split(':')[-1] in self.ITEM_ELEMENTS
+
+    def _start_element(self, name, attrs):
+        self._open.append(name)
+        if self._is_item(name):
+            self._open_items += 1
+
+    def _end_element(self, name):
+        self._open.pop()
+        if self._is_item(name):
+            self._open_items -= 1
+            if not self._open_items:
+                self.items += 1
+                if self.items == self.max_items:
+                    self._end = self._parser.CurrentByteIndex
+                    raise EnoughItems()
+
+    def _truncate(self):
+        # The end tag ends in the current chunk (it can have started
+        # in one of the chunks before), so only that chunk is cut off
+        chunk = self._chunks[-1]
+        try:
+            end = chunk.index('>', max(0, self._end-self._offset)) + 1
+            closing = ''.join('</%s>' % name for name in reversed(self._open))
+            self._chunks[-1] = chunk[:end] + closing.encode('ascii')
+        except (ValueError, UnicodeError):
+            self._parser = None
+            return
+
+        self.truncated = True
+        self._parser = None
+
+    def feed(self, chunk):
+        if self.truncated:
+            return
+
+        if self._decompressor is not None:
+            try:
+                chunk = self._decompressor.decompress(chunk)
+            except zlib.error:
+                # The rest of the document is lost, so the feed is
+                # incomplete just like a truncated one
+                self._parser = None
+                self.truncated = True
+                return
+
+        if not chunk:
+            return
+
+        self._chunks.append(chunk)
+        if self._parser is None:
+            return
+
+        try:
+            # The end tags would have to be encoded in UTF-16, too
+            if not self._offset and (chunk[:2] in ('\xff\xfe', '\xfe\xff') or \
+                    '\x00' in chunk[:2]):
+                self._parser = None
+                return
+
+            self._parser.Parse(chunk, False)
+            self._offset += len(chunk)
+        except EnoughItems:
+            self._truncate()
+        except expat.ExpatError:
+            self._parser = None
+
+    def get_data(self):
+        """Get the document and its content encoding
+
+        The content encoding is None if the document has been
+        decompressed (which is always the case if it is truncated).
+        """
+        if self._decompressor is not None or self.truncated:
+            return ''.join(self._chunks), None
+        return ''.join(self._chunks), self.content_encoding
+
+
+class DigestHandler(urllib2.BaseHandler):
+    """Calculate the digest of a feed and compare it to a known value
+
+    This urllib2 handler reads the body of successful responses and
+    calculates its digest. If the digest matches the one from the last
+    update, UnchangedContent is raised (which feedparser passes on to
+    us as bozo_exception), so that the feed does not need to be parsed.
+
+    If "max_items" is set, only the first "max_items" items of the feed
+    are passed on to feedparser (see FeedTruncator). The body is read
+    in blocks, so the rest of it never has to be kept in memory.
+
+    The status code of the first redirect is kept in "redirect_status",
+    because feedparser cannot report it when UnchangedContent is raised
+    for the redirected request.
+
+    >>> import mimetools
+    >>> def response(code, data=''):
+    ...     headers = mimetools.Message(StringIO.StringIO('\\n'))
+    ...     result = urllib2.addinfourl(StringIO.StringIO(data), headers, 'url')
+    ...     result.code, result.msg = code, ''
+    ...     return result
+    >>> handler = DigestHandler(hashlib.sha1('<rss/>').hexdigest())
+    >>> handler.http_response(None, response(301)).code
+    301
+    >>> handler.http_response(None, response(302)).code
+    302
+    >>> handler.redirect_status
+    301
+    >>> handler.http_response(None, response(200, '<rss/>'))
+    Traceback (most recent call last):
+      ...
+    UnchangedContent
+    >>> handler.http_response(None, response(200, '<rss></rss>')).read()
+    '<rss></rss>'
+    """
+    # Process responses before urllib2's redirect and error handling
+    handler_order = 400
+
+    BLOCK_SIZE = 64*1024
+
+    REDIRECT_CODES = (301, 302, 303, 307)
+
+    def __init__(self, digest, max_items=0):
+        self.old_digest = digest
+        self.max_items = max_items
+        self.digest = None
+        self.truncated = False
+        self.redirect_status = None
+
+    def http_response(self, request, response):
+        code = getattr(response, 'code', None)
+        if code in self.REDIRECT_CODES and self.redirect_status is None:
+            self.redirect_status = code
+
+        if code != 200:
+            return response
+
+        headers = response.info()
+        truncator = FeedTruncator(self.max_items, \
+                headers.get('content-encoding', ''))
+        digest = hashlib.sha1()
+        while True:
+            chunk = response.read(self.BLOCK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            truncator.feed(chunk)
+        self.digest = digest.hexdigest()
+
+        if self.old_digest is not None and self.digest == self.old_digest:
+            raise UnchangedContent(response.geturl(), dict(headers.items()))
+
+        self.truncated = truncator.truncated
+        data, content_encoding = truncator.get_data()
+        if content_encoding is None and 'content-encoding' in headers:
+            # The truncated document has already been decompressed
+            del headers['content-encoding']
+
+        # Pass a copy of the already-read data on to feedparser
+        result = urllib2.addinfourl(StringIO.StringIO(data), \
+                headers, response.geturl())
+        result.code = response.code
+        result.msg = response.msg
+        return result
+
+    https_response = http_response
+
+
 class Fetcher(object):
     # Supported types, see http://feedvalidator.org/docs/warning/EncodingMismatch.html
     FEED_TYPES = ('application/rss+xml',
@@ -111,6 +386,11 @@ class Fetcher(object):
     def __init__(self, user_agent):
         self.user_agent = user_agent
 
+        # Statistics for the feed content digest check (see DigestHandler)
+        self.digest_hits = 0
+        self.digest_misses = 0
+        self._digest_lock = threading.Lock()
+
     def _get_handlers(self):
         """Provide additional urllib2 handler objects
 
@@ -214,13 +494,61 @@ class Fetcher(object):
         else:
             raise UnknownStatusCode(status)
 
-    def _parse_feed(self, url, etag, modified, autodiscovery=True):
-        """Parse the feed and raise the result."""
+    def _check_unchanged_content(self, feed, digest_handler):
+        unchanged = isinstance(feed.get('bozo_exception', None), UnchangedContent)
+
+        self._digest_lock.acquire()
+        if unchanged:
+            self.digest_hits += 1
+        else:
+            self.digest_misses += 1
+        self._digest_lock.release()
+
+        if unchanged:
+            # Treat it like a "304 Not Modified" response, but keep the
+            # status of a permanent redirect, so the new URL gets used
+            if digest_handler.redirect_status == 301:
+                status = 301
+            else:
+                status = 304
+            exception = feed.bozo_exception
+            raise NotModified(feedparser.FeedParserDict(status=status, \
+                    href=exception.url, headers=exception.headers, \
+                    digest=digest_handler.digest))
+
+        if digest_handler.digest is not None:
+            feed['digest'] = digest_handler.digest
+
+    def get_digest_statistics(self):
+        """Get the statistics of the feed content digest check
+
+        Returns a tuple (hits, misses) with the number of feeds that
+        have been skipped because their content did not change and the
+        number of feeds that had to be parsed (or could not be checked).
+        """
+        return (self.digest_hits, self.digest_misses)
+
+    def _parse_feed(self, url, etag, modified, autodiscovery=True, digest=None, \
+            max_items=0):
+        """Parse the feed and raise the result.
+
+        If "digest" is given and the downloaded feed content has the
+        same digest, the feed is not parsed and NotModified is raised.
+        Otherwise, the new digest is available as feed.digest.
+
+        If "max_items" is greater than zero, parsing can stop after
+        that many items (the feed might contain more entries, though).
+        If it did, feed.truncated is True.
+        """
+        digest_handler = DigestHandler(digest, max_items)
         feed = feedparser.parse(url,
                 agent=self.user_agent,
                 modified=modified,
                 etag=etag,
-                handlers=self._get_handlers())
+                handlers=self._get_handlers()+[digest_handler])
+
+        self._check_unchanged_content(feed, digest_handler)
+        feed['truncated'] = digest_handler.truncated
 
         self._check_offline(feed)
         self._check_wifi_login_page(feed)
@@ -231,13 +559,22 @@ class Fetcher(object):
         self._check_valid_feed(feed)
         self._check_statuscode(feed)
 
-    def fetch(self, url, etag=None, modified=None):
+    def fetch(self, url, etag=None, modified=None, digest=None, max_items=0):
         """Download a feed, with optional etag an modified values
 
         This method will always raise an exception that tells
         the calling code the result of the fetch operation. See
         the code for the feedcore module for all the possible
         exception types.
+
+        If "digest" is the value of the "digest" attribute of the
+        result of the last fetch, an unchanged feed body will result
+        in NotModified, even if the server ignores etag and modified.
+        If the feed has been moved permanently, the status of the
+        NotModified data is 301 and "href" is the new URL.
+
+        If "max_items" is greater than zero, only the first "max_items"
+        entries of the feed have to be parsed.
         """
-        self._parse_feed(url, etag, modified)
+        self._parse_feed(url, etag, modified, digest=digest, max_items=max_items)
 
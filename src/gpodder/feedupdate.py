@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+#
+# gPodder - A media aggregator and podcast client
+# Copyright (c) 2005-2010 Thomas Perl and the gPodder Team
+#
+# gPodder is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# gPodder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+#
+#  feedupdate.py -- Parallel feed updates for the GUI and the CLI
+#
+
+from __future__ import with_statement
+
+from gpodder import services
+from gpodder.liblogger import log
+
+import threading
+import urlparse
+import random
+import heapq
+import Queue
+import time
+
+
+class FeedUpdater(object):
+    """Update a list of podcasts with a bounded number of threads
+
+    Downloading and parsing the feeds (PodcastChannel.fetch) is
+    carried out by up to "max_workers" worker threads, with at most
+    "max_connections_per_host" feeds being fetched from the same
+    host at any given time. The results are merged into the database
+    (PodcastChannel.consume) by the thread that calls update(), so
+    there is only a single thread writing to the database.
+
+    Use one FeedUpdater object per update run:
+
+        updater = FeedUpdater(config.feed_update_workers,
+                config.feed_update_connections_per_host)
+        updater.update(channels, config.max_episodes_per_feed,
+                progress_callback=on_progress)
+    """
+
+    def __init__(self, max_workers=4, max_connections_per_host=2):
+        self.max_workers = max(1, max_workers)
+        self.max_connections_per_host = max(1, max_connections_per_host)
+
+        self._condition = threading.Condition()
+        self._pending = []
+        self._active_hosts = {}
+        self._cancelled = False
+
+    def _get_host(self, channel):
+        return urlparse.urlparse(channel.url or '')[1].lower()
+
+    def cancel(self):
+        """Do not start fetching any more feeds
+
+        Feeds that are currently being downloaded will be
+        finished, but their results will not be merged.
+        """
+        with self._condition:
+            self._cancelled = True
+            self._condition.notifyAll()
+
+    def _next_channel(self):
+        """Get the next channel whose host has a free connection
+
+        Blocks until such a channel is available. Returns None
+        when there is nothing more to do for a worker thread.
+        """
+        with self._condition:
+            while self._pending and not self._cancelled:
+                for index, channel in enumerate(self._pending):
+                    host = self._get_host(channel)
+                    active = self._active_hosts.get(host, 0)
+                    if active < self.max_connections_per_host:
+                        del self._pending[index]
+                        self._active_hosts[host] = active + 1
+                        return channel
+                self._condition.wait()
+            return None
+
+    def _release_host(self, channel):
+        with self._condition:
+            host = self._get_host(channel)
+            self._active_hosts[host] -= 1
+            self._condition.notifyAll()
+
+    def _worker(self, results, max_episodes):
+        while True:
+            channel = self._next_channel()
+            if channel is None:
+                break
+
+            try:
+                results.put((channel, channel.fetch(max_episodes), None))
+            except Exception, e:
+                results.put((channel, None, e))
+
+            self._release_host(channel)
+
+        # Tell the writer thread that this worker has finished
+        results.put(None)
+
+    def update(self, channels, max_episodes=0, should_update=None, \
+            progress_callback=None, error_callback=None):
+        """Update all channels and merge the results into the database
+
+        If "should_update" is given, it is called with each channel and
+        should return False if the channel is to be skipped. After each
+        channel has been processed (updated or skipped), the callback
+        progress_callback(channel, position, total) is called. If the
+        update of a channel fails, error_callback(channel, exception)
+        is called (and the error is logged if no callback is given).
+
+        All callbacks are called from the thread calling this method.
+        Returns the list of channels that have been updated.
+        """
+        total = len(channels)
+        position = 0
+        updated = []
+
+        for channel in channels:
+            if should_update is None or should_update(channel):
+                self._pending.append(channel)
+            else:
+                position += 1
+                if progress_callback is not None:
+                    progress_callback(channel, position, total)
+
+        results = Queue.Queue()
+        worker_count = min(self.max_workers, len(self._pending))
+        for i in range(worker_count):
+            worker = threading.Thread(target=self._worker, \
+                    args=(results, max_episodes))
+            worker.setDaemon(True)
+            worker.start()
+
+        while worker_count > 0:
+            item = results.get()
+            if item is None:
+                worker_count -= 1
+                continue
+
+            if self._cancelled:
+                continue
+
+            channel, result, error = item
+            if error is None:
+                try:
+                    channel.consume(result, max_episodes)
+                    updated.append(channel)
+                except Exception, e:
+                    error = e
+
+            if error is not None:
+                if error_callback is not None:
+                    error_callback(channel, error)
+                else:
+                    log('Cannot update %s: %s', channel.url, error, \
+                            sender=self)
+
+            position += 1
+            if progress_callback is not None:
+                progress_callback(channel, position, total)
+
+        return updated
+
+
+class RefreshScheduler(services.ObservableService):
+    """Refresh each podcast on its own when it is due
+
+    The podcasts are kept in a heap ordered by the time of their next
+    refresh, which is estimated from their release cycle (see
+    get_next_update). A daemon thread refreshes the podcast at the top
+    of the heap when it is due, so the load is spread out over time
+    instead of updating all podcasts at once. A random delay of up to
+    "jitter" seconds is added to every due time, and at most
+    "max_rate" podcasts are refreshed per minute.
+
+    Each refreshed podcast is announced with the "podcast-updated"
+    signal (with the podcast, the list of its new episodes and the
+    IDs of the episodes that have been removed from the database),
+    each failed refresh with "podcast-failed" (podcast, exception):
+
+        scheduler = RefreshScheduler(config.max_episodes_per_feed)
+        scheduler.register('podcast-updated', on_podcast_updated)
+        scheduler.set_podcasts(channels)
+        scheduler.start()
+
+    >>> class Channel(object):
+    ...     def __init__(self, id, updated, expected=0, deviation=0):
+    ...         self.id, self.updated_timestamp = id, updated
+    ...         self.release_expected = expected
+    ...         self.release_deviation = deviation
+    >>> a, b, c = Channel(1, 0, 3600), Channel(2, 0, 60), \\
+    ...         Channel(3, 100000, 0, 20000)
+    >>> scheduler = RefreshScheduler(min_interval=600, max_interval=86400, \\
+    ...         max_rate=60000, jitter=0)
+    >>> [scheduler.get_next_update(channel) for channel in (a, b, c)]
+    [3600, 600, 120000]
+    >>> scheduler.get_next_update(Channel(4, 1000000))
+    1086400
+
+    The podcast that is due first is refreshed first:
+
+    >>> scheduler.set_podcasts([a, b, c])
+    >>> scheduler._thread = threading.currentThread()
+    >>> [scheduler._next_podcast()[0].id for i in range(3)]
+    [2, 1, 3]
+    >>> scheduler.set_podcasts([a, b, c])
+    >>> scheduler.remove_podcasts([b])
+    >>> [scheduler._next_podcast()[0].id for i in range(2)]
+    [1, 3]
+
+    The jitter delays each podcast by a random time:
+
+    >>> scheduler = RefreshScheduler(min_interval=600, jitter=300)
+    >>> scheduler.set_podcasts([a, b, c] * 100)
+    >>> delays = [due - scheduler.get_next_update(channel) \\
+    ...         for due, id, channel in scheduler._heap]
+    >>> 0 <= min(delays) < max(delays) <= 300
+    True
+    """
+
+    def __init__(self, max_episodes=0, min_interval=10*60, \
+            max_interval=24*60*60, max_rate=6, jitter=5*60):
+        services.ObservableService.__init__(self, \
+                ['podcast-updated', 'podcast-failed'])
+        self.max_episodes = max_episodes
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_rate = max_rate
+        self.jitter = jitter
+
+        self._condition = threading.Condition()
+        self._heap = []
+        self._generation = 0
+        self._last_refresh = 0
+        self._thread = None
+
+        # Number of pause() calls without resume(), and whether a
+        # podcast is being refreshed right now (see pause)
+        self._paused = 0
+        self._refreshing = False
+
+    def get_next_update(self, channel):
+        """Estimate when a podcast should be refreshed next
+
+        A podcast is due when its next release is expected. If that
+        release is late, it is checked often while it is within the
+        usual deviation of the release cycle and less often later. At
+        least "min_interval" and at most "max_interval" seconds lie
+        between two refreshes.
+        """
+        updated = channel.updated_timestamp or 0
+        expected = channel.release_expected or 0
+        deviation = channel.release_deviation or 0
+
+        if expected > updated:
+            due = expected
+        else:
+            late = updated - expected
+            due = updated + max(0, late - deviation)/4
+
+        return min(max(due, updated + self.min_interval), \
+                updated + self.max_interval)
+
+    def _push(self, channel, earliest=0):
+        due = max(self.get_next_update(channel), earliest)
+        due += random.uniform(0, self.jitter)
+        heapq.heappush(self._heap, (due, channel.id, channel))
+
+    def set_podcasts(self, channels):
+        """Set the podcasts that should be refreshed"""
+        with self._condition:
+            self._heap = []
+            self._generation += 1
+            for channel in channels:
+                self._push(channel)
+            self._condition.notifyAll()
+
+    def remove_podcasts(self, channels):
+        """Stop refreshing the given podcasts (e.g. after deleting them)
+
+        Call this while the scheduler is paused, otherwise a podcast
+        that is being refreshed right now is scheduled again.
+        """
+        ids = set(channel.id for channel in channels)
+        with self._condition:
+            self._heap = [item for item in self._heap if item[1] not in ids]
+            heapq.heapify(self._heap)
+
+    def start(self):
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run)
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop refreshing (a running refresh is finished)"""
+        with self._condition:
+            self._thread = None
+            self._condition.notifyAll()
+
+    def pause(self, wait=True):
+        """Stop refreshing podcasts until resume() is called
+
+        If "wait" is True, this blocks until a refresh that is in
+        progress has finished, so the podcasts can be updated (or
+        deleted) by somebody else in the meantime. Otherwise, use
+        wait_idle() to wait for it. Calls can be nested.
+        """
+        with self._condition:
+            self._paused += 1
+            while wait and self._refreshing:
+                self._condition.wait()
+
+    def resume(self):
+        with self._condition:
+            self._paused -= 1
+            self._condition.notifyAll()
+
+    def wait_idle(self, timeout=None):
+        """Wait for a refresh that is in progress to finish
+
+        Returns True if no podcast is being refreshed anymore.
+        """
+        with self._condition:
+            if self._refreshing:
+                self._condition.wait(timeout)
+            return not self._refreshing
+
+    def _is_stopped(self):
+        return self._thread is not threading.currentThread()
+
+    def _next_podcast(self):
+        # Wait until a podcast is due; returns None when stopped
+        with self._condition:
+            while not self._is_stopped():
+                now = time.time()
+                if not self._heap or self._paused:
+                    self._condition.wait()
+                    continue
+
+                due = max(self._heap[0][0], \
+                        self._last_refresh + 60./self.max_rate)
+                if due <= now:
+                    self._last_refresh = now
+                    self._refreshing = True
+                    due, id, channel = heapq.heappop(self._heap)
+                    return channel, self._generation
+
+                self._condition.wait(due - now)
+
+            return None, None
+
+    def _refresh(self, channel):
+        old_episodes = set(e.id for e in channel.get_new_episodes())
+        removed_ids = channel.consume(channel.fetch(self.max_episodes), \
+                self.max_episodes)
+        return [e for e in channel.get_new_episodes() \
+                if e.id not in old_episodes], removed_ids
+
+    def _run(self):
+        while True:
+            channel, generation = self._next_podcast()
+            if channel is None:
+                break
+
+            log('Refreshing %s', channel.url, sender=self)
+            try:
+                episodes, removed_ids = self._refresh(channel)
+                self.notify('podcast-updated', channel, episodes, \
+                        removed_ids)
+            except Exception, e:
+                log('Cannot update %s: %s', channel.url, e, sender=self)
+                self.notify('podcast-failed', channel, e)
+            finally:
+                with self._condition:
+                    self._refreshing = False
+                    if generation == self._generation:
+                        self._push(channel, time.time() + self.min_interval)
+                    self._condition.notifyAll()
@@ -53,6 +53,7 @@ class DownloadStatusModel(gtk.ListStore):
         self._status_ids[download.DownloadTask.FAILED] = gtk.STOCK_STOP
         self._status_ids[download.DownloadTask.CANCELLED] = gtk.STOCK_CANCEL
         self._status_ids[download.DownloadTask.PAUSED] = gtk.STOCK_MEDIA_PAUSE
+        self._status_ids[download.DownloadTask.POSTPROCESSING] = gtk.STOCK_GO_DOWN
 
     def _format_message(self, episode, message, podcast):
         return '%s\n<small>%s - %s</small>' % (episode, message, podcast)
@@ -103,6 +104,7 @@ class DownloadStatusModel(gtk.ListStore):
             task = row[DownloadStatusModel.C_TASK]
             if task is not None:
                 # Pause currently-running (and queued) downloads
+                # (finishing downloads are completed before quitting)
                 if task.status in (task.QUEUED, task.DOWNLOADING):
                     task.status = task.PAUSED
 
@@ -113,13 +115,14 @@ class DownloadStatusModel(gtk.ListStore):
     def are_downloads_in_progress(self):
         """
         Returns True if there are any downloads in the
-        QUEUED or DOWNLOADING status, False otherwise.
+        QUEUED, DOWNLOADING or POSTPROCESSING status, False otherwise.
         """
         for row in self:
             task = row[DownloadStatusModel.C_TASK]
             if task is not None and \
                     task.status in (task.DOWNLOADING, \
-                                    task.QUEUED):
+                                    task.QUEUED, \
+                                    task.POSTPROCESSING):
                 return True
 
         return False
@@ -129,7 +132,8 @@ class DownloadStatusModel(gtk.ListStore):
             task = row[DownloadStatusModel.C_TASK]
             if task is not None and task.url == url and \
                     task.status in (task.DOWNLOADING, \
-                                    task.QUEUED):
+                                    task.QUEUED, \
+                                    task.POSTPROCESSING):
                 task.status = task.CANCELLED
                 return True
 
@@ -151,7 +155,8 @@ class DownloadTaskMonitor(object):
                 self._on_finished()
             elif task.status == task.PAUSED:
                 self._on_can_resume()
-            elif task.status in (task.QUEUED, task.DOWNLOADING):
+            elif task.status in (task.QUEUED, task.DOWNLOADING, \
+                    task.POSTPROCESSING):
                 self._on_can_pause()
             self._status = task.status
 
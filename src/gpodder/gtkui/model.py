@@ -56,6 +56,9 @@ class EpisodeListModel(gtk.ListStore):
     # In which steps the UI is updated for "loading" animations
     _UI_UPDATE_STEP = .03
 
+    # How many episodes are added to the model at once
+    _UI_PAGE_SIZE = 100
+
     def __init__(self):
         gtk.ListStore.__init__(self, str, str, str, object, \
                 gtk.gdk.Pixbuf, str, str, str, bool, bool, bool)
@@ -64,6 +67,9 @@ class EpisodeListModel(gtk.ListStore):
         self._update_progress = 0.
         self._last_redraw_progress = 0.
 
+        # Incremented on clear() to stop adding episodes of the old list
+        self._generation = 0
+
         # Filter to allow hiding some episodes
         self._filter = self.filter_new()
         self._view_mode = self.VIEW_ALL
@@ -113,6 +119,10 @@ class EpisodeListModel(gtk.ListStore):
 
         return True
 
+    def clear(self):
+        self._generation += 1
+        gtk.ListStore.clear(self)
+
     def get_update_progress(self):
         return self._update_progress
 
@@ -161,47 +171,76 @@ class EpisodeListModel(gtk.ListStore):
 
     def add_from_channel(self, channel, downloading=None, \
             include_description=False, generate_thumbnails=False, \
-            treeview=None):
+            treeview=None, page_callback=None):
         """
         Add episode from the given channel to this model.
         Downloading should be a callback.
         include_description should be a boolean value (True if description
         is to be added to the episode row, or False if not)
+
+        This is meant to be called from a worker thread: the episodes
+        are loaded in this thread and added to the model in pages from
+        the GTK main thread, so the list can be shown while it is still
+        being filled. After each page, page_callback() is called from
+        the GTK main thread. If the model is cleared in the meantime,
+        no more episodes are added.
         """
 
         self._update_progress = 0.
         self._last_redraw_progress = 0.
-        if treeview is not None:
-            util.idle_add(treeview.queue_draw)
+        generation = self._generation
 
         self._all_episodes_view = getattr(channel, 'ALL_EPISODES_PROXY', False)
 
-        episodes = channel.get_all_episodes()
-        if not isinstance(episodes, list):
-            episodes = list(episodes)
-        count = len(episodes)
-
-        for position, episode in enumerate(episodes):
-            iter = self.append()
-            self.set(iter, \
-                    self.C_URL, episode.url, \
-                    self.C_TITLE, episode.title, \
-                    self.C_FILESIZE_TEXT, self._format_filesize(episode), \
-                    self.C_EPISODE, episode, \
-                    self.C_PUBLISHED_TEXT, episode.cute_pubdate())
-            self.update_by_iter(iter, downloading, include_description, \
-                    generate_thumbnails, reload_from_db=False)
-
-            self._update_progress = float(position+1)/count
+        # The description is only needed here for the one-line
+        # summary, which is not displayed in the "All episodes" view
+        lazy = not include_description or self._all_episodes_view
+        episodes = channel.get_all_episodes(lazy=lazy)
+        if isinstance(episodes, list):
+            count = len(episodes)
+        else:
+            # Episodes are streamed from the database
+            count = channel.get_statistics()[0]
+
+        def add_page(page, position):
+            if generation != self._generation:
+                return
+
+            for episode in page:
+                iter = self.append()
+                self.set(iter, \
+                        self.C_URL, episode.url, \
+                        self.C_TITLE, episode.title, \
+                        self.C_FILESIZE_TEXT, self._format_filesize(episode), \
+                        self.C_EPISODE, episode, \
+                        self.C_PUBLISHED_TEXT, episode.cute_pubdate())
+                self.update_by_iter(iter, downloading, include_description, \
+                        generate_thumbnails, reload_from_db=False)
+
+            self._update_progress = min(1., float(position)/max(count, 1))
             if treeview is not None and \
-                    (self._update_progress > self._last_redraw_progress + self._UI_UPDATE_STEP or position+1 == count):
-                def in_gtk_main_thread():
-                    treeview.queue_draw()
-                    while gtk.events_pending():
-                        gtk.main_iteration(False)
-                util.idle_add(in_gtk_main_thread)
+                    (self._update_progress > self._last_redraw_progress + self._UI_UPDATE_STEP or position == count):
+                treeview.queue_draw()
                 self._last_redraw_progress = self._update_progress
 
+            if page_callback is not None:
+                page_callback()
+
+        page = []
+        position = 0
+        for episode in episodes:
+            if generation != self._generation:
+                return
+
+            page.append(episode)
+            position += 1
+            if len(page) == self._UI_PAGE_SIZE:
+                util.idle_add(add_page, page, position)
+                page = []
+
+        if page:
+            util.idle_add(add_page, page, position)
+
     def update_all(self, downloading=None, include_description=False, \
             generate_thumbnails=False):
         for row in self:
@@ -215,6 +254,13 @@ class EpisodeListModel(gtk.ListStore):
                 self.update_by_iter(row.iter, downloading, include_description, \
                         generate_thumbnails)
 
+    def remove_by_ids(self, ids):
+        """Remove the rows of episodes that have been deleted from the DB"""
+        ids = set(ids)
+        for row in reversed(list(self)):
+            if row[self.C_EPISODE].id in ids:
+                self.remove(row.iter)
+
     def update_by_filter_iter(self, iter, downloading=None, \
             include_description=False, generate_thumbnails=False):
         # Convenience function for use by "outside" methods that use iters
@@ -470,10 +516,20 @@ class PodcastChannelProxy(object):
         # Get the total statistics for all channels from the database
         return self._db.get_total_count()
 
-    def get_all_episodes(self):
-        """Returns a generator that yields every episode"""
+    def get_episode_pages(self, lazy=False):
+        """Returns a generator that yields lists of episodes, newest first"""
         channel_lookup_map = dict((c.id, c) for c in self.channels)
-        return self._db.load_all_episodes(channel_lookup_map)
+        if lazy:
+            columns = self._db.episode_columns(exclude=model.PodcastEpisode.LAZY_COLUMNS)
+        else:
+            columns = None
+        return self._db.iter_all_episodes(channel_lookup_map, columns=columns)
+
+    def get_all_episodes(self, lazy=False):
+        """Returns a generator that yields every episode"""
+        for page in self.get_episode_pages(lazy):
+            for episode in page:
+                yield episode
 
     def request_save_dir_size(self):
         if not self._save_dir_size_set:
@@ -506,6 +562,8 @@ class PodcastListModel(gtk.ListStore):
         self._search_term = None
         self._filter.set_visible_func(self._filter_visible_func)
 
+        self._db = None
+
         self._cover_cache = {}
         if gpodder.ui.fremantle:
             self._max_image_side = 64
@@ -641,6 +699,11 @@ class PodcastListModel(gtk.ListStore):
     def set_channels(self, db, config, channels):
         # Clear the model and update the list of podcasts
         self.clear()
+        self._db = db
+
+        # Get the statistics for all podcasts with a single query,
+        # so that get_statistics() below can use the cached values
+        db.get_all_channel_counts()
 
         if config.podcast_list_view_all:
             all_episodes = PodcastChannelProxy(db, config, channels)
@@ -701,6 +764,10 @@ class PodcastListModel(gtk.ListStore):
         self.update_by_iter(self._filter.convert_iter_to_child_iter(iter))
 
     def update_all(self):
+        # Re-query the statistics of all changed podcasts at once
+        if self._db is not None:
+            self._db.get_all_channel_counts()
+
         for row in self:
             self.update_by_iter(row.iter)
 
@@ -57,6 +57,9 @@ except ImportError:
             @staticmethod
             def method(*args, **kwargs):
                 return lambda x: x
+            @staticmethod
+            def signal(*args, **kwargs):
+                return lambda x: x
             class BusName:
                 def __init__(self, *args, **kwargs):
                     pass
@@ -66,12 +69,15 @@ except ImportError:
 
 
 from gpodder import feedcore
+from gpodder import feedupdate
+from gpodder import httppool
 from gpodder import util
 from gpodder import opml
 from gpodder import download
 from gpodder import my
 from gpodder import youtube
 from gpodder import player
+from gpodder import playlist
 from gpodder.liblogger import log
 
 _ = gpodder.gettext
@@ -417,10 +423,13 @@ class gPodder(BuilderWidget, dbus.service.Object):
             self.iconify_main_window()
 
         self.download_tasks_seen = set()
-        self.download_list_update_enabled = False
         self.last_download_count = 0
         self.download_task_monitors = set()
 
+        # The downloads list is updated when download tasks change
+        download.progress_service.register('progress-changed', \
+                self.on_download_progress_changed)
+
         # Subscribed channels
         self.active_channel = None
         self.channels = PodcastChannel.load_from_db(self.db, self.config.download_dir)
@@ -438,6 +447,10 @@ class gPodder(BuilderWidget, dbus.service.Object):
         # Set up the first instance of MygPoClient
         self.mygpo_client = my.MygPoClient(self.config)
 
+        # Refreshes single podcasts when they are due (if auto_update_feeds)
+        self.refresh_scheduler = feedupdate.RefreshScheduler()
+        self.refresh_scheduler.register('podcast-updated', self.on_podcast_refreshed)
+
         # Now, update the feed cache, when everything's in place
         if not gpodder.ui.fremantle:
             self.btnUpdateFeeds.show()
@@ -447,14 +460,12 @@ class gPodder(BuilderWidget, dbus.service.Object):
 
         self.message_area = None
 
-        def find_partial_downloads():
+        def find_unjournaled_partial_downloads():
             # Look for partial file downloads
             partial_files = glob.glob(os.path.join(self.config.download_dir, '*', '*.partial'))
             count = len(partial_files)
             resumable_episodes = []
             if count:
-                if not gpodder.ui.fremantle:
-                    util.idle_add(self.wNotebook.set_current_page, 1)
                 indicator = ProgressIndicator(_('Loading incomplete downloads'), \
                         _('Some episodes have not finished downloading in a previous session.'), \
                         False, self.main_window)
@@ -486,30 +497,44 @@ class gPodder(BuilderWidget, dbus.service.Object):
                     util.delete_file(f)
 
                 util.idle_add(indicator.on_finished)
+            return resumable_episodes
+
+        def find_partial_downloads():
+            # Unfinished downloads are recorded in the download journal
+            channel_mapping = dict((c.id, c) for c in self.channels)
+            journal = self.db.load_download_journal(channel_mapping, \
+                    download.DownloadTask.JOURNALED)
+            resumable_episodes = [episode for episode, status, offset in journal]
+
+            if self.db.download_journal_created:
+                # Partial files from versions without download journal
+                resumable_episodes.extend(find_unjournaled_partial_downloads())
+
+            if resumable_episodes:
+                log('Found %d unfinished downloads', len(resumable_episodes), sender=self)
+                if not gpodder.ui.fremantle:
+                    util.idle_add(self.wNotebook.set_current_page, 1)
 
-                if len(resumable_episodes):
-                    def offer_resuming():
-                        self.download_episode_list_paused(resumable_episodes)
-                        if not gpodder.ui.fremantle:
-                            resume_all = gtk.Button(_('Resume all'))
-                            #resume_all.set_border_width(0)
-                            def on_resume_all(button):
-                                selection = self.treeDownloads.get_selection()
-                                selection.select_all()
-                                selected_tasks, can_queue, can_cancel, can_pause, can_remove, can_force = self.downloads_list_get_selection()
-                                selection.unselect_all()
-                                self._for_each_task_set_status(selected_tasks, download.DownloadTask.QUEUED)
-                                self.message_area.hide()
-                            resume_all.connect('clicked', on_resume_all)
-
-                            self.message_area = SimpleMessageArea(_('Incomplete downloads from a previous session were found.'), (resume_all,))
-                            self.vboxDownloadStatusWidgets.pack_start(self.message_area, expand=False)
-                            self.vboxDownloadStatusWidgets.reorder_child(self.message_area, 0)
-                            self.message_area.show_all()
-                        self.clean_up_downloads(delete_partial=False)
-                    util.idle_add(offer_resuming)
-                elif not gpodder.ui.fremantle:
-                    util.idle_add(self.wNotebook.set_current_page, 0)
+                def offer_resuming():
+                    self.download_episode_list_paused(resumable_episodes)
+                    if not gpodder.ui.fremantle:
+                        resume_all = gtk.Button(_('Resume all'))
+                        #resume_all.set_border_width(0)
+                        def on_resume_all(button):
+                            selection = self.treeDownloads.get_selection()
+                            selection.select_all()
+                            selected_tasks, can_queue, can_cancel, can_pause, can_remove, can_force = self.downloads_list_get_selection()
+                            selection.unselect_all()
+                            self._for_each_task_set_status(selected_tasks, download.DownloadTask.QUEUED)
+                            self.message_area.hide()
+                        resume_all.connect('clicked', on_resume_all)
+
+                        self.message_area = SimpleMessageArea(_('Incomplete downloads from a previous session were found.'), (resume_all,))
+                        self.vboxDownloadStatusWidgets.pack_start(self.message_area, expand=False)
+                        self.vboxDownloadStatusWidgets.reorder_child(self.message_area, 0)
+                        self.message_area.show_all()
+                    self.clean_up_downloads(delete_partial=False)
+                util.idle_add(offer_resuming)
             else:
                 util.idle_add(self.clean_up_downloads, True)
         threading.Thread(target=find_partial_downloads).start()
@@ -1089,11 +1114,6 @@ class gPodder(BuilderWidget, dbus.service.Object):
 
         return False
 
-    def enable_download_list_update(self):
-        if not self.download_list_update_enabled:
-            gobject.timeout_add(1500, self.update_downloads_list)
-            self.download_list_update_enabled = True
-
     def on_btnCleanUpDownloads_clicked(self, button=None):
         model = self.download_status_model
 
@@ -1143,12 +1163,20 @@ class gPodder(BuilderWidget, dbus.service.Object):
     def remove_download_task_monitor(self, monitor):
         self.download_task_monitors.remove(monitor)
 
-    def update_downloads_list(self):
+    def on_download_progress_changed(self, snapshot):
+        self.update_downloads_list(snapshot)
+
+    def update_downloads_list(self, snapshot=None):
+        """Update the downloads list from a DownloadProgressSnapshot
+
+        Only the rows of tasks that have changed since the previous
+        snapshot are updated. Without a snapshot, all rows are updated.
+        """
         try:
             model = self.download_status_model
 
-            downloading, failed, finished, queued, paused, others = 0, 0, 0, 0, 0, 0
-            total_speed, total_size, done_size = 0, 0, 0
+            if snapshot is None:
+                snapshot = download.progress_service.get_snapshot()
 
             # Keep a list of all download tasks that we've seen
             download_tasks_seen = set()
@@ -1166,19 +1194,15 @@ class gPodder(BuilderWidget, dbus.service.Object):
             if model is None:
                 model = ()
 
-            failed_downloads = []
             for row in model:
-                self.download_status_model.request_update(row.iter)
-
                 task = row[self.download_status_model.C_TASK]
-                speed, size, status, progress = task.speed, task.total_size, task.status, task.progress
 
-                # Let the download task monitors know of changes
-                for monitor in self.download_task_monitors:
-                    monitor.task_updated(task)
+                if snapshot.changed is None or task in snapshot.changed:
+                    self.download_status_model.request_update(row.iter)
 
-                total_size += size
-                done_size += size*progress
+                    # Let the download task monitors know of changes
+                    for monitor in self.download_task_monitors:
+                        monitor.task_updated(task)
 
                 if shownotes_episode is not None and \
                         shownotes_episode.url == task.episode.url:
@@ -1186,20 +1210,14 @@ class gPodder(BuilderWidget, dbus.service.Object):
 
                 download_tasks_seen.add(task)
 
-                if status == download.DownloadTask.DOWNLOADING:
-                    downloading += 1
-                    total_speed += speed
-                elif status == download.DownloadTask.FAILED:
-                    failed_downloads.append(task)
-                    failed += 1
-                elif status == download.DownloadTask.DONE:
-                    finished += 1
-                elif status == download.DownloadTask.QUEUED:
-                    queued += 1
-                elif status == download.DownloadTask.PAUSED:
-                    paused += 1
-                else:
-                    others += 1
+            downloading = snapshot.count(download.DownloadTask.DOWNLOADING)
+            failed_downloads = snapshot.get_tasks(download.DownloadTask.FAILED)
+            failed = len(failed_downloads)
+            finished = snapshot.count(download.DownloadTask.DONE)
+            queued = snapshot.count(download.DownloadTask.QUEUED)
+            paused = snapshot.count(download.DownloadTask.PAUSED)
+            others = len(snapshot.tasks) - (downloading + failed + \
+                    finished + queued + paused)
 
             # Remember which tasks we have seen after this run
             self.download_tasks_seen = download_tasks_seen
@@ -1247,12 +1265,16 @@ class gPodder(BuilderWidget, dbus.service.Object):
             if count > 0:
                 title.append(N_('downloading %d file', 'downloading %d files', count) % count)
 
-                if total_size > 0:
-                    percentage = 100.0*done_size/total_size
+                if snapshot.total_size > 0:
+                    percentage = 100.0*snapshot.done_size/snapshot.total_size
                 else:
                     percentage = 0.0
-                total_speed = util.format_filesize(total_speed)
-                title[1] += ' (%d%%, %s/s)' % (percentage, total_speed)
+                total_speed = util.format_filesize(snapshot.total_speed)
+                details = ['%d%%' % percentage, '%s/s' % total_speed]
+                if snapshot.eta is not None:
+                    details.append(_('%s remaining') % \
+                            util.format_seconds_to_hour_min_sec(snapshot.eta))
+                title[1] += ' (%s)' % ', '.join(details)
                 if self.tray_icon is not None:
                     # Update the tray icon status and progress bar
                     self.tray_icon.set_status(self.tray_icon.STATUS_DOWNLOAD_IN_PROGRESS, title[1])
@@ -1287,17 +1309,13 @@ class gPodder(BuilderWidget, dbus.service.Object):
             self.play_or_download()
             if channel_urls:
                 self.update_podcast_list_model(channel_urls)
-
-            if not self.download_queue_manager.are_queued_or_active_tasks():
-                self.download_list_update_enabled = False
-
-            return self.download_list_update_enabled
         except Exception, e:
             log('Exception happened while updating download list.', sender=self, traceback=True)
             self.show_message('%s\n\n%s' % (_('Please report this problem and restart gPodder:'), str(e)), _('Unhandled exception'), important=True)
-            # We return False here, so the update loop won't be called again,
-            # that's why we require the restart of gPodder in the message.
-            return False
+            # We stop listening for download progress here, so the list won't
+            # be updated again, that's why we require the restart of gPodder.
+            download.progress_service.unregister('progress-changed', \
+                    self.on_download_progress_changed)
 
     def on_config_changed(self, *args):
         util.idle_add(self._on_config_changed, *args)
@@ -1473,10 +1491,12 @@ class gPodder(BuilderWidget, dbus.service.Object):
                 can_queue = False
             if task.status not in (download.DownloadTask.PAUSED, \
                     download.DownloadTask.QUEUED, \
-                    download.DownloadTask.DOWNLOADING):
+                    download.DownloadTask.DOWNLOADING, \
+                    download.DownloadTask.POSTPROCESSING):
                 can_cancel = False
             if task.status not in (download.DownloadTask.QUEUED, \
-                    download.DownloadTask.DOWNLOADING):
+                    download.DownloadTask.DOWNLOADING, \
+                    download.DownloadTask.POSTPROCESSING):
                 can_pause = False
             if task.status not in (download.DownloadTask.CANCELLED, \
                     download.DownloadTask.FAILED, \
@@ -1537,10 +1557,10 @@ class gPodder(BuilderWidget, dbus.service.Object):
                 # Only queue task when its paused/failed/cancelled (or forced)
                 if task.status in (task.PAUSED, task.FAILED, task.CANCELLED) or force_start:
                     self.download_queue_manager.add_task(task, force_start)
-                    self.enable_download_list_update()
             elif status == download.DownloadTask.CANCELLED:
                 # Cancelling a download allowed when downloading/queued
-                if task.status in (task.QUEUED, task.DOWNLOADING):
+                if task.status in (task.QUEUED, task.DOWNLOADING, \
+                        task.POSTPROCESSING):
                     task.status = status
                 # Cancelling paused downloads requires a call to .run()
                 elif task.status == task.PAUSED:
@@ -1549,11 +1569,13 @@ class gPodder(BuilderWidget, dbus.service.Object):
                     task.run()
             elif status == download.DownloadTask.PAUSED:
                 # Pausing a download only when queued/downloading
-                if task.status in (task.DOWNLOADING, task.QUEUED):
+                if task.status in (task.DOWNLOADING, task.QUEUED, \
+                        task.POSTPROCESSING):
                     task.status = status
             elif status is None:
                 # Remove the selected task - cancel downloading/queued tasks
-                if task.status in (task.QUEUED, task.DOWNLOADING):
+                if task.status in (task.QUEUED, task.DOWNLOADING, \
+                        task.POSTPROCESSING):
                     task.status = task.CANCELLED
                 model.remove(model.get_iter(row_reference.get_path()))
                 # Remember the URL, so we can tell the UI to update
@@ -1986,6 +2008,7 @@ class gPodder(BuilderWidget, dbus.service.Object):
 
         if delete_partial:
             temporary_files += glob.glob('%s/*/*.partial' % self.config.download_dir)
+            temporary_files += glob.glob('%s/*/*.partial.segments' % self.config.download_dir)
 
         for tempfile in temporary_files:
             util.delete_file(tempfile)
@@ -2258,7 +2281,7 @@ class gPodder(BuilderWidget, dbus.service.Object):
         if episode is None:
             return False
 
-        return episode.url in (task.url for task in self.download_tasks_seen if task.status in (task.DOWNLOADING, task.QUEUED, task.PAUSED))
+        return episode.url in (task.url for task in self.download_tasks_seen if task.status in (task.DOWNLOADING, task.QUEUED, task.PAUSED, task.POSTPROCESSING))
 
     def update_episode_list_model(self):
         if self.channels and self.active_channel is not None:
@@ -2269,18 +2292,24 @@ class gPodder(BuilderWidget, dbus.service.Object):
             self.episode_list_model.clear()
             self.episode_list_model.reset_update_progress()
             self.treeAvailable.set_model(self.empty_episode_list_model)
+            def on_episode_list_page_added():
+                # Show the list as soon as the first episodes are there
+                filtered_model = self.episode_list_model.get_filtered_model()
+                if self.treeAvailable.get_model() is not filtered_model:
+                    self.treeAvailable.set_model(filtered_model)
+                    self.treeAvailable.columns_autosize()
+
             def do_update_episode_list_model():
                 additional_args = (self.episode_is_downloading, \
                         self.config.episode_list_descriptions and gpodder.ui.desktop, \
                         self.config.episode_list_thumbnails and gpodder.ui.desktop, \
-                        self.treeAvailable)
+                        self.treeAvailable, on_episode_list_page_added)
                 self.episode_list_model.add_from_channel(self.active_channel, *additional_args)
 
                 def on_episode_list_model_updated():
                     if gpodder.ui.fremantle:
                         hildon.hildon_gtk_window_set_progress_indicator(self.episodes_window.main_window, False)
-                    self.treeAvailable.set_model(self.episode_list_model.get_filtered_model())
-                    self.treeAvailable.columns_autosize()
+                    on_episode_list_page_added()
                     self.currently_updating = False
                     self.play_or_download()
                 util.idle_add(on_episode_list_model_updated)
@@ -2465,6 +2494,9 @@ class gPodder(BuilderWidget, dbus.service.Object):
         self.channel_list_changed = True
         self.update_podcast_list_model(select_url=select_url_afterwards)
 
+        self.refresh_scheduler.set_podcasts(self.channels)
+        self.refresh_scheduler.resume()
+
         # Only search for new episodes in podcasts that have been
         # updated, not in other podcasts (for single-feed updates)
         episodes = self.get_new_episodes([c for c in self.channels if c.url in updated_urls])
@@ -2546,45 +2578,65 @@ class gPodder(BuilderWidget, dbus.service.Object):
     def update_feed_cache_proc(self, channels, select_url_afterwards):
         total = len(channels)
 
-        for updated, channel in enumerate(channels):
-            if not self.feed_cache_update_cancelled:
-                try:
-                    # Update if timeout is not reached or we update a single podcast or skipping is disabled
-                    if channel.query_automatic_update() or total == 1 or not self.config.feed_update_skipping:
-                        channel.update(max_episodes=self.config.max_episodes_per_feed)
-                    else:
-                        log('Skipping update of %s (see feed_update_skipping)', channel.title, sender=self)
-                    self._update_cover(channel)
-                except Exception, e:
-                    d = {'url': saxutils.escape(channel.url), 'message': saxutils.escape(str(e))}
-                    if d['message']:
-                        message = _('Error while updating %(url)s: %(message)s')
-                    else:
-                        message = _('The feed at %(url)s could not be updated.')
-                    self.notification(message % d, _('Error while updating feed'), widget=self.treeChannels)
-                    log('Error: %s', str(e), sender=self, traceback=True)
+        # Wait for a background refresh to finish (resumed when done)
+        self.refresh_scheduler.pause()
+
+        def should_update(channel):
+            # Update if timeout is not reached or we update a single podcast or skipping is disabled
+            if channel.query_automatic_update() or total == 1 or not self.config.feed_update_skipping:
+                return True
+            log('Skipping update of %s (see feed_update_skipping)', channel.title, sender=self)
+            return False
+
+        def on_error(channel, e):
+            d = {'url': saxutils.escape(channel.url), 'message': saxutils.escape(str(e))}
+            if d['message']:
+                message = _('Error while updating %(url)s: %(message)s')
+            else:
+                message = _('The feed at %(url)s could not be updated.')
+            self.notification(message % d, _('Error while updating feed'), widget=self.treeChannels)
+            log('Error: %s', str(e), sender=self)
+
+        updater = feedupdate.FeedUpdater(self.config.feed_update_workers, \
+                self.config.feed_update_connections_per_host)
+
+        def on_progress(channel, updated, total):
+            self._update_cover(channel)
 
             if self.feed_cache_update_cancelled:
-                break
+                updater.cancel()
+                return
 
             if gpodder.ui.fremantle:
                 util.idle_add(self.button_refresh.set_title, \
                         _('%(position)d/%(total)d updated') % {'position': updated, 'total': total})
-                continue
+                return
 
-            # By the time we get here the update may have already been cancelled
-            if not self.feed_cache_update_cancelled:
-                def update_progress():
-                    d = {'podcast': channel.title, 'position': updated, 'total': total}
-                    progression = _('Updated %(podcast)s (%(position)d/%(total)d)') % d
-                    self.pbFeedUpdate.set_text(progression)
-                    if self.tray_icon:
-                        self.tray_icon.set_status(self.tray_icon.STATUS_UPDATING_FEED_CACHE, progression)
-                    self.pbFeedUpdate.set_fraction(float(updated)/float(total))
-                util.idle_add(update_progress)
+            def update_progress():
+                # By the time we get here the update may have already been cancelled
+                if self.feed_cache_update_cancelled:
+                    return
+                d = {'podcast': channel.title, 'position': updated, 'total': total}
+                progression = _('Updated %(podcast)s (%(position)d/%(total)d)') % d
+                self.pbFeedUpdate.set_text(progression)
+                if self.tray_icon:
+                    self.tray_icon.set_status(self.tray_icon.STATUS_UPDATING_FEED_CACHE, progression)
+                self.pbFeedUpdate.set_fraction(float(updated)/float(total))
+            util.idle_add(update_progress)
 
-        updated_urls = [c.url for c in channels]
-        util.idle_add(self.update_feed_cache_finish_callback, updated_urls, select_url_afterwards)
+        try:
+            updater.update(channels, self.config.max_episodes_per_feed, \
+                    should_update, on_progress, on_error)
+
+            hits, misses = PodcastChannel.feed_fetcher.get_digest_statistics()
+            log('Feed content check: %d unchanged, %d parsed', hits, misses, sender=self)
+            hits, misses, evictions = httppool.connection_pool.get_statistics()
+            log('HTTP connections: %d re-used, %d opened, %d closed when idle', \
+                    hits, misses, evictions, sender=self)
+        finally:
+            # Also resumes the refresh scheduler if the update has failed
+            updated_urls = [c.url for c in channels]
+            util.idle_add(self.update_feed_cache_finish_callback, updated_urls, select_url_afterwards)
 
     def show_update_feeds_buttons(self):
         # Make sure that the buttons for updating feeds
@@ -2621,6 +2673,7 @@ class gPodder(BuilderWidget, dbus.service.Object):
             self.channels = PodcastChannel.load_from_db(self.db, self.config.download_dir)
             self.channel_list_changed = True
             self.update_podcast_list_model(select_url=select_url_afterwards)
+            self.refresh_scheduler.set_podcasts(self.channels)
             return
 
         # Fix URLs if mygpo has rewritten them
@@ -2733,9 +2786,22 @@ class gPodder(BuilderWidget, dbus.service.Object):
         if self.tray_icon is not None:
             self.tray_icon.set_visible(False)
 
+        # Stop refreshing podcasts; wait for a running refresh to
+        # finish (without blocking the UI) before closing the database
+        self.refresh_scheduler.stop()
+        self.refresh_scheduler.pause(wait=False)
+        while not self.refresh_scheduler.wait_idle(.1):
+            while gtk.events_pending():
+                gtk.main_iteration(False)
+
         # Notify all tasks to to carry out any clean-up actions
         self.download_status_model.tell_all_tasks_to_quit()
 
+        # Finish moving and tagging already downloaded files
+        download.post_download_pipeline.wait()
+        playlist.playlist_manager.flush()
+        download.progress_service.stop()
+
         while gtk.events_pending():
             gtk.main_iteration(False)
 
@@ -2952,9 +3018,8 @@ class gPodder(BuilderWidget, dbus.service.Object):
             if not episode.was_downloaded(and_exists=True):
                 task_exists = False
                 for task in self.download_tasks_seen:
-                    if episode.url == task.url and task.status not in (task.DOWNLOADING, task.QUEUED):
+                    if episode.url == task.url and task.status not in (task.DOWNLOADING, task.QUEUED, task.POSTPROCESSING):
                         self.download_queue_manager.add_task(task, force_start)
-                        self.enable_download_list_update()
                         task_exists = True
                         continue
 
@@ -2977,7 +3042,6 @@ class gPodder(BuilderWidget, dbus.service.Object):
                     self.download_queue_manager.add_task(task, force_start)
 
                 self.download_status_model.register_task(task)
-                self.enable_download_list_update()
 
         # Flush updated episode status
         self.mygpo_client.flush()
@@ -2987,7 +3051,8 @@ class gPodder(BuilderWidget, dbus.service.Object):
             return
 
         for task in tasks:
-            if task.status in (task.QUEUED, task.DOWNLOADING):
+            if task.status in (task.QUEUED, task.DOWNLOADING, \
+                    task.POSTPROCESSING):
                 task.status = task.CANCELLED
             elif task.status == task.PAUSED:
                 task.status = task.CANCELLED
@@ -3261,8 +3326,14 @@ class gPodder(BuilderWidget, dbus.service.Object):
                         # we simply select the one that comes after it
                         select_url = self.channels[position+1].url
 
-                # Remove the channel and clean the database entries
-                channel.delete()
+                # Remove the channel and clean the database entries (wait for
+                # a background refresh, so that it cannot save episodes of it)
+                self.refresh_scheduler.pause()
+                try:
+                    channel.delete()
+                finally:
+                    self.refresh_scheduler.remove_podcasts([channel])
+                    self.refresh_scheduler.resume()
                 self.channels.remove(channel)
 
             # Clean up downloads and download directories
@@ -3559,6 +3630,7 @@ class gPodder(BuilderWidget, dbus.service.Object):
             log('Removing existing auto update timer.', sender=self)
             gobject.source_remove(self._auto_update_timer_source_id)
             self._auto_update_timer_source_id = None
+        self.refresh_scheduler.stop()
 
         if self.config.auto_update_feeds and \
                 self.config.auto_update_frequency:
@@ -3568,15 +3640,49 @@ class gPodder(BuilderWidget, dbus.service.Object):
             self._auto_update_timer_source_id = gobject.timeout_add(\
                     interval, self._on_auto_update_timer)
 
+            # Each podcast is refreshed on its own when it is due
+            self.refresh_scheduler.max_episodes = self.config.max_episodes_per_feed
+            self.refresh_scheduler.min_interval = 60*self.config.auto_update_frequency
+            self.refresh_scheduler.set_podcasts(self.channels)
+            self.refresh_scheduler.start()
+
     def _on_auto_update_timer(self):
         log('Auto update timer fired.', sender=self)
-        self.update_feed_cache(force_update=True)
 
         # Ask web service for sub changes (if enabled)
         self.mygpo_client.flush()
 
         return True
 
+    def on_podcast_refreshed(self, channel, episodes, removed_ids):
+        # Called by the refresh scheduler (see restart_auto_update_timer)
+        self.db.commit()
+        self.update_podcast_list_model([channel.url])
+        self._update_cover(channel)
+
+        if removed_ids and channel is self.active_channel:
+            self.episode_list_model.remove_by_ids(removed_ids)
+
+        episodes = [e for e in episodes if not self.episode_is_downloading(e)]
+        count = len(episodes)
+        if not count:
+            return False
+
+        if channel is self.active_channel:
+            self.update_episode_list_model()
+
+        if (self.is_iconified() and self.config.auto_download == 'minimized') or \
+                self.config.auto_download == 'always':
+            self.download_episode_list(episodes)
+            title = N_('Downloading %d new episode.', 'Downloading %d new episodes.', count) % count
+        elif self.config.auto_download == 'queue':
+            self.download_episode_list_paused(episodes)
+            title = N_('%d new episode added to download list.', '%d new episodes added to download list.', count) % count
+        else:
+            title = N_('%d new episode available', '%d new episodes available', count) % count
+        self.show_message(title, _('New episodes available'), widget=self.labelDownloads)
+        return False
+
     def on_treeDownloads_row_activated(self, widget, *args):
         # Use the standard way of working on the treeview
         selection = self.treeDownloads.get_selection()
@@ -3584,13 +3690,14 @@ class gPodder(BuilderWidget, dbus.service.Object):
         selected_tasks = [(gtk.TreeRowReference(model, path), model.get_value(model.get_iter(path), 0)) for path in paths]
 
         for tree_row_reference, task in selected_tasks:
-            if task.status in (task.DOWNLOADING, task.QUEUED):
+            if task.status in (task.DOWNLOADING, task.QUEUED, \
+                    task.POSTPROCESSING):
                 task.status = task.PAUSED
             elif task.status in (task.CANCELLED, task.PAUSED, task.FAILED):
                 self.download_queue_manager.add_task(task)
-                self.enable_download_list_update()
             elif task.status == task.DONE:
                 model.remove(model.get_iter(tree_row_reference.get_path()))
+                task.removed_from_list()
                 
         self.play_or_download()
 
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+#
+# gPodder - A media aggregator and podcast client
+# Copyright (c) 2005-2010 Thomas Perl and the gPodder Team
+#
+# gPodder is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# gPodder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+#
+#  httppool.py -- Persistent HTTP connections shared by all requests
+#
+
+from __future__ import with_statement
+
+from gpodder.liblogger import log
+
+import threading
+import httplib
+import urllib2
+import urllib
+import socket
+import time
+
+
+class PooledResponse(object):
+    """A HTTP response whose connection goes back to the pool
+
+    Behaves like a file object. As soon as the response body has
+    been read completely, the connection is given back to the pool
+    so that the next request to the same host can re-use it.
+    """
+
+    # When closing a response early, read at most this many bytes of
+    # the remaining body so that the connection can still be re-used
+    DRAIN_LIMIT = 64*1024
+
+    def __init__(self, pool, key, connection, response):
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self._buffer = ''
+
+        self.status = response.status
+        self.reason = response.reason
+        self.msg = response.msg
+
+        # Responses without body (e.g. for HEAD) are complete already
+        if response.length == 0:
+            self._read(None)
+
+    def _read(self, amt):
+        if self._response is None:
+            return ''
+
+        data = self._response.read(amt)
+        if self._response.isclosed():
+            self._release()
+        return data
+
+    def _release(self):
+        response, connection = self._response, self._connection
+        self._response, self._connection = None, None
+        if response.will_close:
+            connection.close()
+        else:
+            self._pool.release(self._key, connection)
+
+    def read(self, amt=None):
+        if amt is None or amt < 0:
+            data, self._buffer = self._buffer + self._read(None), ''
+        elif self._buffer:
+            data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        else:
+            data = self._read(amt)
+        return data
+
+    def readline(self, limit=-1):
+        while '\n' not in self._buffer and self._response is not None:
+            chunk = self._read(8192)
+            if not chunk:
+                break
+            self._buffer += chunk
+
+        end = self._buffer.find('\n') + 1 or len(self._buffer)
+        if limit >= 0:
+            end = min(end, limit)
+        line, self._buffer = self._buffer[:end], self._buffer[end:]
+        return line
+
+    def readlines(self, sizehint=0):
+        return list(iter(self.readline, ''))
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def info(self):
+        return self.msg
+
+    def getheader(self, name, default=None):
+        return self.msg.getheader(name, default)
+
+    def getheaders(self):
+        return self.msg.items()
+
+    def close(self):
+        if self._response is None:
+            return
+
+        length = self._response.length
+        if length is not None and length <= self.DRAIN_LIMIT:
+            try:
+                self._read(None)
+                return
+            except (socket.error, httplib.HTTPException):
+                pass
+
+        if self._response is not None:
+            self._response.close()
+            self._connection.close()
+            self._response, self._connection = None, None
+
+
+class ConnectionPool(object):
+    """Keep-alive HTTP connections, grouped by scheme and host
+
+    Idle connections are kept for up to "idle_timeout" seconds, and
+    at most "max_idle_per_host" idle connections are kept per host.
+
+    >>> import mimetools, StringIO
+    >>> class Response(object):
+    ...     status, reason, will_close = 200, 'OK', False
+    ...     def __init__(self):
+    ...         headers = 'Content-Type: text/plain\\n\\n'
+    ...         self.msg = mimetools.Message(StringIO.StringIO(headers))
+    ...         self.length = 4
+    ...     def read(self, amt=None):
+    ...         data, self.length = 'data'[:self.length], 0
+    ...         return data
+    ...     def isclosed(self):
+    ...         return self.length == 0
+    >>> class Connection(object):
+    ...     stale = False
+    ...     def __init__(self, host, timeout=None):
+    ...         pass
+    ...     def request(self, method, selector, body, headers):
+    ...         if self.stale:
+    ...             raise socket.error('connection reset by peer')
+    ...     def getresponse(self):
+    ...         return Response()
+    ...     def close(self):
+    ...         pass
+    >>> pool = ConnectionPool(max_idle_per_host=1)
+    >>> pool.CONNECTION_CLASSES = {'http': Connection}
+
+    Connections are given back when the response has been read, and
+    the next request to the same host re-uses them:
+
+    >>> r = pool.request('http', 'example.com', 'GET', '/')
+    >>> r.getheader('content-type'), r.getheaders(), r.read()
+    ('text/plain', [('content-type', 'text/plain')], 'data')
+    >>> pool.request('http', 'Example.com', 'GET', '/').read()
+    'data'
+    >>> pool.get_statistics()
+    (1, 1, 0)
+
+    GET and HEAD requests are sent again if a re-used connection has
+    been closed by the server; other requests fail:
+
+    >>> pool._idle[('http', 'example.com')][0][0].stale = True
+    >>> pool.request('http', 'example.com', 'GET', '/').read()
+    'data'
+    >>> pool._idle[('http', 'example.com')][0][0].stale = True
+    >>> pool.request('http', 'example.com', 'POST', '/', body='x')
+    Traceback (most recent call last):
+      ...
+    error: connection reset by peer
+    >>> pool.get_statistics()
+    (3, 2, 0)
+
+    Connections above the per-host limit and connections that have been
+    idle for too long are closed:
+
+    >>> c1, reused = pool.acquire(('http', 'example.com'))
+    >>> c2, reused = pool.acquire(('http', 'example.com'))
+    >>> pool.release(('http', 'example.com'), c1)
+    >>> pool.release(('http', 'example.com'), c2)
+    >>> pool.get_statistics()
+    (3, 4, 1)
+    >>> pool.idle_timeout = -1
+    >>> pool.acquire(('http', 'example.com'))[1]
+    False
+    >>> pool.get_statistics()
+    (3, 5, 2)
+    """
+    # Only these requests can be sent again on a new connection
+    RETRY_METHODS = ('GET', 'HEAD')
+
+    CONNECTION_CLASSES = {'http': httplib.HTTPConnection}
+    if hasattr(httplib, 'HTTPSConnection'):
+        CONNECTION_CLASSES['https'] = httplib.HTTPSConnection
+
+    def __init__(self, max_idle_per_host=4, idle_timeout=30.):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+
+        self._lock = threading.Lock()
+        self._idle = {}
+
+        # Statistics (see get_statistics)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _evict(self, now):
+        for key, idle in self._idle.items():
+            for connection, since in idle[:]:
+                if now - since > self.idle_timeout:
+                    connection.close()
+                    idle.remove((connection, since))
+                    self.evictions += 1
+            if not idle:
+                del self._idle[key]
+
+    def acquire(self, key, timeout=None):
+        """Get a connection for key = (scheme, host)
+
+        Returns a tuple (connection, reused).
+        """
+        with self._lock:
+            self._evict(time.time())
+            idle = self._idle.get(key)
+            if idle:
+                connection, since = idle.pop()
+                self.hits += 1
+                return connection, True
+            self.misses += 1
+
+        scheme, host = key
+        if timeout is None or timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            return self.CONNECTION_CLASSES[scheme](host), False
+        return self.CONNECTION_CLASSES[scheme](host, timeout=timeout), False
+
+    def release(self, key, connection):
+        """Give back a connection that is ready for the next request"""
+        with self._lock:
+            now = time.time()
+            self._evict(now)
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append((connection, now))
+            else:
+                connection.close()
+                self.evictions += 1
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            for idle in self._idle.values():
+                for connection, since in idle:
+                    connection.close()
+            self._idle = {}
+
+    def get_statistics(self):
+        """Get the pool statistics as (hits, misses, evictions)
+
+        "hits" is the number of requests that re-used a connection,
+        "misses" the number of requests that needed a new connection.
+        """
+        return (self.hits, self.misses, self.evictions)
+
+    def request(self, scheme, host, method, selector, headers=None, \
+            body=None, timeout=None):
+        """Send a HTTP request using a pooled connection
+
+        Returns a PooledResponse object. If a re-used connection has
+        been closed by the server in the meantime, GET and HEAD requests
+        are sent again on a new connection (the server might have
+        carried out other requests before closing the connection).
+        """
+        key = (scheme.lower(), host.lower())
+        if headers is None:
+            headers = {}
+
+        while True:
+            connection, reused = self.acquire(key, timeout)
+            try:
+                connection.request(method, selector, body, headers)
+                response = connection.getresponse()
+            except (socket.error, httplib.HTTPException), e:
+                connection.close()
+                if reused and method.upper() in self.RETRY_METHODS:
+                    log('Stale connection to %s: %s', host, e, sender=self)
+                    continue
+                raise
+            return PooledResponse(self, key, connection, response)
+
+
+# The connection pool that is used for all HTTP requests
+connection_pool = ConnectionPool()
+
+
+class PooledHandlerMixin:
+    def _open_pooled(self, scheme, req):
+        # Tunneling HTTPS through a proxy is not supported here
+        if getattr(req, '_tunnel_host', None):
+            return None
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update((k, v) for k, v in req.headers.items() \
+                if k not in headers)
+        headers = dict((name.title(), value) for name, value in headers.items())
+
+        try:
+            r = connection_pool.request(scheme, req.get_host(), \
+                    req.get_method(), req.get_selector(), headers, \
+                    req.data, getattr(req, 'timeout', None))
+        except socket.error, err:
+            raise urllib2.URLError(err)
+
+        response = urllib.addinfourl(r, r.msg, req.get_full_url())
+        response.code = r.status
+        response.msg = r.reason
+        return response
+
+
+class PooledHTTPHandler(PooledHandlerMixin, urllib2.HTTPHandler):
+    def http_open(self, req):
+        return self._open_pooled('http', req) or \
+                urllib2.HTTPHandler.http_open(self, req)
+
+
+if hasattr(urllib2, 'HTTPSHandler'):
+    class PooledHTTPSHandler(PooledHandlerMixin, urllib2.HTTPSHandler):
+        def https_open(self, req):
+            return self._open_pooled('https', req) or \
+                    urllib2.HTTPSHandler.https_open(self, req)
+
+    HANDLER_CLASSES = (PooledHTTPHandler, PooledHTTPSHandler)
+else:
+    HANDLER_CLASSES = (PooledHTTPHandler,)
+
+
+def get_handlers():
+    """Get urllib2 handlers that send requests through the pool
+
+    The handlers replace urllib2's default HTTP(S) handlers
+    when passed to urllib2.build_opener().
+    """
+    return [cls() for cls in HANDLER_CLASSES]
+
+
+def build_opener(*handlers):
+    """Like urllib2.build_opener, but using the connection pool"""
+    return urllib2.build_opener(*(get_handlers() + list(handlers)))
@@ -27,9 +27,8 @@ import gpodder
 from gpodder import util
 from gpodder import feedcore
 from gpodder import youtube
-from gpodder import corestats
-from gpodder import config
-from gpodder import tagger
+from gpodder import httppool
+from gpodder import playlist
 
 from gpodder.liblogger import log
 
@@ -62,7 +61,7 @@ class gPodderFetcher(feedcore.Fetcher):
     def __init__(self):
         feedcore.Fetcher.__init__(self, gpodder.user_agent)
 
-    def fetch_channel(self, channel):
+    def fetch_channel(self, channel, max_episodes=0):
         etag = channel.etag
         modified = feedparser._parse_date(channel.last_modified)
         # If we have a username or password, rebuild the url with them included
@@ -73,11 +72,15 @@ class gPodderFetcher(feedcore.Fetcher):
             custom_feed = handler.handle_url(url)
             if custom_feed is not None:
                 raise CustomFeed(custom_feed)
-        self.fetch(url, etag, modified)
+        self.fetch(url, etag, modified, channel.feed_digest, max_episodes)
 
     def _resolve_url(self, url):
         return youtube.get_real_channel_url(url)
 
+    def _get_handlers(self):
+        # Re-use connections to the same host (see httppool)
+        return httppool.get_handlers()
+
     @classmethod
     def register(cls, handler):
         cls.custom_handlers.append(handler)
@@ -167,7 +170,18 @@ class PodcastChannel(PodcastModelObject):
 
         Returns: A new PodcastEpisode object
         """
-        return PodcastEpisode.create_from_dict(d, self)
+        episode = PodcastEpisode.create_from_dict(d, self)
+
+        # Columns that have not been loaded are loaded on first access
+        for column in PodcastEpisode.LAZY_COLUMNS:
+            if column not in d:
+                setattr(episode, '_'+column, None)
+
+        return episode
+
+    def record_factory(self, d, db__parameter_is_unused=None):
+        """Like episode_factory, but returns an EpisodeRecord"""
+        return EpisodeRecord(self, d)
 
     def _consume_custom_feed(self, custom_feed, max_episodes=0):
         self.title = custom_feed.get_title()
@@ -177,14 +191,14 @@ class PodcastChannel(PodcastModelObject):
         self.pubDate = time.time()
         self.save()
 
-        guids = [episode.guid for episode in self.get_all_episodes()]
+        guids = [episode.guid for episode in self.get_all_episodes(lazy=True)]
 
         # Insert newly-found episodes into the database
         custom_feed.get_new_episodes(self, guids)
 
         self.save()
 
-        self.db.purge(max_episodes, self.id)
+        return self.db.prune_episodes(self.id, max_episodes)
 
     def _consume_updated_feed(self, feed, max_episodes=0):
         self.parse_error = feed.get('bozo_exception', None)
@@ -215,25 +229,16 @@ class PodcastChannel(PodcastModelObject):
 
         self.save()
 
-        # Load all episodes to update them properly.
-        existing = self.get_all_episodes()
-
         # We can limit the maximum number of entries that gPodder will parse
         if max_episodes > 0 and len(feed.entries) > max_episodes:
             entries = feed.entries[:max_episodes]
         else:
             entries = feed.entries
 
-        # Title + PubDate hashes for existing episodes
-        existing_dupes = dict((e.duplicate_id(), e) for e in existing)
-
-        # GUID-based existing episode list
-        existing_guids = dict((e.guid, e) for e in existing)
-
         # Get most recent pubDate of all episodes
         last_pubdate = self.db.get_last_pubdate(self) or 0
 
-        # Search all entries for new episodes
+        episodes = []
         for entry in entries:
             try:
                 episode = PodcastEpisode.from_feedparser_entry(entry, self)
@@ -243,22 +248,41 @@ class PodcastChannel(PodcastModelObject):
                 log('Cannot instantiate episode: %s. Skipping.', e, sender=self, traceback=True)
                 continue
 
-            if episode is None:
-                continue
+            if episode is not None:
+                episodes.append(episode)
+
+        # Only load existing episodes that have the same GUID or the
+        # same title and pubDate (duplicate ID) as one of the entries
+        existing = self.db.load_matching_episodes(self, \
+                [e.guid for e in episodes], [e.duplicate_id for e in episodes], \
+                factory=self.episode_factory)
+
+        # Title + PubDate hashes for existing episodes
+        existing_dupes = dict((e.duplicate_id, e) for e in existing)
+
+        # GUID-based existing episode list
+        existing_guids = dict((e.guid, e) for e in existing)
+
+        episodes_to_save = []
+        new_pubdates = []
 
+        # Search all entries for new episodes
+        for episode in episodes:
             # Detect (and update) existing episode based on GUIDs
             existing_episode = existing_guids.get(episode.guid, None)
             if existing_episode:
                 existing_episode.update_from(episode)
-                existing_episode.save()
+                existing_episode.check_file_state()
+                episodes_to_save.append(existing_episode)
                 continue
 
             # Detect (and update) existing episode based on duplicate ID
-            existing_episode = existing_dupes.get(episode.duplicate_id(), None)
+            existing_episode = existing_dupes.get(episode.duplicate_id, None)
             if existing_episode:
                 if existing_episode.is_duplicate(episode):
                     existing_episode.update_from(episode)
-                    existing_episode.save()
+                    existing_episode.check_file_state()
+                    episodes_to_save.append(existing_episode)
                     continue
 
             # Workaround for bug 340: If the episode has been
@@ -268,34 +292,37 @@ class PodcastChannel(PodcastModelObject):
                 log('Episode with old date: %s', episode.title, sender=self)
                 episode.is_played = True
 
-            episode.save()
+            episode.check_file_state()
+            episodes_to_save.append(episode)
+            new_pubdates.append(episode.pubDate)
+
+        self.update_release_statistics(new_pubdates)
+
+        # Write all new and changed episodes in one go
+        self.db.save_episodes(episodes_to_save)
 
         # Remove "unreachable" episodes - episodes that have not been
         # downloaded and that the feed does not list as downloadable anymore
-        if self.id is not None:
+        # (unless the items after max_episodes have not been parsed)
+        if self.id is not None and not feed.get('truncated', False):
             seen_guids = set(e.guid for e in feed.entries if hasattr(e, 'guid'))
-            episodes_to_purge = (e for e in existing if \
-                    e.state != gpodder.STATE_DOWNLOADED and \
-                    e.guid not in seen_guids and e.guid is not None)
-            for episode in episodes_to_purge:
-                log('Episode removed from feed: %s (%s)', episode.title, \
-                        episode.guid, sender=self)
-                self.db.delete_episode_by_guid(episode.guid, self.id)
+        else:
+            seen_guids = None
 
         # This *might* cause episodes to be skipped if there were more than
         # max_episodes_per_feed items added to the feed between updates.
         # The benefit is that it prevents old episodes from apearing as new
         # in certain situations (see bug #340).
-        self.db.purge(max_episodes, self.id)
+        return self.db.prune_episodes(self.id, max_episodes, seen_guids)
 
     def update_channel_lock(self):
         self.db.update_channel_lock(self)
 
     def _update_etag_modified(self, feed):
         self.updated_timestamp = time.time()
-        self.calculate_publish_behaviour()
         self.etag = feed.headers.get('etag', self.etag)
         self.last_modified = feed.headers.get('last-modified', self.last_modified)
+        self.feed_digest = feed.get('digest', self.feed_digest)
 
     def query_automatic_update(self):
         """Query if this channel should be updated automatically
@@ -314,46 +341,76 @@ class PodcastChannel(PodcastModelObject):
         return updated < one_day_ago or \
                 (expected < now and updated < lastcheck)
 
-    def update(self, max_episodes=0):
+    def fetch(self, max_episodes=0):
+        """Download and parse the feed of this channel
+
+        This only does network I/O and parsing, but does not touch
+        the database, so it can be called from any thread. Returns
+        the result of the fetch operation (one of the successful
+        feedcore exceptions or CustomFeed) for use with consume().
+        Errors are raised as exceptions (see update() below).
+
+        If "max_episodes" is greater than zero, parsing of the feed
+        stops after the first "max_episodes" episodes.
+        """
         try:
-            self.feed_fetcher.fetch_channel(self)
-        except CustomFeed, updated:
-            custom_feed = updated.data
-            self._consume_custom_feed(custom_feed, max_episodes)
+            self.feed_fetcher.fetch_channel(self, max_episodes)
+        except (CustomFeed, feedcore.UpdatedFeed, feedcore.NewLocation, \
+                feedcore.NotModified), result:
+            return result
+
+    def consume(self, result, max_episodes=0):
+        """Merge the result of fetch() into the database
+
+        Returns the list of IDs of the episodes that have been
+        removed from the database (see Database.prune_episodes).
+        """
+        removed_ids = []
+        if isinstance(result, CustomFeed):
+            custom_feed = result.data
+            removed_ids = self._consume_custom_feed(custom_feed, max_episodes)
             self.save()
-        except feedcore.UpdatedFeed, updated:
-            feed = updated.data
-            self._consume_updated_feed(feed, max_episodes)
+        elif isinstance(result, feedcore.UpdatedFeed):
+            feed = result.data
+            removed_ids = self._consume_updated_feed(feed, max_episodes)
             self._update_etag_modified(feed)
             self.save()
-        except feedcore.NewLocation, updated:
-            feed = updated.data
+        elif isinstance(result, feedcore.NewLocation):
+            feed = result.data
             self.url = feed.href
-            self._consume_updated_feed(feed, max_episodes)
+            removed_ids = self._consume_updated_feed(feed, max_episodes)
             self._update_etag_modified(feed)
             self.save()
-        except feedcore.NotModified, updated:
-            feed = updated.data
+        elif isinstance(result, feedcore.NotModified):
+            feed = result.data
+            if feed.get('status', None) == 301:
+                # Unchanged content, but the feed has been moved
+                self.url = feed.href
             self._update_etag_modified(feed)
             self.save()
-        except Exception, e:
-            # "Not really" errors
-            #feedcore.AuthenticationRequired
-            # Temporary errors
-            #feedcore.Offline
-            #feedcore.BadRequest
-            #feedcore.InternalServerError
-            #feedcore.WifiLogin
-            # Permanent errors
-            #feedcore.Unsubscribe
-            #feedcore.NotFound
-            #feedcore.InvalidFeed
-            #feedcore.UnknownStatusCode
-            raise
 
         self.db.commit()
+        return removed_ids
+
+    def update(self, max_episodes=0):
+        # Errors raised by fetch() are passed on to the caller:
+        #
+        # "Not really" errors
+        #feedcore.AuthenticationRequired
+        # Temporary errors
+        #feedcore.Offline
+        #feedcore.BadRequest
+        #feedcore.InternalServerError
+        #feedcore.WifiLogin
+        # Permanent errors
+        #feedcore.Unsubscribe
+        #feedcore.NotFound
+        #feedcore.InvalidFeed
+        #feedcore.UnknownStatusCode
+        return self.consume(self.fetch(max_episodes), max_episodes)
 
     def delete(self):
+        playlist.playlist_manager.forget(self)
         self.db.delete_channel(self)
 
     def save(self):
@@ -393,6 +450,7 @@ class PodcastChannel(PodcastModelObject):
 
         self.last_modified = None
         self.etag = None
+        self.feed_digest = None
 
         self.save_dir_size = 0
         self.__save_dir_size_set = False
@@ -403,24 +461,69 @@ class PodcastChannel(PodcastModelObject):
         self.release_deviation = 0
         self.updated_timestamp = 0
 
-    def calculate_publish_behaviour(self):
-        episodes = self.db.load_episodes(self, factory=self.episode_factory, limit=30)
-        if len(episodes) < 3:
+        # Statistics of the intervals between releases (see
+        # update_release_statistics); None if not calculated yet
+        self.release_count = None
+        self.release_mean = None
+        self.release_m2 = None
+        self.release_min = None
+        self.release_latest = None
+
+    def _add_release_interval(self, interval):
+        # Welford's algorithm for the running mean and variance
+        self.release_count += 1
+        delta = interval - self.release_mean
+        self.release_mean += delta/self.release_count
+        self.release_m2 += delta*(interval - self.release_mean)
+        if self.release_min is None or interval < self.release_min:
+            self.release_min = interval
+
+    def _add_release_dates(self, pubdates):
+        for pubdate in sorted(pubdates):
+            if not pubdate or pubdate < self.release_latest:
+                continue
+            if self.release_latest:
+                self._add_release_interval(pubdate - self.release_latest)
+            self.release_latest = pubdate
+
+    def update_release_statistics(self, pubdates):
+        """Add the release dates of new episodes to the statistics
+
+        The intervals between releases are kept as count, mean, sum of
+        squared differences from the mean and minimum, so they can be
+        updated without loading any episodes. Release dates before the
+        latest known release are ignored. The first time, the statistics
+        are initialized from the release dates of the 30 newest episodes.
+        """
+        if not pubdates:
             return
 
-        deltas = []
-        latest = max(e.pubDate for e in episodes)
-        for index in range(len(episodes)-1):
-            if episodes[index].pubDate != 0 and episodes[index+1].pubDate != 0:
-                deltas.append(episodes[index].pubDate - episodes[index+1].pubDate)
+        if self.release_latest is None:
+            self.release_count, self.release_mean, self.release_m2 = 0, 0., 0.
+            self.release_min = None
+            self.release_latest = 0
+            if self.id is not None:
+                self._add_release_dates(self.db.load_episodes(self, \
+                        factory=lambda d, db: d['pubDate'], limit=30, \
+                        columns=('pubDate',)))
 
-        if len(deltas) > 1:
-            stats = corestats.Stats(deltas)
-            self.release_expected = min([latest+stats.stdev(), latest+(stats.min()+stats.avg())*.5])
-            self.release_deviation = stats.stdev()
-        else:
+        self._add_release_dates(pubdates)
+        self.calculate_publish_behaviour()
+
+    def calculate_publish_behaviour(self):
+        if not self.release_count:
+            return
+
+        latest = self.release_latest
+        if self.release_count == 1:
             self.release_expected = latest
             self.release_deviation = 0
+            return
+
+        deviation = (self.release_m2/(self.release_count-1))**.5
+        self.release_expected = min([latest+deviation, \
+                latest+(self.release_min+self.release_mean)*.5])
+        self.release_deviation = deviation
 
     def request_save_dir_size(self):
         if not self.__save_dir_size_set:
@@ -508,46 +611,37 @@ class PodcastChannel(PodcastModelObject):
         return self.save_dir+'.m3u'
 
     def update_m3u_playlist(self):
-        m3u_filename = self.get_playlist_filename()
-
-        downloaded_episodes = self.get_downloaded_episodes()
-        if not downloaded_episodes:
-            log('No episodes - removing %s', m3u_filename, sender=self)
-            util.delete_file(m3u_filename)
-            return
+        """Re-create the playlist from the database and write it now
 
-        log('Writing playlist to %s', m3u_filename, sender=self)
-        f = open(m3u_filename, 'w')
-        f.write('#EXTM3U\n')
-
-        for episode in PodcastEpisode.sort_by_pubdate(downloaded_episodes):
-            if episode.was_downloaded(and_exists=True):
-                filename = episode.local_filename(create=False)
-                assert filename is not None
-
-                if os.path.dirname(filename).startswith(os.path.dirname(m3u_filename)):
-                    filename = filename[len(os.path.dirname(m3u_filename)+os.sep):]
-                f.write('#EXTINF:0,'+self.title+' - '+episode.title+' ('+episode.cute_pubdate()+')\n')
-                f.write(filename+'\n')
+        Downloads and deletions update the playlist incrementally
+        (see playlist.PlaylistManager), so this is only needed when
+        the files have been changed outside of gPodder.
+        """
+        playlist.playlist_manager.rebuild(self)
 
-        f.close()
+    def get_all_episodes(self, lazy=False):
+        """Get all episodes of this podcast
 
-    def addDownloadedItem(self, item):
-        log('addDownloadedItem(%s)', item.url)
+        If "lazy" is True, the columns in PodcastEpisode.LAZY_COLUMNS
+        are not loaded now, but on first access of each episode.
+        """
+        if lazy:
+            columns = self.db.episode_columns(exclude=PodcastEpisode.LAZY_COLUMNS)
+        else:
+            columns = None
+        return self.db.load_episodes(self, factory=self.episode_factory, columns=columns)
 
-        if not item.was_downloaded():
-            item.mark_downloaded(save=True)
-            self.update_m3u_playlist()
-        if gpodder.config.Config().update_tags:
-        # object.__new__() complains about only taking one argument if the
-        # config object is passed to the tagger's constructor.
-        # So, get that going separately 
-            t = tagger.Tagger()
-            t.config = gpodder.config.Config()
-            t.update_tag(item)
+    def get_episode_records(self, lazy=True):
+        """Get all episodes of this podcast as EpisodeRecord objects
 
-    def get_all_episodes(self):
-        return self.db.load_episodes(self, factory=self.episode_factory)
+        This uses less memory than get_all_episodes(), but the
+        records are read-only (see EpisodeRecord.get_episode).
+        """
+        if lazy:
+            columns = self.db.episode_columns(exclude=PodcastEpisode.LAZY_COLUMNS)
+        else:
+            columns = None
+        return self.db.load_episodes(self, factory=self.record_factory, columns=columns)
 
     def find_unique_folder_name(self, foldername):
         # Remove trailing dots to avoid errors on Windows (bug 600)
@@ -642,12 +736,29 @@ class PodcastChannel(PodcastModelObject):
             util.delete_file(filename)
 
         episode.set_state(gpodder.STATE_DELETED)
+        playlist.playlist_manager.episode_deleted(episode)
 
 
 class PodcastEpisode(PodcastModelObject):
     """holds data for one object in a channel"""
     MAX_FILENAME_LENGTH = 200
 
+    # Big columns that are not needed to display the episode list;
+    # they are loaded from the database when they are first accessed
+    LAZY_COLUMNS = ('description',)
+
+    def _get_description(self):
+        if self._description is None:
+            if self.id is not None:
+                self._description = self.db.load_episode_value(self.id, 'description')
+            self._description = self._description or ''
+        return self._description
+
+    def _set_description(self, description):
+        self._description = description
+
+    description = property(fget=_get_description, fset=_set_description)
+
     def _get_played(self):
         return self.is_played
 
@@ -793,7 +904,7 @@ class PodcastEpisode(PodcastModelObject):
         self.length = 0
         self.mimetype = 'application/octet-stream'
         self.guid = ''
-        self.description = ''
+        self._description = ''
         self.link = ''
         self.channel = channel
         self.pubDate = 0
@@ -812,6 +923,12 @@ class PodcastEpisode(PodcastModelObject):
         self.current_position = 0
         self.current_position_updated = time.time()
 
+        # Fingerprint of the tags written to the file (see tagger.py)
+        self.tag_fingerprint = None
+
+        # SHA-1 of the downloaded file (if dedup_downloads is enabled)
+        self.digest = None
+
     def get_is_locked(self):
         return self._is_locked
 
@@ -820,15 +937,21 @@ class PodcastEpisode(PodcastModelObject):
 
     is_locked = property(fget=get_is_locked, fset=set_is_locked)
 
-    def save(self):
+    def check_file_state(self):
+        """Mark the episode as downloaded if its file exists"""
         if self.state != gpodder.STATE_DOWNLOADED and self.file_exists():
             self.state = gpodder.STATE_DOWNLOADED
+
+    def save(self):
+        self.check_file_state()
         self.db.save_episode(self)
 
-    def on_downloaded(self, filename):
+    def on_downloaded(self, filename, digest=None):
         self.state = gpodder.STATE_DOWNLOADED
         self.is_played = False
         self.length = os.path.getsize(filename)
+        self.tag_fingerprint = None
+        self.digest = digest
         self.db.save_downloaded_episode(self)
         self.db.commit()
 
@@ -1156,15 +1279,91 @@ class PodcastEpisode(PodcastModelObject):
     played_prop = property(fget=get_played_string)
 
     def is_duplicate(self, episode):
-        if self.title == episode.title and self.pubDate == episode.pubDate:
+        # Compare the duplicate IDs, which do not depend on whether
+        # the title is a byte string (from the DB) or unicode string
+        if self.duplicate_id == episode.duplicate_id:
             log('Possible duplicate detected: %s', self.title)
             return True
         return False
 
-    def duplicate_id(self):
-        return hash((self.title, self.pubDate))
+    def _get_duplicate_id(self):
+        return util.duplicate_id(self.title, self.pubDate)
+
+    def _set_duplicate_id(self, duplicate_id):
+        # The ID is always calculated from the title and pubDate
+        pass
+
+    # Accessor for the "duplicate_id" DB column
+    duplicate_id = property(fget=_get_duplicate_id, fset=_set_duplicate_id)
 
     def update_from(self, episode):
         for k in ('title', 'url', 'description', 'link', 'pubDate', 'guid'):
             setattr(self, k, getattr(episode, k))
 
+
+
+class EpisodeRecord(object):
+    """Compact, read-only representation of an episode
+
+    Used instead of PodcastEpisode for listing large numbers of
+    episodes. The values of the database columns are stored in
+    slots, the description is loaded on first access and the
+    methods that only read the episode are shared with PodcastEpisode.
+
+    The record is a snapshot of the database row and must not be
+    modified; use get_episode() to get a PodcastEpisode for that.
+    """
+    COLUMNS = ('id', 'channel_id', 'url', 'title', 'length', 'mimetype', \
+            'guid', 'link', 'pubDate', 'state', 'filename', 'auto_filename', \
+            'total_time', 'current_position', 'current_position_updated', \
+            'tag_fingerprint', 'digest')
+
+    __slots__ = COLUMNS + ('is_played', 'is_locked', '_description', \
+            'channel', '_episode')
+
+    def __init__(self, channel, d):
+        self.channel = channel
+        self._episode = None
+        for column in self.COLUMNS:
+            setattr(self, column, d.get(column))
+        self.is_played = bool(d.get('played'))
+        self.is_locked = bool(d.get('locked'))
+        self._description = d.get('description')
+
+    @property
+    def db(self):
+        return self.channel.db
+
+    def get_episode(self):
+        """Get the PodcastEpisode object for this episode
+
+        The object is created on the first call and then re-used.
+        """
+        if self._episode is None:
+            d = dict((column, getattr(self, column)) for column in self.COLUMNS)
+            d['played'] = self.is_played
+            d['locked'] = self.is_locked
+            if self._description is not None:
+                d['description'] = self._description
+            self._episode = self.channel.episode_factory(d)
+        return self._episode
+
+    def local_filename(self, create, force_update=False, check_only=False,
+            template=None):
+        # Only the read-only case is handled here; generating or
+        # recovering a filename changes the episode (see PodcastEpisode)
+        if not create and not force_update and self.filename is not None:
+            return os.path.join(self.channel.save_dir, self.filename)
+
+        return self.get_episode().local_filename(create, force_update, \
+                check_only, template)
+
+for name in ('description', 'played', 'locked', 'has_website_link', \
+        'title_markup', 'age_in_days', 'get_age_string', 'age_prop', \
+        'one_line_description', 'extension', 'check_is_new', 'file_exists', \
+        'was_downloaded', 'sync_filename', 'file_type', 'basename', \
+        'published', 'pubtime', 'cute_pubdate', 'pubdate_prop', \
+        'get_filesize_string', 'filesize_prop', 'get_played_string', \
+        'played_prop', 'is_duplicate', 'duplicate_id'):
+    setattr(EpisodeRecord, name, PodcastEpisode.__dict__[name])
+del name
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+#
+# gPodder - A media aggregator and podcast client
+# Copyright (c) 2005-2010 Thomas Perl and the gPodder Team
+#
+# gPodder is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# gPodder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+#
+#  playlist.py -- Incrementally maintained m3u playlists of podcasts
+#
+
+from __future__ import with_statement
+
+import gpodder
+from gpodder import util
+from gpodder.liblogger import log
+
+import threading
+import atexit
+import shutil
+import os
+
+
+def _encode(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s or ''
+
+
+class ChannelPlaylist(object):
+    """The m3u playlist of a podcast, kept in memory
+
+    The downloaded episodes are read from the database (and checked
+    for existence on disk) once. After that, the playlist is only
+    changed with add() and remove().
+    """
+    def __init__(self, channel):
+        self.channel = channel
+        self._entries = {}
+        for episode in channel.get_downloaded_episodes():
+            if episode.was_downloaded(and_exists=True):
+                self.add(episode)
+
+    def add(self, episode):
+        filename = episode.local_filename(create=False)
+        if filename is not None:
+            self._entries[episode.id] = (episode.pubDate, \
+                    _encode(episode.title), _encode(episode.cute_pubdate()), \
+                    _encode(os.path.basename(filename)))
+
+    def remove(self, episode):
+        self._entries.pop(episode.id, None)
+
+    def get_lines(self):
+        # The episodes are in the podcast's folder next to the playlist
+        folder = _encode(os.path.basename(self.channel.save_dir))
+        title = _encode(self.channel.title)
+
+        lines = ['#EXTM3U']
+        for pubdate, episode_title, cute_pubdate, filename in \
+                sorted(self._entries.itervalues()):
+            lines.append('#EXTINF:0,%s - %s (%s)' % (title, episode_title, \
+                    cute_pubdate))
+            lines.append(os.path.join(folder, filename))
+        return lines
+
+    def write(self):
+        """Write the playlist file (atomically), or remove it if empty"""
+        m3u_filename = self.channel.get_playlist_filename()
+
+        if not self._entries:
+            log('No episodes - removing %s', m3u_filename, sender=self)
+            util.delete_file(m3u_filename)
+            return
+
+        log('Writing playlist to %s', m3u_filename, sender=self)
+        fp = open(m3u_filename+'.tmp', 'w')
+        fp.write('\n'.join(self.get_lines())+'\n')
+        fp.close()
+        if gpodder.win32:
+            # Win32 does not support atomic rename with os.rename
+            shutil.move(m3u_filename+'.tmp', m3u_filename)
+        else:
+            os.rename(m3u_filename+'.tmp', m3u_filename)
+
+
+class PlaylistManager(object):
+    """Keeps the playlists of all podcasts up to date
+
+    Downloaded and deleted episodes are added to and removed from the
+    in-memory playlist of their podcast. Changed playlists are written
+    "delay" seconds after the first change (so a burst of downloads
+    causes a single write) or when flush() is called.
+    """
+    def __init__(self, delay=10.):
+        self.delay = delay
+        self._lock = threading.RLock()
+        self._playlists = {}
+        self._dirty = set()
+        self._timer = None
+
+    def _get_playlist(self, channel):
+        playlist = self._playlists.get(channel.id)
+        if playlist is None:
+            playlist = ChannelPlaylist(channel)
+            self._playlists[channel.id] = playlist
+        else:
+            playlist.channel = channel
+        return playlist
+
+    def _mark_dirty(self, channel):
+        self._dirty.add(channel.id)
+        if self._timer is None:
+            self._timer = threading.Timer(self.delay, self.flush)
+            self._timer.setDaemon(True)
+            self._timer.start()
+
+    def episode_downloaded(self, episode):
+        with self._lock:
+            self._get_playlist(episode.channel).add(episode)
+            self._mark_dirty(episode.channel)
+
+    def episode_deleted(self, episode):
+        with self._lock:
+            self._get_playlist(episode.channel).remove(episode)
+            self._mark_dirty(episode.channel)
+
+    def rebuild(self, channel):
+        """Re-read the playlist of a podcast and write it right now"""
+        with self._lock:
+            playlist = ChannelPlaylist(channel)
+            self._playlists[channel.id] = playlist
+            self._dirty.discard(channel.id)
+            playlist.write()
+
+    def forget(self, channel):
+        """Drop the playlist of a podcast (e.g. after unsubscribing)"""
+        with self._lock:
+            self._playlists.pop(channel.id, None)
+            self._dirty.discard(channel.id)
+
+    def flush(self):
+        """Write all changed playlists now"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+            dirty, self._dirty = self._dirty, set()
+            for channel_id in dirty:
+                try:
+                    self._playlists[channel_id].write()
+                except Exception, e:
+                    log('Cannot write playlist: %s', e, sender=self, \
+                            traceback=True)
+
+
+# The playlists of all podcasts; pending changes are written on exit
+playlist_manager = PlaylistManager()
+atexit.register(playlist_manager.flush)
+
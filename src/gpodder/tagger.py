@@ -22,10 +22,108 @@
 
 
 from gpodder.liblogger import log
+from gpodder import services
 
+try:
+    import multiprocessing
+except ImportError:
+    # Python 2.5 - re-tag all files in this process
+    multiprocessing = None
 
+import os
+import shutil
+import hashlib
 import tagpy
 
+
+# The tags that are set from the tag_* settings in the config
+TAGS = ('title', 'album', 'genre')
+
+def _unicode(s):
+    if isinstance(s, str):
+        return s.decode('utf-8', 'replace')
+    return s or u''
+
+def get_tag_values(config, episode):
+    """Get the tags that an episode's file should have
+
+    Returns a dict that maps each tag in TAGS to a unicode string.
+    """
+    tagvalues = {'channel.title': None,'episode.title':None,'artist':None}
+    tagvalues['channel.title'] = episode.channel.title
+    tagvalues['episode.title'] = episode.title
+    #tagvalues['artist'] =  #Figure this out too
+
+    return {
+            'title': _unicode(config.tag_title % tagvalues),
+            'album': _unicode(config.tag_album % tagvalues),
+            'genre': _unicode(config.tag_genre % tagvalues),
+    }
+
+def get_fingerprint(values):
+    """Get a short string that identifies a set of tag values
+
+    >>> values = {'title': u'Episode', 'album': u'Podcast', 'genre': u'Talk'}
+    >>> fingerprint = get_fingerprint(values)
+    >>> len(fingerprint)
+    32
+    >>> get_fingerprint(dict(values)) == fingerprint
+    True
+    >>> get_fingerprint(dict(values, genre=u'Music')) == fingerprint
+    False
+    >>> get_fingerprint(dict(values, title=u'\xc4pisode')) == fingerprint
+    False
+    """
+    data = u'\0'.join(u'%s=%s' % (tag, values[tag]) for tag in TAGS)
+    return hashlib.md5(data.encode('utf-8')).hexdigest()
+
+def break_link(filename):
+    """Give a hard-linked file a copy of the data of its own
+
+    Downloads of the same file are hard-linked (dedup_downloads), so
+    writing tags in place would change the file of every episode.
+    Returns True if the file was linked.
+    """
+    if os.stat(filename).st_nlink < 2:
+        return False
+
+    tempname = filename + '.tagging'
+    try:
+        shutil.copy2(filename, tempname)
+        os.rename(tempname, filename)
+    except:
+        if os.path.exists(tempname):
+            os.remove(tempname)
+        raise
+    return True
+
+def write_tags(filename, values):
+    """Set the tags of a file to the given values
+
+    The file is only saved if at least one tag has a different value.
+    Returns True if the file has been changed. Raises ValueError if
+    the file cannot be read.
+    """
+    if isinstance(filename, unicode):
+        filename = filename.encode('utf-8')
+    fileref = tagpy.FileRef(filename)
+    tag = fileref.tag()
+
+    changed = [name for name in TAGS if getattr(tag, name) != values[name]]
+    if not changed:
+        return False
+
+    if break_link(filename):
+        log('Copied hard-linked file before tagging: %s', filename)
+        fileref = tagpy.FileRef(filename)
+        tag = fileref.tag()
+
+    for name in changed:
+        setattr(tag, name, values[name])
+    fileref.save()
+    return True
+
+
 class Tagger(object):
     """This class accepts a path to a file and updates the tags for it based 
     on the attributes of the file (name of podcast, episode number, etc) and 
@@ -40,26 +138,146 @@ class Tagger(object):
         if filename is None:
             log('Cannot update tag of non-existing file')
             return False
+
+        values = get_tag_values(self.config, episode)
         try: 
-            fileref = tagpy.FileRef(filename.encode('utf-8'))
-            tag = fileref.tag()
+            write_tags(filename, values)
         except ValueError:
             log('Unable to read tag')
             return False
 
-        self.artist = self.config.tag_artist
-        self.album = self.config.tag_album
-        self.genre = self.config.tag_genre
-        self.title = self.config.tag_title
-        tagvalues = {'channel.title': None,'episode.title':None,'artist':None}
-        tagvalues['channel.title'] = episode.channel.title
-        tagvalues['episode.title'] = episode.title
-        #tagvalues['artist'] =  #Figure this out too
-
-
-        tag.title = self.title % tagvalues
-        tag.genre = self.genre % tagvalues
-        tag.album = self.album % tagvalues
-        #tag.artist = self.artist % tagvalues # Don't know what to use for this yet
-        fileref.save()
+        episode.tag_fingerprint = get_fingerprint(values)
+        episode.db.save_tag_fingerprints([(episode.id, episode.tag_fingerprint)])
+        episode.db.commit()
         return True
+
+
+def _retag_file(job):
+    # Carried out by the worker processes of BatchTagger
+    id, filename, values = job
+    try:
+        if write_tags(filename, values):
+            return (id, BatchTagger.CHANGED)
+        return (id, BatchTagger.UNCHANGED)
+    except Exception, e:
+        log('Cannot update tags of %s: %s', filename, e)
+        return (id, BatchTagger.FAILED)
+
+
+class BatchTagger(services.ObservableService):
+    """Updates the tags of many episodes using a pool of processes
+
+    Episodes whose tag fingerprint in the database matches the current
+    tag settings are skipped without opening the file. The other files
+    are only written if their tags differ from the settings.
+
+    Observers of "progress" get (position, total) for each file that
+    has been checked; observers of "finished" get the results (see
+    retag).
+    """
+    (CHANGED, UNCHANGED, SKIPPED, FAILED) = range(4)
+
+    def __init__(self, config, processes=None):
+        services.ObservableService.__init__(self, ['progress', 'finished'])
+        self.config = config
+        self.processes = processes
+
+    def _map(self, jobs):
+        if multiprocessing is None or self.processes == 1 or len(jobs) < 2:
+            for job in jobs:
+                yield _retag_file(job)
+            return
+
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            for result in pool.imap_unordered(_retag_file, jobs, 4):
+                yield result
+        finally:
+            pool.terminate()
+
+    def retag(self, episodes, force=False):
+        """Update the tags of all downloaded episodes in "episodes"
+
+        If "force" is True, the stored fingerprints are ignored and
+        every file is checked. Returns a dict that maps CHANGED,
+        UNCHANGED, SKIPPED and FAILED to the number of episodes.
+
+        >>> from minimock import mock, Mock, restore
+        >>> import gpodder.tagger
+        >>> config = Mock('config', tracker=None)
+        >>> config.tag_title = '%(episode.title)s'
+        >>> config.tag_album = '%(channel.title)s'
+        >>> config.tag_genre = 'Podcast'
+        >>> saved = []
+        >>> db = Mock('db', tracker=None)
+        >>> db.save_tag_fingerprints = saved.extend
+        >>> def episode(id, title, downloaded=True):
+        ...     e = Mock('episode', tracker=None, id=id, title=title, db=db)
+        ...     e.channel = Mock('channel', tracker=None, title='Channel')
+        ...     e.was_downloaded = lambda and_exists: downloaded
+        ...     e.local_filename = lambda create: '/podcasts/%d.mp3' % id
+        ...     e.tag_fingerprint = None
+        ...     return e
+        >>> episodes = [episode(1, 'One'), episode(2, 'Two'), \\
+        ...         episode(3, 'Three'), episode(4, 'Four', False)]
+        >>> episodes[0].tag_fingerprint = get_fingerprint( \\
+        ...         get_tag_values(config, episodes[0]))
+        >>> mock('gpodder.tagger.write_tags', \\
+        ...         returns_func=lambda filename, values: '2' in filename)
+        >>> r = BatchTagger(config, processes=1).retag(episodes)
+        Called gpodder.tagger.write_tags(
+            '/podcasts/2.mp3',
+            {'album': u'Channel', 'genre': u'Podcast', 'title': u'Two'})
+        Called gpodder.tagger.write_tags(
+            '/podcasts/3.mp3',
+            {'album': u'Channel', 'genre': u'Podcast', 'title': u'Three'})
+        >>> r == {BatchTagger.CHANGED: 1, BatchTagger.UNCHANGED: 1, \\
+        ...         BatchTagger.SKIPPED: 1, BatchTagger.FAILED: 0}
+        True
+        >>> [id for id, fingerprint in saved]
+        [2, 3]
+        >>> saved[0][1] == get_fingerprint(get_tag_values(config, episodes[1]))
+        True
+        >>> r = BatchTagger(config, processes=1).retag(episodes[:1], force=True)
+        Called gpodder.tagger.write_tags(
+            '/podcasts/1.mp3',
+            {'album': u'Channel', 'genre': u'Podcast', 'title': u'One'})
+        >>> [id for id, fingerprint in saved]
+        [2, 3, 1]
+        >>> restore()
+        """
+        results = dict.fromkeys((self.CHANGED, self.UNCHANGED, \
+                self.SKIPPED, self.FAILED), 0)
+        jobs, fingerprints, db = [], {}, None
+
+        for episode in episodes:
+            if not episode.was_downloaded(and_exists=True):
+                continue
+
+            values = get_tag_values(self.config, episode)
+            fingerprint = get_fingerprint(values)
+            if fingerprint == episode.tag_fingerprint and not force:
+                results[self.SKIPPED] += 1
+                continue
+
+            jobs.append((episode.id, episode.local_filename(create=False), values))
+            fingerprints[episode.id] = fingerprint
+            db = episode.db
+
+        total = len(jobs)
+        self.notify('progress', 0, total)
+
+        done = []
+        for position, (id, result) in enumerate(self._map(jobs)):
+            results[result] += 1
+            if result != self.FAILED:
+                done.append((id, fingerprints[id]))
+            self.notify('progress', position+1, total)
+
+        if done:
+            db.save_tag_fingerprints(done)
+            db.commit()
+
+        self.notify('finished', results)
+        return results
+
@@ -31,6 +31,7 @@ are not tied to any specific part of gPodder.
 
 import gpodder
 from gpodder.liblogger import log
+from gpodder import httppool
 
 import os
 import os.path
@@ -48,6 +49,7 @@ import locale
 import gzip
 import datetime
 import threading
+import hashlib
 
 import urlparse
 import urllib
@@ -247,12 +249,15 @@ def directory_is_writable( path):
     return os.path.isdir( path) and os.access( path, os.W_OK)
 
 
-def calculate_size( path):
+def calculate_size( path, seen=None):
     """
     Tries to calculate the size of a directory, including any 
     subdirectories found. The returned value might not be 
     correct if the user doesn't have appropriate permissions 
     to list all subdirectories of the given path.
+
+    Files with several hard links in the directory are only
+    counted once ("seen" is used internally to track them).
     """
     if path is None:
         return 0L
@@ -261,15 +266,22 @@ def calculate_size( path):
         return 0L
 
     if os.path.isfile( path):
-        return os.path.getsize( path)
+        st = os.stat(path)
+        if seen is not None and st.st_nlink > 1:
+            if (st.st_dev, st.st_ino) in seen:
+                return 0L
+            seen.add((st.st_dev, st.st_ino))
+        return st.st_size
 
     if os.path.isdir( path) and not os.path.islink( path):
         sum = os.path.getsize( path)
+        if seen is None:
+            seen = set()
 
         try:
             for item in os.listdir(path):
                 try:
-                    sum += calculate_size(os.path.join(path, item))
+                    sum += calculate_size(os.path.join(path, item), seen)
                 except:
                     log('Cannot get size for %s', path)
         except:
@@ -715,6 +727,35 @@ def get_first_line( s):
     return s.strip().split('\n')[0].strip()
 
 
+def duplicate_id(title, pubdate):
+    """
+    Returns an ID for detecting duplicate episodes (episodes
+    with the same title and publication date). The ID is the
+    same for str and unicode titles and does not change between
+    gPodder runs, so it can be stored in the database.
+
+    >>> duplicate_id(u'T\xe4st', 1262300400) == duplicate_id('T\xc3\xa4st', 1262300400.0)
+    True
+    >>> duplicate_id('Test', 1262300400) == duplicate_id('Test', 1262304000)
+    False
+    >>> duplicate_id(None, None)
+    '9406f932c83e7556c67d89e750127054'
+    >>> duplicate_id(None, 'invalid') == duplicate_id(None, None)
+    True
+    """
+    if isinstance(title, unicode):
+        title = title.encode('utf-8')
+    elif title is not None and not isinstance(title, str):
+        title = str(title)
+
+    try:
+        pubdate = int(pubdate or 0)
+    except (TypeError, ValueError):
+        pubdate = 0
+
+    return hashlib.md5('%s\n%d' % (title or '', pubdate)).hexdigest()
+
+
 def object_string_formatter( s, **kwargs):
     """
     Makes attributes of object passed in as keyword 
@@ -884,7 +925,7 @@ def urlopen(url):
     """
     headers = {'User-agent': gpodder.user_agent}
     request = urllib2.Request(url, headers=headers)
-    return urllib2.urlopen(request)
+    return httppool.build_opener().open(request)
 
 def find_command( command):
     """
@@ -1083,10 +1124,8 @@ def format_seconds_to_hour_min_sec(seconds):
 
 def http_request(url, method='HEAD'):
     (scheme, netloc, path, parms, qry, fragid) = urlparse.urlparse(url)
-    conn = httplib.HTTPConnection(netloc)
     start = len(scheme) + len('://') + len(netloc)
-    conn.request(method, url[start:])
-    return conn.getresponse()
+    return httppool.connection_pool.request(scheme, netloc, method, url[start:])
 
 def get_episode_info_from_url(url):
     """
@@ -1375,7 +1414,7 @@ def relpath(p1, p2):
     return os.path.join(*p)
 
 
-def run_external_command(command_line):
+def run_external_command(command_line, env=None):
     """
     This is the function that will be called in a separate
     thread that will call an external command (specified by
@@ -1385,6 +1424,9 @@ def run_external_command(command_line):
     first being the error message and the second being the
     title to be used for the error message.
 
+    If "env" is given, it is used as the environment of the
+    command instead of the environment of gPodder.
+
     >>> from minimock import mock, Mock, restore
     >>> mock('subprocess.Popen', returns=Mock('subprocess.Popen'))
     >>> run_external_command('testprogramm')
@@ -1395,7 +1437,10 @@ def run_external_command(command_line):
 
     def open_process(command_line):
         log('Running external command: %s', command_line)
-        p = subprocess.Popen(command_line, shell=True)
+        if env is None:
+            p = subprocess.Popen(command_line, shell=True)
+        else:
+            p = subprocess.Popen(command_line, shell=True, env=env)
         result = p.wait()
         if result == 127:
             log('Command not found: %s', command_line)
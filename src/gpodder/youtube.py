@@ -50,6 +50,7 @@ def get_real_download_url(url, preferred_fmt_id=18):
             req = util.http_request(url, method='GET')
             if 'location' in req.msg:
                 url = req.msg['location']
+                req.close()
             else:
                 page = req.read()
 